@@ -0,0 +1,52 @@
+import re
+
+
+def clean_address(address):
+    """
+    Clean up a Finn address string so it can be geocoded: remove any pairs of
+    parentheses and their contents, and keep only the first and last part if
+    the address has more than one comma.
+    """
+    address = re.sub(r"\s*\([^)]*\)", "", address)
+    if address.count(',') > 1:
+        address = f"{address.split(',')[0]}, {address.split(',')[-1]}"
+    return address
+
+
+def normalize_address(address):
+    """
+    Normalize an address to a key that is stable across runs and sources, e.g.
+    'FAGERHEIMGATA 18,  0475 Oslo' and 'Fagerheimgata 18, 0475 Oslo' both
+    become 'fagerheimgata 18, 0475 oslo'.
+    """
+    if not isinstance(address, str):
+        return None
+    address = clean_address(address)
+    address = re.sub(r"\s+", " ", address.casefold())
+    address = re.sub(r"\s*,\s*", ", ", address)
+    return address.strip() or None
+
+
+ADDRESS_PATTERN = re.compile(
+    r"^(?P<street>.+?)\s+(?P<number>\d+)\s*(?P<letter>[a-zæøå])?\s*,\s*(?P<postcode>\d{4})\b",
+    re.IGNORECASE,
+)
+
+
+def street_key(street):
+    """Normalize a street name for matching, e.g. 'Sverdrups gate' -> 'sverdrupsgate'."""
+    return re.sub(r"[\W_]+", "", street.casefold())
+
+
+def parse_address(address):
+    """
+    Split an address like 'Sverdrups gate 5 C, 0559 Oslo' into
+    ('sverdrupsgate', '5c', '0559'). Returns None if the address can not be parsed.
+    """
+    if not isinstance(address, str):
+        return None
+    match = ADDRESS_PATTERN.match(clean_address(address).strip())
+    if not match:
+        return None
+    number = match['number'].lstrip('0') + (match['letter'] or '').casefold()
+    return street_key(match['street']), number, match['postcode']
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import zipfile
+import datetime
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from dotenv import load_dotenv
+
+from metrics import get_metrics
+
+load_dotenv()
+
+ATLAS_URL = 'https://gis-api.atlas.co'
+ZIP_MAGIC = b'PK\x03\x04'
+CHUNK_SIZE = 1024 * 1024
+
+# Responses worth retrying: rate limiting and temporary server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Methods that can be sent again without doing something twice. Other methods, such as
+# the webhook POST, are only retried when the connection could not be made at all.
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+def _retry_after(value, default):
+    """
+    Seconds to wait from a Retry-After header, which is either a number of seconds or an
+    HTTP date. Returns default if there is no header or it cannot be parsed.
+    """
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+
+def _not_sent(error):
+    """Whether a request failed before it reached the server, because no connection was made."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests wraps the urllib3 error in a MaxRetryError with the cause as its reason
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _gzip_chunks(file_path, chunk_size=CHUNK_SIZE):
+    """Yield the gzip compressed contents of a file, one chunk at a time."""
+    compressor = zlib.compressobj(wbits=31)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+
+def _file_chunks(file_path, chunk_size=CHUNK_SIZE):
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+class AtlasClient:
+    """
+    Talk to the Atlas API over one pooled HTTP session. Every request has a timeout.
+    Requests with IDEMPOTENT_METHODS are retried with exponential backoff on connection
+    errors, timeouts and RETRY_STATUSES, waiting as long as a Retry-After header asks.
+    Other requests are only retried if the connection could not be made, so a POST that
+    may have reached the server is never sent twice.
+    """
+
+    def __init__(self, base_url=None, session=None, timeout=None, retries=None, backoff=1.0):
+        self.base_url = (base_url or os.getenv('ATLAS_URL') or ATLAS_URL).rstrip('/')
+        self.session = session or requests.Session()
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        # (connect, read) timeouts in seconds. The read timeout is per chunk, not for the whole body.
+        self.timeout = (10, timeout or float(os.getenv('ATLAS_TIMEOUT') or 60))
+        self.retries = retries if retries is not None else int(os.getenv('ATLAS_RETRIES') or 3)
+        self.backoff = backoff
+
+    def request(self, method, url, body=None, **kwargs):
+        """
+        Send a request, retrying on failure. body is a function returning the request body,
+        so a streamed body can be created again for every attempt.
+        """
+        metrics = get_metrics()
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            if attempt:
+                metrics.count('atlas.retries')
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    data=body() if body else None,
+                    timeout=self.timeout,
+                    **kwargs,
+                )
+                metrics.observe_latency('atlas', time.perf_counter() - start)
+                if not idempotent or response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                wait = _retry_after(response.headers.get('Retry-After'), self.backoff * 2**attempt)
+                print(f"{method} {url} returned {response.status_code}, retrying in {wait:.1f} s...")
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries or not (idempotent or _not_sent(e)):
+                    raise
+                wait = self.backoff * 2**attempt
+                print(f"{method} {url} failed ({e.__class__.__name__}), retrying in {wait:.1f} s...")
+            time.sleep(wait)
+
+    def login(self, username, password):
+        """Log in and use the access token for the following requests. Returns the token, or None."""
+        response = self.request(
+            'POST',
+            f'{self.base_url}/auth/login',
+            body=lambda: {'username': username, 'password': password},
+        )
+        if response.status_code != 200:
+            return None
+        token = response.json().get('access_token')
+        self.session.headers['Authorization'] = f'Bearer {token}'
+        return token
+
+    def download_dataset(self, dataset_id, dest_path):
+        """
+        Stream a dataset as GeoJSON to dest_path, unpacking it if Atlas sends a zip. The ETag
+        and Last-Modified of the download are kept next to the file, so an unchanged dataset
+        is not downloaded again.
+
+        Returns:
+        - True if the dataset was downloaded, False if dest_path is already up to date,
+          or None if the download failed.
+        """
+        print(f"Downloading existing dataset {dataset_id} from Atlas...")
+        meta_path = f'{dest_path}.meta.json'
+        headers = {}
+        if os.path.exists(dest_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('dataset_id') == dataset_id:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+        response = self.request(
+            'GET',
+            f'{self.base_url}/datasets/download/{dataset_id}',
+            params={'format': 'GEOJSON'},
+            headers=headers,
+            stream=True,
+        )
+        with response:
+            if response.status_code == 304:
+                print("The dataset has not changed since the last download.")
+                return False
+            if response.status_code != 200:
+                print(f"Failed to download dataset: {response.status_code}")
+                return None
+
+            download_path = f'{dest_path}.download'
+            with open(download_path, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+            meta = {
+                'dataset_id': dataset_id,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+
+        with open(download_path, 'rb') as f:
+            is_zip = f.read(4) == ZIP_MAGIC
+        if is_zip:
+            with zipfile.ZipFile(download_path) as zip_ref:
+                names = [name for name in zip_ref.namelist() if name.endswith('.geojson')]
+                if not names:
+                    print("The downloaded zip file does not contain a GeoJSON file.")
+                    os.remove(download_path)
+                    return None
+                with zip_ref.open(names[0]) as source, open(f'{dest_path}.unzipped', 'wb') as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+            os.remove(download_path)
+            download_path = f'{dest_path}.unzipped'
+
+        os.replace(download_path, dest_path)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        print(f"Downloaded {os.path.getsize(dest_path) / 1e6:.1f} MB to {dest_path}.")
+        return True
+
+    def upload_file(self, file_path, webhook_url, compress=False):
+        """
+        Post a GeoJSON file to a webhook as a chunked stream, without reading the whole
+        file into memory. With compress the stream is gzip compressed and sent with
+        Content-Encoding: gzip, which the webhook has to accept. Returns the JSON response.
+        """
+        headers = {'Content-Type': 'application/json'}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+            body = lambda: _gzip_chunks(file_path)
+        else:
+            body = lambda: _file_chunks(file_path)
+
+        print(f"Uploading {os.path.getsize(file_path) / 1e6:.1f} MB via webhook...")
+        response = self.request('POST', webhook_url, body=body, headers=headers)
+        print(response.status_code)
+        if response.status_code != 200:
+            raise Exception(f"Upload failed: {response.text}")
+        print(f"Upload successful. Task ID: {response.json().get('task_id')}")
+        return response.json()
+
+
+_client = None
+
+
+def get_client():
+    """Get the shared Atlas client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = AtlasClient()
+    return _client
@@ -1,191 +1,411 @@
+import io
+import time
+import argparse
 import json
-import requests
+import glob
+import shutil
 from dotenv import load_dotenv
 import os
-from file_converter import geojson_to_csv
-import pandas as pd
-import zipfile
-import io
 
-from clean_data import geocode_data, process_data
-from merge import merge_dataframes, df_to_geojson
+# pandas and the modules using it are imported in the functions that need them, so the
+# CLI starts fast and a run where nothing changed never loads them
+from atlas import get_client
+from manifest import BuildManifest
+from metrics import get_metrics, start_run
+from paths import MASTER_PATH, TILES_PATH
+from postcodes import find_postcode_file
+from transit import find_transit_stops_file
 
 load_dotenv()
 
 PATH_ROOT = os.getenv('PATH_ROOT')
 
+# Seconds between checks of the downloads folder in watch mode
+WATCH_INTERVAL = 5
+
 
 def fetch_jwt_token(username, password):
-    url = 'https://gis-api.atlas.co'
-    reqUrl = f"{url}/auth/login"
-    headersList = {"Content-Type": "application/x-www-form-urlencoded"}
-    payload = f"username={username}&password={password}"
-
-    response = requests.request("POST", reqUrl, data=payload, headers=headersList)
-    if response.status_code == 200:
-        return response.json().get("access_token")
-    else:
-        return None
+    return get_client().login(username, password)
 
 
-def get_existing_dataset_file(datasetId, headers):
-    print(f"Downloading existing dataset {datasetId} from Atlas...")
-    url = 'https://gis-api.atlas.co'
-    reqUrl = f"{url}/datasets/download/{datasetId}?format=GEOJSON"
-    response = requests.request("GET", reqUrl, headers=headers)
-    if response.status_code == 200:
-        # Check if content is a ZIP file by looking at first few bytes
-        content_start = response.content[:4]
-        is_zip = content_start.startswith(b'PK\x03\x04')
-
-        if is_zip:
-            # Handle ZIP file
-            with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
-                for file_name in zip_ref.namelist():
-                    if file_name.endswith('.geojson'):
-                        with zip_ref.open(file_name) as geojson_file:
-                            data = json.load(geojson_file)
-                            print(f"Downloaded {len(data.get('features', []))} features.")
-                            return data
-        else:
-            # Handle direct GeoJSON response
-            data = response.json()
-            print(f"Downloaded {len(data.get('features', []))} features.")
-            return data
+def get_existing_dataset_file(dataset_id, dest_path):
+    """Download the dataset to dest_path. Returns False if the local copy is already up to date."""
+    return get_client().download_dataset(dataset_id, dest_path)
 
-        return None
-    else:
-        print(f"Failed to download dataset: {response.status_code}")
+
+def upload_dataset_file(file_path, webhook_url):
+    compress = os.getenv('ATLAS_COMPRESS_UPLOAD', 'false').lower() == 'true'
+    return get_client().upload_file(file_path, webhook_url, compress=compress)
+
+
+def upload_merged_dataset(geojson_path, webhook_url, changes_path=None, mode=None, manifest=None):
+    """
+    Upload the merged dataset unless it is unchanged since the last successful upload.
+
+    With mode 'patch' (or UPLOAD_MODE=patch) only the change set at changes_path is sent,
+    to PATCH_WEBHOOK_URL if set. Otherwise the full GeoJSON file is sent. The uploaded
+    dataset is recorded as the 'upload' stage in the build manifest.
+    """
+    mode = mode or os.getenv('UPLOAD_MODE') or 'full'
+    manifest = manifest or BuildManifest()
+    if manifest.is_current('upload', [geojson_path]):
+        print("The dataset is unchanged since the last upload. Skipping upload.")
         return None
 
+    with get_metrics().stage('upload') as stage:
+        if mode == 'patch' and changes_path and os.path.exists(changes_path):
+            with open(changes_path) as f:
+                changes = json.load(f)
+            counts = {name: len(changes[name]) for name in ('added', 'updated', 'removed')}
+            if not any(counts.values()):
+                print("No changes to upload.")
+                result = None
+            else:
+                print(
+                    f"Uploading changes: {counts['added']} added, {counts['updated']} updated, "
+                    f"{counts['removed']} removed..."
+                )
+                result = upload_dataset_file(changes_path, os.getenv('PATCH_WEBHOOK_URL') or webhook_url)
+            stage['rows_in'] = sum(counts.values())
+            stage['bytes'] = os.path.getsize(changes_path)
+        else:
+            result = upload_dataset_file(geojson_path, webhook_url)
+            stage['bytes'] = os.path.getsize(geojson_path)
 
-def load_fc_from_geojson(geojson_file_path):
-    with open(geojson_file_path) as f:
-        data = json.load(f)
-    return data
+    manifest.record('upload', [geojson_path])
+    return result
 
 
-def upload_dataset_file(file_path, webhook_url):
-    data = load_fc_from_geojson(file_path)
-    print(f"Uploading {len(data['features'])} features via webhook...")
-    response = requests.post(webhook_url, json=data)
-    print(response.status_code)
-    if response.status_code == 200:
-        task_id = response.json().get('task_id')
-        print(f"Upload successful. Task ID: {task_id}")
-        return response.json()
-    else:
-        raise Exception(f"Upload failed: {response.text}")
+def source_file_pattern():
+    """The file name, or glob pattern for several files, of the CSV exports from the scraper."""
+    return os.getenv('DOWNLOAD_FILE_PATTERN') or os.getenv('DOWNLOAD_FILE_NAME') or 'finn-eiendom.csv'
 
 
-def move_fresh_file_from_downloads():
-    # check if the file exists in downloads. If it does, move it to the current directory and return the path
-    import shutil
+def move_fresh_files_from_downloads(pattern=None):
+    # check if there are exports in downloads. If there are, move them to the files directory and return their paths
     download_path = os.getenv('DOWNLOAD_PATH')
-    download_file_name = os.getenv('DOWNLOAD_FILE_NAME')
-    source = f'{download_path}/{download_file_name}'
-    dest = f'{PATH_ROOT}/files/{download_file_name}'
+    moved = []
     try:
-        if os.path.exists(source):
+        for source in sorted(glob.glob(f'{download_path}/{pattern or source_file_pattern()}')):
+            dest = f'{PATH_ROOT}/files/{os.path.basename(source)}'
             try:
                 shutil.copy2(source, dest)
                 os.remove(source)
                 print(f"Moved {source} to {dest}")
-                return dest
             except PermissionError:
                 shutil.copy2(source, dest)
                 print(f"Copied {source} to {dest} (could not delete original)")
-                return dest
+            moved.append(dest)
     except (PermissionError, OSError) as e:
         print(f"Could not access downloads folder: {e}")
         print("Please manually copy the file to the project folder if needed.")
-    return None
+    return moved
 
 
-def file_last_modified_time(file_path):
-    """Get the last modified time of a file."""
-    return os.path.getmtime(file_path)
+def find_source_files(pattern=None):
+    """Get the paths of the scraper exports in the files directory."""
+    return sorted(glob.glob(f'{PATH_ROOT}/files/{pattern or source_file_pattern()}'))
 
 
-def geocode_and_process(source_file_path, source_mod_time, geocoded_data_path):
-    if os.path.exists(geocoded_data_path):
-        if file_last_modified_time(geocoded_data_path) <= source_mod_time:
-            print("Geocoded data is outdated. Regenerating...")
-            geocode_data(source_file_path, geocoded_data_path, save_data=True)
-        else:
-            print("Geocoded data is up-to-date.")
+def read_source_files(paths):
+    """
+    Read the scraper exports into one DataFrame. Listings found by several searches are
+    kept once, from the most recent scrape, so they are only geocoded and processed once.
+    """
+    import pandas as pd
+    from delta import latest_listings
+
+    if len(paths) == 1:
+        source_df = pd.read_csv(paths[0])
+        latest_df = latest_listings(source_df)
+    else:
+        # Read the files as text and parse the result once, so the columns get the same
+        # types as if the listings came from one file and content hashes stay stable
+        source_df = pd.concat([pd.read_csv(path, dtype=str) for path in paths], ignore_index=True)
+        buffer = io.StringIO()
+        latest_listings(source_df).to_csv(buffer, index=False)
+        buffer.seek(0)
+        latest_df = pd.read_csv(buffer)
+    if len(paths) > 1 or len(latest_df) < len(source_df):
+        print(
+            f"Read {len(source_df)} listings from {len(paths)} files, "
+            f"{len(source_df) - len(latest_df)} duplicates removed."
+        )
+    return latest_df
+
+
+def transit_stops_files():
+    """The transit stop file as a list, empty if there is none, for the inputs of a stage."""
+    path = find_transit_stops_file()
+    return [path] if path and os.path.exists(path) else []
+
+
+def refresh_transit_distances(df):
+    """
+    Recompute the transit distances of the listings in an earlier dataset, so they match
+    the current stop file. Unchanged listings are kept as they are by the merge, so this
+    is the only way they get distances from a new stop file. Cheap, as the distances are
+    cached by coordinate.
+    """
+    if df is None or 'latitude' not in df.columns or not transit_stops_files():
+        return df
+    from transit import add_transit_distances
+
+    return add_transit_distances(df.copy())
+
+
+def geocode_and_process(source_file_paths, geocoded_data_path, previous_df=None, manifest=None):
+    """
+    Geocode and process only the listings that are new or changed compared to
+    previous_df. Unchanged listings are carried over from previous_df untouched.
+    Geocoding and processing are skipped if their input is the same as last time.
+    """
+    import pandas as pd
+    from clean_data import geocode_data, process_data
+    from delta import split_delta
+    from store import apply_schema
+
+    manifest = manifest or BuildManifest()
+    source_df = read_source_files(source_file_paths)
+    delta_df, carried_df = split_delta(source_df, previous_df)
+    print(f"{len(delta_df)} new or changed listings, {len(carried_df)} unchanged.")
+
+    transit_stops = transit_stops_files()
+    if delta_df.empty:
+        return carried_df
+
+    delta_file_path = f'{PATH_ROOT}/files/delta_finn_eiendom.csv'
+    delta_df.to_csv(delta_file_path, index=False)
+    geocoder = {'backend': os.getenv('GEOCODER_BACKEND') or 'nominatim', 'url': os.getenv('GEOCODER_URL')}
+    if manifest.is_current('geocode', [delta_file_path], geocoder, [geocoded_data_path]):
+        print("The new and changed listings were geocoded in an earlier run.")
+    else:
+        geocode_data(delta_file_path, geocoded_data_path, save_data=True)
+        manifest.record('geocode', [delta_file_path], geocoder, [geocoded_data_path])
+
+    processed_data_path = f'{PATH_ROOT}/files/new_finn_eiendom.csv'
+    postcodes = {'postcode_areas': find_postcode_file()}
+    if manifest.is_current('process', [geocoded_data_path, *transit_stops], postcodes, [processed_data_path]):
+        print("The geocoded data was processed in an earlier run.")
+        processed_df = apply_schema(pd.read_csv(processed_data_path))
     else:
-        print("Geocoded data not found. Generating...")
-        geocode_data(source_file_path, geocoded_data_path, save_data=True)
+        print("Processing the geocoded data...")
+        processed_df = process_data(geocoded_data_path, processed_data_path, save_data=True)
+        manifest.record('process', [geocoded_data_path, *transit_stops], postcodes, [processed_data_path])
+    if carried_df.empty:
+        return processed_df
+    return pd.concat([processed_df, carried_df], ignore_index=True)
+
+
+def load_previous_dataset():
+    """Load the master dataset, or the previous merged CSV if there is no master dataset yet."""
+    import pandas as pd
+    from store import read_master
+
+    master_df = read_master(MASTER_PATH)
+    if master_df is not None:
+        return refresh_transit_distances(master_df)
+    previous_path = f'{PATH_ROOT}/files/merged_finn_eiendom.csv'
+    if os.path.exists(previous_path):
+        return refresh_transit_distances(pd.read_csv(previous_path))
+    return None
 
-    print("Processing the geocoded data...")
-    return process_data(
-        geocoded_data_path, f'{PATH_ROOT}/files/new_finn_eiendom.csv', save_data=True
-    )
+
+def main(profile=False):
+    """
+    Run the pipeline, and save a report of the time, rows and memory of each stage to
+    files/run_reports. With profile, the stages are also profiled with cProfile and
+    tracemalloc.
+    """
+    metrics = start_run(profile)
+    try:
+        run_pipeline()
+        export_map_tiles()
+    finally:
+        metrics.write_report()
+
+
+def export_map_tiles(manifest=None):
+    """Export the master dataset as map tiles to files/tiles, unless it is unchanged since the last export."""
+    manifest = manifest or BuildManifest()
+    outputs = [f'{TILES_PATH}/tiles.json']
+    if not os.path.exists(MASTER_PATH) or manifest.is_current('tiles', [MASTER_PATH], outputs=outputs):
+        return
+    from tiles import export_tiles
+
+    with get_metrics().stage('tiles') as stage:
+        stage['written'], stage['deleted'] = export_tiles(output_path=TILES_PATH, master_path=MASTER_PATH)
+    manifest.record('tiles', [MASTER_PATH], outputs=outputs)
 
 
-def main():
+def run_pipeline():
     username = os.getenv('ATLAS_USERNAME')
     password = os.getenv('ATLAS_PASSWORD')
     dataset_id = os.getenv('DATASET_ID')
     webhook_url = os.getenv('WEBHOOK_URL')
-    move_fresh_file_from_downloads()
+    move_fresh_files_from_downloads()
 
-    token = fetch_jwt_token(username, password)
-    headers = {"Authorization": f"Bearer {token}"}
+    fetch_jwt_token(username, password)
 
-    source_file_path = f'{PATH_ROOT}/files/finn-eiendom.csv'
+    source_file_paths = find_source_files()
     geocoded_data_path = f'{PATH_ROOT}/files/geocoded_finn_eiendom.csv'
-    output_file_path = f'{PATH_ROOT}/files/merged_finn_eiendom.geojson'
+    merged_file_path = f'{PATH_ROOT}/files/merged_finn_eiendom'
+    identifying_columns = ['annonse-href']
 
-    if not os.path.exists(source_file_path):
-        raise FileNotFoundError(f"No source data found at {source_file_path}.")
+    if not source_file_paths:
+        raise FileNotFoundError(f"No source data found matching {PATH_ROOT}/files/{source_file_pattern()}.")
 
-    source_mod_time = file_last_modified_time(source_file_path)
-
-    if os.path.exists(output_file_path):
-        output_mod_time = file_last_modified_time(output_file_path)
-
-        if source_mod_time < output_mod_time:
-            print("The data is already up-to-date. No need to process.")
-            # print("Uploading the existing file to Atlas...")
-            # upload_dataset_file(f'{PATH_ROOT}/files/merged_finn_eiendom.geojson', webhook_url)
-            return
-        else:
-            print("The source file is newer than the output file. Geocoding the data...")
-            fresh_df = geocode_and_process(source_file_path, source_mod_time, geocoded_data_path)
-    else:
-        print("No output file detected. Geocoding the data...")
-        fresh_df = geocode_and_process(source_file_path, source_mod_time, geocoded_data_path)
-        # georeference the new data
+    # Get the live dataset first, so only listings that are new or changed since then
+    # need to be geocoded and processed. It is only downloaded again if it changed.
+    manifest = BuildManifest()
+    live_dataset_path = f'{PATH_ROOT}/files/existing_finn_eiendom.geojson'
+    inputs = [*source_file_paths, *transit_stops_files()]
+    if dataset_id:
+        with get_metrics().stage('download') as stage:
+            downloaded = get_existing_dataset_file(dataset_id, live_dataset_path)
+            stage['result'] = {True: 'downloaded', False: 'not modified', None: 'failed'}[downloaded]
+
+        if downloaded:
+            from snapshots import SnapshotStore
+
+            # Back up the existing dataset in case we need to revert
+            snapshots = SnapshotStore()
+            snapshots.add(live_dataset_path)
+            snapshots.prune()
+        if downloaded is not None:
+            inputs.append(live_dataset_path)
+
+    # The merged dataset only has to be rebuilt if the scraped or live data changed
+    params = {
+        'dataset_id': dataset_id,
+        'identifying_columns': identifying_columns,
+        'postcode_areas': find_postcode_file(),
+    }
+    outputs = [f'{merged_file_path}.csv', f'{merged_file_path}.geojson', MASTER_PATH]
+    if manifest.is_current('merge', inputs, params, outputs):
+        print("The data is already up-to-date. No need to process.")
+        # print("Uploading the existing file to Atlas...")
+        # upload_merged_dataset(f'{merged_file_path}.geojson', webhook_url, manifest=manifest)
+        return
+
+    import pandas as pd
+    from file_converter import load_geojson
+    from merge import merge_dataframes, df_to_geojson
+    from rollups import update_price_rollups
+    from query import update_listing_index
+    from store import read_master, write_master, sync_user_columns
 
     if dataset_id:
-        live_dataset_file = get_existing_dataset_file(dataset_id, headers)
+        if downloaded is None:
+            live_dataframe = pd.DataFrame()
+        else:
+            live_dataframe = load_geojson(live_dataset_path)
+            print(f"Loaded {len(live_dataframe)} features from the existing dataset.")
 
-        # save the existing dataset with timestamp in case we need to revert
-        with open(
-            f'{PATH_ROOT}/old_datasets/existing_finn_eiendom_{pd.Timestamp.now()}.geojson', 'w'
-        ) as f:
-            json.dump(live_dataset_file, f)
+        # The master dataset is the source of truth, except for the columns edited in Atlas
+        existing_dataframe = read_master(MASTER_PATH)
+        if existing_dataframe is None:
+            existing_dataframe = live_dataframe
+        else:
+            existing_dataframe = sync_user_columns(existing_dataframe, live_dataframe)
+        existing_dataframe = refresh_transit_distances(existing_dataframe)
 
-        live_dataset_path = f'{PATH_ROOT}/files/existing_finn_eiendom.csv'
-        live_dataframe = geojson_to_csv(live_dataset_file, live_dataset_path)
-        merged_file_path = f'{PATH_ROOT}/files/merged_finn_eiendom'
-        identifying_columns = ['annonse-href']
+        print("Geocoding the new and changed data...")
+        fresh_df = geocode_and_process(
+            source_file_paths, geocoded_data_path, existing_dataframe, manifest
+        )
 
         # merge the datasets
         print("Merging dataframes...")
-        merge_dataframes(live_dataframe, fresh_df, merged_file_path, identifying_columns)
-
-        # upload the merged file via webhook
-        # upload_dataset_file(f'{PATH_ROOT}/files/merged_finn_eiendom.geojson', webhook_url)
+        with get_metrics().stage('merge', rows_in=len(fresh_df)) as stage:
+            merged_df = merge_dataframes(
+                existing_dataframe,
+                fresh_df,
+                merged_file_path,
+                identifying_columns,
+                published_dataframe=live_dataframe,
+            )
+            write_master(merged_df, MASTER_PATH)
+            stage['rows_out'] = len(merged_df)
+        manifest.record('merge', inputs, params, outputs)
+
+        # upload the merged file, or only the changes, via webhook
+        # upload_merged_dataset(
+        #     f'{merged_file_path}.geojson',
+        #     webhook_url,
+        #     f'{merged_file_path}_changes.json',
+        #     manifest=manifest,
+        # )
     else:
+        print("Geocoding the new and changed data...")
+        fresh_df = geocode_and_process(
+            source_file_paths, geocoded_data_path, load_previous_dataset(), manifest
+        )
+
         print("No dataset ID provided. Skipping download and merge, uploading fresh data only...")
-        output_path = f'{PATH_ROOT}/files/merged_finn_eiendom'
-        df_to_geojson(fresh_df, output_path)
-        # upload_dataset_file(f'{output_path}.geojson', webhook_url)
+        fresh_df.to_csv(merged_file_path + '.csv', index=False)
+        df_to_geojson(fresh_df, merged_file_path)
+        write_master(fresh_df, MASTER_PATH)
+        update_price_rollups(fresh_df)
+        update_listing_index(fresh_df)
+        manifest.record('merge', inputs, params, outputs)
+        # upload_merged_dataset(f'{merged_file_path}.geojson', webhook_url, manifest=manifest)
+
+
+def _download_files():
+    """The size and modification time of the scraper exports in the downloads folder, by path."""
+    files = {}
+    for path in glob.glob(f"{os.getenv('DOWNLOAD_PATH')}/{source_file_pattern()}"):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def watch(interval=WATCH_INTERVAL, profile=False):
+    """
+    Keep running and run the pipeline whenever a new export from the scraper shows up in
+    the downloads folder. An export is only picked up once its size and modification time
+    are unchanged between two checks, so files that are still being written are left
+    alone. The modules and caches loaded by a run stay loaded for the next one.
+    """
+    print(f"Watching {os.getenv('DOWNLOAD_PATH')} for {source_file_pattern()}, press Ctrl+C to stop.")
+    previous = {}
+    processed = {}
+    try:
+        while True:
+            files = _download_files()
+            # Exports that could not be moved out of the downloads folder are only run once
+            if files and files == previous and files != processed:
+                try:
+                    main(profile=profile)
+                except Exception as e:
+                    # Keep watching, the next export may well work
+                    print(f"The pipeline failed: {e!r}")
+                files = processed = _download_files()
+                print(f"Waiting for the next export in {os.getenv('DOWNLOAD_PATH')}...")
+            previous = files
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Update the Finn listings dataset in Atlas.")
+    parser.add_argument(
+        '--profile', action='store_true', help="Profile each stage with cProfile and tracemalloc"
+    )
+    parser.add_argument(
+        '--watch', action='store_true', help="Keep running and process every new export in DOWNLOAD_PATH"
+    )
+    parser.add_argument(
+        '--interval', type=float, default=WATCH_INTERVAL, help="Seconds between checks in watch mode"
+    )
+    args = parser.parse_args()
     load_dotenv('.env', override=True)
-    main()
+    if args.watch:
+        watch(args.interval, profile=args.profile)
+    else:
+        main(profile=args.profile)
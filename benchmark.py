@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from delta import HASH_COLUMN, content_hash
+from merge import build_change_set, upsert_listings, merge_dataframes, df_to_geojson
+from history import append_events, change_events
+from clean_data import clean_dataframe, clean_dataframe_parallel, process_data
+from file_converter import geojson_to_csv, csv_to_geojson
+from store import apply_schema
+from tiles import export_tiles
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+BENCHMARK_DATA_PATH = f'{PATH_ROOT}/files/benchmark'
+BASELINE_PATH = f'{PATH_ROOT}/files/benchmark_baseline.json'
+
+SUITE_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# A benchmark counts as a regression if it is this much slower or uses this much more memory
+# than the baseline. Differences below the noise floor are ignored.
+TOLERANCE = 0.2
+NOISE_FLOOR_SECONDS = 0.05
+
+# One-shot CLI invocations should start well within this many seconds
+STARTUP_BUDGET_SECONDS = 1.0
+STARTUP_COMMANDS = {
+    'import automatic_upload': ['-c', "import sys, automatic_upload; print('pandas' in sys.modules)"],
+    'automatic_upload.py --help': ['automatic_upload.py', '--help'],
+    'query.py --help': ['query.py', '--help'],
+}
+
+
+def make_listings(n, seed=0, first_finnkode=200_000_000):
+    """Generate n processed Finn-like listings with the columns of the merged dataset."""
+    rng = np.random.default_rng(seed)
+    finnkoder = first_finnkode + np.arange(n)
+    rooms = rng.integers(1, 6, n)
+    area = rng.integers(25, 160, n)
+    prisantydning = (area * rng.integers(60_000, 140_000, n)).round(-4)
+    pris = prisantydning + rng.integers(50_000, 500_000, n)
+    return pd.DataFrame(
+        {
+            'annonse-href': [f'https://www.finn.no/realestate/homes/ad.html?finnkode={k}' for k in finnkoder],
+            'adresse': [f'Testgata {i % 200 + 1}, 0{450 + i % 200} Oslo' for i in range(n)],
+            'annonse': 'Lys og pen leilighet med balkong',
+            'latitude': rng.uniform(59.85, 59.98, n),
+            'longitude': rng.uniform(10.65, 10.90, n),
+            'pris': pd.array(pris, dtype='Int64'),
+            'prisantydning': pd.array(prisantydning, dtype='Int64'),
+            'internt-bruksareal': pd.array(area, dtype='Int64'),
+            'antall-rom': pd.array(rooms, dtype='Int64'),
+            'antall-soverom': pd.array(np.maximum(rooms - 1, 0), dtype='Int64'),
+            'felleskostnader': pd.array(rng.integers(1_500, 9_000, n), dtype='Int64'),
+            'byggeår': pd.array(rng.integers(1890, 2024, n), dtype='Int64'),
+            'eieform': rng.choice(['Eier (Selveier)', 'Andel', 'Aksje'], n),
+            'energiklasse': rng.choice(['A', 'B', 'C', 'D', 'E', 'F', 'G', None], n),
+            'fasiliteter': 'Balkong/Terrasse, Heis, Sentralt',
+            'heis': rng.random(n) < 0.5,
+            'balkong': rng.random(n) < 0.7,
+            'pris/m2': (pris / area).round(),
+            'web-scraper-order': [f'1720009066-{i}' for i in range(n)],
+            'solgt': False,
+            'pin': False,
+            'gjem': False,
+            'first-seen': '2024-07-03 14:55:53',
+            HASH_COLUMN: [format(k, '016x') for k in finnkoder * 7919],
+        }
+    )
+
+
+def make_scrape(existing_df, seed=1, churn=0.02):
+    """
+    Generate a fresh scrape of existing_df: a share of churn listings disappear, the same
+    number of new ones appear, and a share of churn listings get a new price.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(existing_df)
+    kept = existing_df[rng.random(n) >= churn].drop(columns=['solgt', 'pin', 'gjem', 'first-seen'])
+    changed = rng.random(len(kept)) < churn
+    kept.loc[changed, 'prisantydning'] = kept.loc[changed, 'prisantydning'] - 100_000
+    kept.loc[changed, HASH_COLUMN] = kept.loc[changed, HASH_COLUMN] + '-2'
+    added = make_listings(n - len(kept), seed=seed, first_finnkode=400_000_000)
+    added = added.drop(columns=['solgt', 'pin', 'gjem', 'first-seen'])
+    return pd.concat([kept, added], ignore_index=True)
+
+
+FACILITY_LABELS = [
+    'Balkong/Terrasse',
+    'Barnevennlig',
+    'Bredbåndstilknytning',
+    'Fellesvaskeri',
+    'Garasje/P-plass',
+    'Heis',
+    'Kjæledyr tillatt',
+    'Offentlig vann/kloakk',
+    'Peis/Ildsted',
+    'Rolig',
+    'Sentralt',
+    'Takterrasse',
+    'Utsikt',
+]
+ENERGY_LABELS = [
+    'A - Mørkegrønn',
+    'B - Lysegrønn',
+    'C - Gul',
+    'D - Oransje',
+    'E - Rød',
+    'F - Rød',
+    'G - Rød',
+]
+TRYGGHET = [
+    'Solforhold (sommer)',
+    'Nabolaget oppleves som veldig trygt',
+    'Kort gangavstand til skole',
+    'Umiddelbar nærhet til butikk',
+]
+START_URL = (
+    'https://www.finn.no/realestate/homes/search.html?facilities=1&lat=59.92555358328295&lifecycle=1'
+    '&lon=10.748986445803979&min_bedrooms=1&ownership_type=3&price_collective_from={}'
+    '&price_collective_to={}&property_type=3&radius=4000&sort=PUBLISHED_DESC&stored-id=65343065'
+)
+STREETS = ['Thorvald Meyers gate', 'Hovinveien', 'Bjerkelundgata', 'Sverdrups gate', 'Trondheimsveien']
+
+
+def _pick(rng, values, n):
+    return np.asarray(values, dtype=object)[rng.integers(0, len(values), n)]
+
+
+def _format_numbers(numbers, suffix=''):
+    """Format numbers with a unit, e.g. '5900000 kr'."""
+    return [f'{number:.0f}{suffix}' for number in numbers]
+
+
+def make_raw_scrape(n, seed=0):
+    """
+    Generate n geocoded listings with the columns of the scraper export, before
+    clean_dataframe: numbers as text with units, ranges like '60-95 m²' for new building
+    projects, energiklasse as 'C - Gul' and fasiliteter as the scraped HTML.
+    """
+    rng = np.random.default_rng(seed)
+    finnkoder = 200_000_000 + np.arange(n)
+    rooms = rng.integers(1, 6, n)
+    area = rng.integers(25, 160, n)
+    prisantydning = (area * rng.integers(60_000, 140_000, n)).round(-4)
+    omkostninger = (prisantydning * 0.025).round()
+    pris = prisantydning + omkostninger
+    price_band = rng.choice([3_500_000, 4_500_000], n)
+    # New building projects give ranges of values
+    project = rng.random(n) < 0.05
+    project_positions = np.flatnonzero(project)
+
+    def with_ranges(values, suffix):
+        text = np.array(_format_numbers(values, suffix), dtype=object)
+        upper = _format_numbers(values[project] * 1.4, suffix)
+        text[project_positions] = [
+            f"{low.removesuffix(suffix)}-{high}" for low, high in zip(text[project_positions], upper)
+        ]
+        return text
+
+    # Listings have a handful of facilities, and the same combinations come up again and again
+    facility_html = [
+        ''.join(
+            f'<div class="py-4 break-words">{label}</div>'
+            for label in rng.choice(FACILITY_LABELS, rng.integers(0, 8), replace=False)
+        )
+        for _ in range(500)
+    ]
+    listings = pd.DataFrame(
+        {
+            'latitude': rng.uniform(59.85, 59.98, n).round(6),
+            'longitude': rng.uniform(10.65, 10.90, n).round(6),
+            'internt-bruksareal': with_ranges(area, ' m²'),
+            'solgt-pris': np.where(rng.random(n) < 0.7, 0.0, np.nan),
+            'omkostninger': _format_numbers(omkostninger, ' kr'),
+            'leilighetstype': 'Leilighet',
+            'pris': _format_numbers(pris, ' kr'),
+            'trygghet': _pick(rng, TRYGGHET, n),
+            'prisantydning': with_ranges(prisantydning, ' kr'),
+            'first-seen': (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 200 * 86400, n), 's'))
+            .strftime('%Y-%m-%d %H:%M:%S')
+            .to_numpy(),
+            'web-scraper-order': [f'1720009066-{i}' for i in range(n)],
+            'antall-soverom': np.maximum(rooms - 1, 0),
+            'annonse': _pick(rng, ['Lys og pen leilighet med balkong', 'Stilren 3-roms | Solrik | Heis'], n),
+            'avstand-trikk': rng.integers(0, 600, n),
+            'utvidelsesmuligheter': rng.random(n) < 0.1,
+            'etasje': rng.integers(-1, 10, n).astype(str),
+            'energiklasse': np.where(rng.random(n) < 0.2, None, _pick(rng, ENERGY_LABELS, n)),
+            'byggeår': rng.integers(1890, 2025, n),
+            'antall-rom': with_ranges(rooms, ''),
+            'web-scraper-start-url': [START_URL.format(band, band + 2_000_000) for band in price_band],
+            'avstand-tbane': np.where(rng.random(n) < 0.1, np.nan, rng.integers(2, 1800, n)),
+            'eksternt-bruksareal': _format_numbers(rng.integers(1, 25, n), ' m²'),
+            'adresse': [
+                f'{STREETS[i % len(STREETS)]} {i % 97 + 1}{"" if i % 3 else " (Byggetrinn 2)"}, 0{450 + i % 200} Oslo'
+                for i in range(n)
+            ],
+            'image-url-src': [
+                f'https://images.finncdn.no/dynamic/1600w/{k}_1.jpg https://images.finncdn.no/dynamic/1600w/{k}_2.jpg'
+                for k in finnkoder
+            ],
+            'annonse-href': [f'https://www.finn.no/realestate/homes/ad.html?finnkode={k}' for k in finnkoder],
+            'felleskostnader': _format_numbers(rng.integers(1_500, 9_000, n), ' kr'),
+            'avstand-buss': rng.integers(1, 2200, n),
+            'bruksareal': _format_numbers(area + rng.integers(0, 15, n), ' m²'),
+            'fasiliteter': _pick(rng, facility_html, n),
+            'eieform': _pick(rng, ['Eier (Selveier)', 'Andel', 'Aksje'], n),
+        }
+    )
+    listings[HASH_COLUMN] = content_hash(listings)
+    return listings
+
+
+def write_benchmark_data(n, path=None, seed=0):
+    """
+    Write the synthetic files for n listings to path, unless they are already there: the
+    geocoded scraper export, the processed dataset as CSV (latitude and longitude first,
+    like the exports csv_to_geojson expects) and as GeoJSON. Returns the file paths.
+    """
+    path = path or BENCHMARK_DATA_PATH
+    os.makedirs(path, exist_ok=True)
+    files = {
+        'raw': f'{path}/geocoded_{n}.csv',
+        'csv': f'{path}/processed_{n}.csv',
+        'geojson': f'{path}/processed_{n}.geojson',
+    }
+    if all(os.path.exists(file_path) for file_path in files.values()):
+        return files
+    print(f"Generating {n} synthetic listings in {path}...")
+    raw_df = make_raw_scrape(n, seed)
+    raw_df.to_csv(files['raw'], index=False)
+    processed_df = clean_dataframe(raw_df)
+    processed_df.to_csv(files['csv'], index=False)
+    df_to_geojson(processed_df, files['geojson'].removesuffix('.geojson'))
+    return files
+
+
+def measure(func, repeat=1):
+    """
+    Run func repeat times and get the best wall time, then once more under tracemalloc for
+    the peak memory allocated, so tracing does not distort the timings.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': round(min(timings), 4), 'peak_mb': round(peak / 1e6, 1)}
+
+
+def _quietly(func):
+    """Run func without the progress messages of the pipeline."""
+
+    def run():
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            try:
+                return func()
+            finally:
+                sys.stdout = stdout
+
+    return run
+
+
+def bench_suite(sizes, path=None, repeat=None):
+    """Time the cleaning, merge and export paths on synthetic data. Returns the results by 'name:size'."""
+    path = path or BENCHMARK_DATA_PATH
+    results = {}
+    for n in sizes:
+        files = write_benchmark_data(n, path)
+        runs = repeat or (3 if n <= 10_000 else 1)
+        output_path = f'{path}/output_{n}'
+        os.makedirs(output_path, exist_ok=True)
+
+        existing_df = apply_schema(pd.read_csv(files['csv']))
+        fresh_df = make_scrape(existing_df)
+
+        def merge():
+            # The history and rollups are written next to the merged files. Start them
+            # afresh, with a history that is already started, as in a normal run.
+            shutil.rmtree(output_path)
+            os.makedirs(output_path)
+            first_listing = build_change_set(existing_df.iloc[:0], existing_df.iloc[:1])
+            append_events(change_events(first_listing), path=f'{output_path}/history')
+            merge_dataframes(existing_df, fresh_df, f'{output_path}/merged')
+
+        def tiles():
+            shutil.rmtree(f'{output_path}/tiles', ignore_errors=True)
+            export_tiles(existing_df, f'{output_path}/tiles')
+
+        benchmarks = {
+            'process_data': lambda: process_data(files['raw'], save_data=False, workers=1),
+            'merge_dataframes': merge,
+            'geojson_to_csv': lambda: geojson_to_csv(files['geojson'], f'{output_path}/from_geojson.csv'),
+            'df_to_geojson': lambda: df_to_geojson(existing_df, f'{output_path}/from_df'),
+            'csv_to_geojson': lambda: csv_to_geojson(files['csv'], f'{output_path}/from_csv.geojson'),
+            'export_tiles': tiles,
+        }
+        for name, func in benchmarks.items():
+            result = measure(_quietly(func), runs)
+            results[f'{name}:{n}'] = result
+            print(f"{name:<18} {n:>9} listings: {result['seconds']:8.3f} s  {result['peak_mb']:8.1f} MB")
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=TOLERANCE):
+    """Print how the results compare to the baseline. Returns the names of the regressions."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        time_ratio = result['seconds'] / before['seconds'] if before['seconds'] else 1.0
+        memory_ratio = result['peak_mb'] / before['peak_mb'] if before['peak_mb'] else 1.0
+        slower = (
+            time_ratio > 1 + tolerance and result['seconds'] - before['seconds'] > NOISE_FLOOR_SECONDS
+        )
+        larger = memory_ratio > 1 + tolerance and result['peak_mb'] - before['peak_mb'] > 1
+        flag = 'REGRESSION' if slower or larger else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<28} time {time_ratio:5.2f}x  memory {memory_ratio:5.2f}x  {flag}")
+    return regressions
+
+
+def bench_process(sizes):
+    worker_counts = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+    for n in sizes:
+        raw_df = make_raw_scrape(n)
+        start = time.perf_counter()
+        expected = clean_dataframe(raw_df)
+        serial = time.perf_counter() - start
+        print(f"clean_dataframe          {n:>9} listings: {serial:7.3f} s")
+        for workers in worker_counts[1:]:
+            start = time.perf_counter()
+            cleaned = clean_dataframe_parallel(raw_df, workers)
+            elapsed = time.perf_counter() - start
+            pd.testing.assert_frame_equal(cleaned, expected)
+            print(
+                f"clean_dataframe_parallel {n:>9} listings, {workers} workers: {elapsed:7.3f} s"
+                f"  ({serial / elapsed:.1f}x)"
+            )
+
+
+def bench_startup(repeat=5):
+    """
+    Time fresh Python processes running the CLI commands that should start fast. Returns
+    the commands that took longer than STARTUP_BUDGET_SECONDS.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    slow = []
+    for name, command in STARTUP_COMMANDS.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, *command], cwd=root, capture_output=True, text=True, check=True
+            )
+            timings.append(time.perf_counter() - start)
+        note = '  (imports pandas)' if result.stdout.strip() == 'True' else ''
+        print(f"{name:<30} {min(timings):7.3f} s{note}")
+        if min(timings) > STARTUP_BUDGET_SECONDS:
+            slow.append(name)
+    return slow
+
+
+def bench_merge(sizes):
+    for n in sizes:
+        existing_df = make_listings(n)
+        new_df = make_scrape(existing_df)
+        start = time.perf_counter()
+        merged_df, status = upsert_listings(existing_df, new_df)
+        elapsed = time.perf_counter() - start
+        counts = status.value_counts().to_dict()
+        print(f"upsert_listings {n:>9} listings: {elapsed:7.3f} s  {counts}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic listings.")
+    parser.add_argument('command', nargs='?', default='suite', choices=['suite', 'merge', 'process', 'startup'])
+    parser.add_argument('sizes', nargs='*', type=int, help="Numbers of listings")
+    parser.add_argument('--repeat', type=int, help="Runs per benchmark, the best time counts")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Baseline results to compare to")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        bench_merge(args.sizes or [10_000, 100_000, 1_000_000])
+    elif args.command == 'process':
+        bench_process(args.sizes or [100_000, 1_000_000])
+    elif args.command == 'startup':
+        slow = bench_startup(args.repeat or 5)
+        if slow:
+            print(f"Slower than {STARTUP_BUDGET_SECONDS} s to start: {', '.join(slow)}")
+            sys.exit(1)
+    else:
+        results = bench_suite(args.sizes or SUITE_SIZES, repeat=args.repeat)
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        if args.save_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump({**baseline, **results}, f, indent=1)
+            print(f"Saved the baseline to {args.baseline}.")
+        elif baseline:
+            regressions = compare_to_baseline(results, baseline, args.tolerance)
+            if regressions:
+                print(f"{len(regressions)} benchmarks regressed: {', '.join(regressions)}")
+                sys.exit(1)
+        else:
+            print("No baseline to compare to. Save one with --save-baseline.")
@@ -3,16 +3,23 @@ import os
 import re
 import pandas as pd
 import numpy as np
-from bs4 import BeautifulSoup
-from geopy.geocoders import Nominatim
 import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
+from address import clean_address
+from geocode_cache import GeocodeCache
+from geocoder import get_engine
+from offline_geocoder import get_address_index
+from facilities import parse_facilities
+from postcodes import add_postcodes
+from transit import add_transit_distances
+from metrics import get_metrics
+
 load_dotenv()
 
-PATH_ROOT = os.getenv('PATH_ROOT')
-DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH')
-DOWNLOAD_FILE_NAME = os.getenv('DOWNLOAD_FILE_NAME')
 
 NUMERIC_COLUMNS = [
     'pris',
@@ -28,10 +35,26 @@ NUMERIC_COLUMNS = [
     'felleskostnader',
 ]
 
+# Text columns cleaned with .str. A column that is blank in every row, as often happens
+# in a small delta, is read from CSV as floats, so these are made text columns first.
+TEXT_COLUMNS = ['adresse', 'image-url-src', 'energiklasse', 'fasiliteter']
+
+# Batches smaller than this are cleaned in one process, as starting workers costs more than it saves
+MIN_PARALLEL_ROWS = 100_000
+PARALLEL_CHUNK_SIZE = 50_000
+
 
 # %%
 
 
+def scrape_file_path(prefix=''):
+    """
+    The path of the scraper export in the files directory, with prefix added to the file
+    name. Read from the environment when called, so a .env loaded after import is used.
+    """
+    return f"{os.getenv('PATH_ROOT')}/files/{prefix}{os.getenv('DOWNLOAD_FILE_NAME')}"
+
+
 # Some values can be hyphenated, e.g. 1000-1500, especially if the ad is a new building project.
 # This function averages the values.
 def average_hyphenated_values(value):
@@ -49,83 +72,172 @@ def average_hyphenated_values(value):
         return pd.NA
 
 
-# Function to get latitude and longitude from the address using geocoding
-def get_lat_long(row, geocode_counter, total_rows):
-    geolocator = Nominatim(user_agent="your_geocoding_app_name")
-    # clean up the address string by removing any pairs of parentheses and their contents
-    formatted_address = format_address(row)['adresse']
-    location = geolocator.geocode(formatted_address)
-    if geocode_counter % 10 == 0 and geocode_counter > 0:
-        remaining = total_rows - geocode_counter
-        print(f"Geocoded {geocode_counter}/{total_rows} addresses. ~{remaining // 60}m {remaining % 60}s remaining.")
-    time.sleep(1)  # Sleep for 1 second every 10 requests to avoid Nominatim rate limits
-    if location:
-        row['latitude'], row['longitude'] = location.latitude, location.longitude
-    else:
+def has_address(row):
+    return isinstance(row['adresse'], str) and row['adresse'].strip() != ''
+
+
+def get_cached_lat_long(row, cache):
+    """
+    Fill in latitude and longitude from the cache. Returns False if the address is not
+    cached. Rows without an address get no coordinates and are not looked up.
+    """
+    if not has_address(row):
         row['latitude'], row['longitude'] = None, None
+        return True
+    formatted_address = format_address(row)['adresse']
+    cached = cache.get(formatted_address)
+    if cached is None:
+        return False
+    row['latitude'], row['longitude'] = cached
+    return True
+
+
+def print_geocoding_progress(start_time):
+    def progress(done, total):
+        if done % 10 == 0 or done == total:
+            remaining = round((time.monotonic() - start_time) / done * (total - done))
+            print(f"Geocoded {done}/{total} addresses. ~{remaining // 60}m {remaining % 60}s remaining.")
+
+    return progress
 
 
 def geocode_data(
-    file_path=f'{PATH_ROOT}/files/{DOWNLOAD_FILE_NAME}',
-    save_path=f'{PATH_ROOT}/files/geocoded_{DOWNLOAD_FILE_NAME}',
+    file_path=None,
+    save_path=None,
     save_data=True,
+    cache_path=None,
+    engine=None,
 ):
+    file_path = file_path or scrape_file_path()
+    save_path = save_path or scrape_file_path('geocoded_')
+    engine = engine or get_engine()
     data = pd.read_csv(file_path).to_dict(orient='records')
-    total_rows = len(data)
-    print(f"Starting geocoding of {total_rows} rows. Estimated time: ~{total_rows} seconds ({total_rows // 60} min {total_rows % 60} sec)")
+    metrics = get_metrics()
+    with metrics.stage('geocode', rows_in=len(data)) as stage:
+        with GeocodeCache(cache_path) as cache:
+            if len(cache) == 0:
+                cache.preload_existing()
+
+            # Only addresses we have never seen (or whose cache entry expired) go to the geocoder
+            uncached = [row for row in data if not get_cached_lat_long(row, cache)]
+            addresses = list(dict.fromkeys(row['adresse'] for row in uncached if has_address(row)))
+            locations = {}
+            without_address = sum(not has_address(row) for row in data)
+            if without_address:
+                print(f"Skipped {without_address} listings without an address.")
+            print(f"Found {len(data) - len(uncached) - without_address}/{len(data)} addresses in the geocode cache.")
+
+            # Resolve what we can from the local address register, so the rate limited
+            # geocoder is only used for addresses that are not in it
+            address_index = get_address_index()
+            if address_index is not None and engine.backend is not address_index:
+                locations = {
+                    address: location
+                    for address, location in address_index.geocode_many(addresses).items()
+                    if location is not None
+                }
+                print(f"Found {len(locations)}/{len(addresses)} addresses in the address register.")
+                metrics.count('address_register.hits', len(locations))
+                metrics.count('address_register.misses', len(addresses) - len(locations))
+                addresses = [address for address in addresses if address not in locations]
+
+            total_rows = len(addresses)
+            estimate = round(total_rows / engine.limiter.rate)
+            print(f"Starting geocoding of {total_rows} addresses. Estimated time: ~{estimate} seconds ({estimate // 60} min {estimate % 60} sec)")
+
+            locations.update(
+                engine.geocode_many(addresses, print_geocoding_progress(time.monotonic()))
+            )
 
-    # Initialize the geocode counter
-    geocode_counter = 0
+            # Initialize the geocode counter
+            geocode_counter = 0
 
-    # Loop over each row in the list of dictionaries
-    for row in data:
-        try:
-            get_lat_long(row, geocode_counter, total_rows)
-            geocode_counter += 1
-        except Exception as e:
-            print(f"Error processing row: {e}")
+            for address, location in locations.items():
+                if isinstance(location, Exception):
+                    print(f"Error geocoding '{address}': {location}")
+                    continue
+                latitude, longitude = location if location else (None, None)
+                cache.set(address, latitude, longitude, commit=False)
+                geocode_counter += 1
+            cache.commit()
+            metrics.count('geocode_cache.hits', cache.hits)
+            metrics.count('geocode_cache.misses', cache.misses)
+            metrics.count('geocoder.requests', len(addresses))
 
-    # Convert the list of dictionaries back to a DataFrame
-    df = pd.DataFrame(data)
+            for row in uncached:
+                location = locations.get(row['adresse'])
+                if isinstance(location, Exception) or not location:
+                    row['latitude'], row['longitude'] = None, None
+                else:
+                    row['latitude'], row['longitude'] = location
 
-    if save_data:
-        df.to_csv(save_path, index=False)
+        # Convert the list of dictionaries back to a DataFrame
+        df = pd.DataFrame(data)
+
+        if save_data:
+            df.to_csv(save_path, index=False)
 
-    # Display the final number of geocoded addresses
-    print(f"Geocoded {geocode_counter} addresses.")
+        # Display the final number of geocoded addresses
+        print(f"Geocoded {geocode_counter} addresses.")
+        stage['rows_out'] = len(df)
 
 
 def format_address(row):
-    row['adresse'] = re.sub(r"\s*\([^)]*\)", "", row['adresse'])  # Adjusted regex pattern
-    if row['adresse'].count(',') > 1:
-        row['adresse'] = f"{row['adresse'].split(',')[0]}, {row['adresse'].split(',')[-1]}"
+    row['adresse'] = clean_address(row['adresse'])
     return row
 
 
-def process_data(
-    file_path=f'{PATH_ROOT}/files/geocoded_{DOWNLOAD_FILE_NAME}',
-    save_path=f'{PATH_ROOT}/files/new_{DOWNLOAD_FILE_NAME}',
-    save_data=True,
-):
-    # Read the CSV file into a DataFrame
-    df = pd.read_csv(file_path)
-
-    df = df.apply(format_address, axis=1)
+def format_address_column(addresses):
+    """Vectorized format_address for a Series of addresses."""
+    addresses = addresses.str.replace(r"\s*\([^)]*\)", "", regex=True)
+    # Keep only the first and last part of addresses with more than one comma
+    first_and_last = addresses.str.extract(r"^([^,]*),.*,([^,]*)$", flags=re.DOTALL)
+    return (first_and_last[0] + ', ' + first_and_last[1]).fillna(addresses)
+
+
+def parse_numeric_column(values):
+    """
+    Vectorized average_hyphenated_values, followed by stripping everything but digits and
+    dots and converting the result to numbers.
+    """
+    inferred_type = pd.api.types.infer_dtype(values, skipna=True)
+    if inferred_type not in ('string', 'mixed', 'mixed-integer', 'empty'):
+        return pd.to_numeric(values, errors='coerce')
+
+    # Values repeat a lot (rooms, floors, build years), so parse each distinct value once
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    numbers = pd.to_numeric(
+        uniques.str.replace(r'[^\d.]', '', regex=True).fillna(uniques), errors='coerce'
+    ).astype(float)
+
+    hyphenated = uniques.str.contains('-', regex=False, na=False)
+    if hyphenated.any():
+        parts = uniques[hyphenated].str.findall(r'\d+(?:\.\d+)?').explode().astype(float)
+        averages = parts.groupby(level=0).mean().round()
+        numbers[hyphenated] = averages.reindex(uniques.index[hyphenated])
+
+    # Missing values have code -1, which picks the NaN appended at the end
+    return pd.Series(np.append(numbers.to_numpy(), np.nan)[codes], index=values.index)
+
+
+def clean_dataframe(df):
+    """
+    Clean a geocoded DataFrame from the scraper: format addresses, parse numbers and
+    energy labels, extract facilities and add the derived columns.
+    """
+    df = df.copy()
+    for col in TEXT_COLUMNS:
+        df[col] = df[col].astype(object).where(df[col].isna(), df[col].astype(str))
+    df['adresse'] = format_address_column(df['adresse'])
     # Extract the first image URL
-    df['image-url-src'] = df['image-url-src'].apply(
-        lambda x: x.split()[0] if not pd.isna(x) else None
-    )
-    df.apply(lambda x: pd.to_numeric(x, errors="ignore"))  # type: ignore
+    first_image_urls = df['image-url-src'].str.split().str[0]
+    df['image-url-src'] = first_image_urls.astype(object).where(first_image_urls.notna(), None)
 
     # Convert specified columns to numeric
     numeric_columns = NUMERIC_COLUMNS
-    for col in numeric_columns:
-        df[col] = df[col].apply(average_hyphenated_values)
-
     df[numeric_columns] = (
-        df[numeric_columns]
-        .replace('[^\d.]', '', regex=True)
-        .apply(pd.to_numeric, errors='coerce')
+        pd.DataFrame({col: parse_numeric_column(df[col]) for col in numeric_columns})
         .round(0)
         .astype('Int64')
     )
@@ -137,26 +249,9 @@ def process_data(
     df['energiklasse'] = energimerking_parts[0]  # The letter grade
     df['energiklasse-farge'] = energimerking_parts[1]  # The color description
 
-    # Apply try-except block for 'fasiliteter'
-    try:
-        df['fasiliteter'] = df['fasiliteter'].apply(
-            lambda x: (
-                [
-                    item.text
-                    for item in BeautifulSoup(x, 'html.parser').find_all(
-                        'div', class_='py-4 break-words'
-                    )
-                ]
-                if pd.notna(x)
-                else []
-            )
-        )
-        # After converting to text, check for "utvidelsesmuligheter" in the string
-    except Exception as e:
-        print(f"Error processing 'fasiliteter': {e}")
-
-    df['heis'] = df['fasiliteter'].apply(lambda x: 'Heis' in x)
-    df['balkong'] = df['fasiliteter'].apply(lambda x: 'Balkong/Terrasse' in x)
+    # Extract the facilities as text, with a boolean column for the ones we filter on
+    df['fasiliteter'], facility_flags = parse_facilities(df['fasiliteter'])
+    df[facility_flags.columns] = facility_flags
     df['pris/m2'] = round(df['pris'] / df['internt-bruksareal'])
     df['prisantydning/m2'] = round(df['prisantydning'] / df['internt-bruksareal'])
     df['solgt'] = False
@@ -165,6 +260,72 @@ def process_data(
     # TODO: make sure this is where to add this
     # df['first-seen'] = time.strftime("%Y-%m-%d %H:%M:%S")
 
+    return df
+
+
+# The DataFrame clean_dataframe_parallel is cleaning. Forked workers inherit it, so only
+# the row ranges have to be sent to them
+_parallel_df = None
+
+
+def _clean_rows(rows):
+    start, stop = rows
+    return clean_dataframe(_parallel_df.iloc[start:stop])
+
+
+def clean_dataframe_parallel(df, workers=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    clean_dataframe in a pool of worker processes. df is split into consecutive chunks of
+    rows, at least one per worker, and the cleaned chunks are put back together in the
+    original order, so the result is the same as with clean_dataframe.
+    """
+    global _parallel_df
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(df) < MIN_PARALLEL_ROWS:
+        return clean_dataframe(df)
+    chunk_size = min(chunk_size, -(-len(df) // workers))
+    bounds = [(start, min(start + chunk_size, len(df))) for start in range(0, len(df), chunk_size)]
+    workers = min(workers, len(bounds))
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _parallel_df = df
+        try:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                cleaned = list(pool.map(_clean_rows, bounds))
+        finally:
+            _parallel_df = None
+    else:
+        # Without fork every worker gets its chunk pickled
+        with ProcessPoolExecutor(workers) as pool:
+            cleaned = list(pool.map(clean_dataframe, (df.iloc[start:stop] for start, stop in bounds)))
+    return pd.concat(cleaned)
+
+
+def process_data(
+    file_path=None,
+    save_path=None,
+    save_data=True,
+    workers=None,
+):
+    """
+    Clean the geocoded CSV at file_path, add postal codes and compute the distances to the
+    nearest transit stops. With workers above 1 (or PROCESS_WORKERS), large batches are
+    cleaned in that many processes; 0 uses all cores.
+    """
+    file_path = file_path or scrape_file_path('geocoded_')
+    save_path = save_path or scrape_file_path('new_')
+    if workers is None:
+        workers = int(os.getenv('PROCESS_WORKERS') or 1)
+
+    # Read the CSV file into a DataFrame
+    df = pd.read_csv(file_path)
+
+    with get_metrics().stage('process', rows_in=len(df)) as stage:
+        df = clean_dataframe_parallel(df, workers or None)
+        df = add_postcodes(df)
+        df = add_transit_distances(df)
+        stage['rows_out'] = len(df)
+
     if save_data:
         df.to_csv(save_path, index=False)
 
@@ -175,12 +336,10 @@ def process_data(
 
 def move_fresh_file_from_downloads():
     # check if the file exists in downloads. If it does, move it to the current directory and return the path
-    if os.path.exists(f'{DOWNLOAD_PATH}/{DOWNLOAD_FILE_NAME}'):
-        os.rename(
-            f'{DOWNLOAD_PATH}/{DOWNLOAD_FILE_NAME}',
-            f'{PATH_ROOT}/files/{DOWNLOAD_FILE_NAME}',
-        )
-        return f'{PATH_ROOT}/files/{DOWNLOAD_FILE_NAME}'
+    download_file_path = f"{os.getenv('DOWNLOAD_PATH')}/{os.getenv('DOWNLOAD_FILE_NAME')}"
+    if os.path.exists(download_file_path):
+        os.rename(download_file_path, scrape_file_path())
+        return scrape_file_path()
     else:
         return None
 
@@ -189,17 +348,24 @@ def move_fresh_file_from_downloads():
 
 
 if __name__ == "__main__":
-    move_fresh_file_from_downloads()
-    geocode_data(
-        file_path=f'{PATH_ROOT}/files/{DOWNLOAD_FILE_NAME}',
-        save_path=f'{PATH_ROOT}/files/geocoded_{DOWNLOAD_FILE_NAME}',
-        save_data=True,
-    )
+    parser = argparse.ArgumentParser(description="Geocode and clean the scraped listings.")
+    parser.add_argument('--workers', type=int, help="Processes used for cleaning, 0 for all cores")
+    parser.add_argument('--skip-geocoding', action='store_true', help="Only clean the geocoded file")
+    args = parser.parse_args()
+
+    if not args.skip_geocoding:
+        move_fresh_file_from_downloads()
+        geocode_data(
+            file_path=scrape_file_path(),
+            save_path=scrape_file_path('geocoded_'),
+            save_data=True,
+        )
     df = process_data(
-        file_path=f'{PATH_ROOT}/files/geocoded_{DOWNLOAD_FILE_NAME}',
-        # file_path=f'{PATH_ROOT}/files/finn-eiendom.csv',
-        save_path=f'{PATH_ROOT}/files/new_{DOWNLOAD_FILE_NAME}',
+        file_path=scrape_file_path('geocoded_'),
+        # file_path=scrape_file_path(),
+        save_path=scrape_file_path('new_'),
         save_data=True,
+        workers=args.workers,
     )
 
     # %%
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+HASH_COLUMN = 'innhold-hash'
+
+# Columns that change on every scrape without the listing itself changing
+VOLATILE_COLUMNS = [
+    'web-scraper-order',
+    'web-scraper-start-url',
+    'latitude',
+    'longitude',
+    HASH_COLUMN,
+]
+
+
+# Floats up to this are exact integers, so whole numbers among them can be written as ints
+MAX_EXACT_FLOAT = 2**53
+
+
+def _canonical_text(values):
+    """
+    The values of a column as text that does not depend on the type pandas guessed for it.
+    One missing value turns a column of ints into floats, so whole floats are written as
+    ints: 3 and 3.0 both become '3'.
+    """
+    text = values.astype(str)
+    if pd.api.types.is_float_dtype(values):
+        whole = values.notna() & (values % 1 == 0) & (values.abs() < MAX_EXACT_FLOAT)
+        text[whole] = values[whole].astype('int64').astype(str)
+    return text
+
+
+def content_hash(df):
+    """
+    Hash the scraped content of each row, ignoring columns that change on every scrape.
+    Returns a Series of hex strings aligned with df.
+    """
+    columns = sorted(col for col in df.columns if col not in VOLATILE_COLUMNS)
+    text = pd.DataFrame({col: _canonical_text(df[col]) for col in columns}, index=df.index)
+    hashes = pd.util.hash_pandas_object(text, index=False)
+    return hashes.map(lambda h: format(h, '016x'))
+
+
+def split_delta(fresh_df, previous_df, unique_column='annonse-href'):
+    """
+    Split a freshly scraped DataFrame into the rows that are new or changed since the
+    previous dataset, and the previous rows for listings that are unchanged.
+
+    Parameters:
+    - fresh_df: The raw scraped DataFrame.
+    - previous_df: The live dataset or the previous merged DataFrame.
+    - unique_column: Column identifying a listing.
+
+    Returns:
+    - delta_df: Rows of fresh_df that need to be geocoded and processed.
+    - carried_df: Rows of previous_df for listings in fresh_df that have not changed.
+    """
+    fresh_df = fresh_df.copy()
+    fresh_df[HASH_COLUMN] = content_hash(fresh_df)
+
+    if previous_df is None or previous_df.empty or HASH_COLUMN not in previous_df.columns:
+        return fresh_df, pd.DataFrame(columns=fresh_df.columns)
+
+    previous_hashes = previous_df.drop_duplicates(subset=[unique_column], keep='last').set_index(
+        unique_column
+    )[HASH_COLUMN]
+    unchanged = fresh_df[HASH_COLUMN].eq(fresh_df[unique_column].map(previous_hashes))
+
+    delta_df = fresh_df[~unchanged]
+    carried_df = previous_df[
+        previous_df[unique_column].isin(fresh_df.loc[unchanged, unique_column])
+    ].drop_duplicates(subset=[unique_column], keep='last')
+    return delta_df, carried_df
+
+
+def latest_listings(df, unique_column='annonse-href'):
+    """
+    Drop duplicate listings, e.g. from overlapping searches, keeping the most recently
+    scraped row of each. web-scraper-order is '<unix time>-<position>', so it is compared
+    as two numbers. The kept rows stay in the order of df.
+    """
+    if 'web-scraper-order' in df:
+        parts = df['web-scraper-order'].astype(str).str.extract(r'^(\d+)-(\d+)$').astype(float).fillna(-1)
+        order = np.lexsort((parts[1].to_numpy(), parts[0].to_numpy()))
+    else:
+        order = np.arange(len(df))
+    duplicated = df[unique_column].iloc[order].duplicated(keep='last').to_numpy()
+    return df.iloc[np.sort(order[~duplicated])]
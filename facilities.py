@@ -0,0 +1,121 @@
+import re
+import html
+from html.parser import HTMLParser
+import numpy as np
+import pandas as pd
+
+# Each facility on Finn is a <div class="py-4 break-words">Label</div> in the scraped HTML
+FACILITY_CLASS = 'py-4 break-words'
+FACILITY_PATTERN = re.compile(
+    r'<div\s[^>]*?class=(["\'])py-4 break-words\1[^>]*>(.*?)</div>', re.DOTALL | re.IGNORECASE
+)
+FACILITY_START_PATTERN = re.compile(r'<div\s[^>]*?class=(["\'])py-4 break-words\1', re.IGNORECASE)
+TAG_PATTERN = re.compile(r'<[^>]+>')
+NESTED_DIV_PATTERN = re.compile(r'<div[\s>/]', re.IGNORECASE)
+
+# Boolean column for each facility we care about, and the Finn labels that count as it
+FACILITY_COLUMNS = {
+    'heis': ['Heis'],
+    'balkong': ['Balkong/Terrasse'],
+    'takterrasse': ['Takterrasse'],
+    'garasje': ['Garasje/P-plass'],
+    'lademulighet': ['Lademulighet'],
+    'peis': ['Peis/Ildsted'],
+    'fellesvaskeri': ['Fellesvaskeri'],
+    'balansert-ventilasjon': ['Balansert ventilasjon'],
+    'aircondition': ['Aircondition'],
+    'vaktmester': ['Vaktmester-/vektertjeneste'],
+    'kjæledyr-tillatt': ['Kjæledyr tillatt', 'Husdyr tillatt'],
+    'hage': ['Hage'],
+    'utsikt': ['Utsikt'],
+    'ingen-gjenboere': ['Ingen gjenboere'],
+}
+
+_LABEL_COLUMNS = {
+    label.casefold(): i for i, labels in enumerate(FACILITY_COLUMNS.values()) for label in labels
+}
+
+
+class FacilityParser(HTMLParser):
+    """
+    Collect the text of every facility div. Divs are matched up with their own closing
+    tag, so a facility with nested divs gets all of its text, like BeautifulSoup would.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.facilities = []
+        # Whether each open div is a facility, and the text parts of the open facilities by position
+        self._open_divs = []
+        self._texts = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'div':
+            return
+        is_facility = dict(attrs).get('class') == FACILITY_CLASS
+        self._open_divs.append(is_facility)
+        if is_facility:
+            self._texts[len(self.facilities)] = []
+            self.facilities.append(None)
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self._open_divs and self._open_divs.pop():
+            position = max(self._texts)
+            self.facilities[position] = ''.join(self._texts.pop(position)).strip()
+
+    def handle_data(self, data):
+        for parts in self._texts.values():
+            parts.append(data)
+
+    def close(self):
+        super().close()
+        # Facilities that are never closed run to the end of the HTML
+        for position, parts in self._texts.items():
+            self.facilities[position] = ''.join(parts).strip()
+        self._texts = {}
+
+
+def extract_facilities(fasiliteter_html):
+    """
+    Get the list of facility labels from the fasiliteter HTML of a listing. The regex
+    ends each facility at the first </div>, which is only its own closing tag if no other
+    div opens inside it. HTML with nested or unclosed facility divs is parsed with
+    FacilityParser instead.
+    """
+    if not isinstance(fasiliteter_html, str):
+        return []
+    contents = [match[2] for match in FACILITY_PATTERN.finditer(fasiliteter_html)]
+    unclosed = len(FACILITY_START_PATTERN.findall(fasiliteter_html)) != len(contents)
+    if not unclosed and not any(NESTED_DIV_PATTERN.search(content) for content in contents):
+        return [html.unescape(TAG_PATTERN.sub('', content)).strip() for content in contents]
+
+    parser = FacilityParser()
+    parser.feed(fasiliteter_html)
+    parser.close()
+    return parser.facilities
+
+
+def parse_facilities(fasiliteter):
+    """
+    Parse a Series of fasiliteter HTML. Identical HTML is only parsed once.
+
+    Returns:
+    - text: The facilities of each listing as comma separated text.
+    - flags: A DataFrame with a boolean column for each facility in FACILITY_COLUMNS.
+    """
+    codes, uniques = pd.factorize(fasiliteter)
+    # Missing values have code -1, which picks the empty entry appended at the end
+    parsed = [extract_facilities(value) for value in uniques] + [[]]
+
+    flags = np.zeros((len(parsed), len(FACILITY_COLUMNS)), dtype=bool)
+    for row, facilities in enumerate(parsed):
+        for facility in facilities:
+            column = _LABEL_COLUMNS.get(facility.casefold())
+            if column is not None:
+                flags[row, column] = True
+    text = np.array([', '.join(facilities) for facilities in parsed], dtype=object)
+
+    return (
+        pd.Series(text[codes], index=fasiliteter.index, name=fasiliteter.name),
+        pd.DataFrame(flags[codes], index=fasiliteter.index, columns=list(FACILITY_COLUMNS)),
+    )
@@ -1,59 +1,120 @@
+import os
+import io
 import json
 import csv
+import zipfile
+import contextlib
+import numpy as np
 import pandas as pd
 
+from atlas import ZIP_MAGIC
 
-def geojson_path_to_csv(geojson_file_path, csv_file):
-    with open(geojson_file_path) as f:
-        data = json.load(f)
-
-    features = data['features']
-    attribute_names = set()
-
-    for feature in features:
-        attributes = feature['properties']
-        attribute_names.update(attributes.keys())
-
-    with open(csv_file, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['latitude', 'longitude'] + list(attribute_names))
-
-        for feature in features:
-            coordinates = feature['geometry']['coordinates']
-            attributes = feature['properties']
-            row = [coordinates[1], coordinates[0]] + [
-                attributes.get(attr) for attr in attribute_names
-            ]
-            writer.writerow(row)
 
+def geojson_path_to_csv(geojson_file_path, csv_file):
+    load_geojson(geojson_file_path).to_csv(csv_file, index=False)
+
+
+def _features_from_source(source, iterative=False):
+    """
+    Iterate over the features of a GeoJSON FeatureCollection given as a parsed dict, a file
+    path, bytes or a binary file object. Zipped GeoJSON is detected from the content and the
+    first .geojson member is read. With iterative=True the features are parsed one at a time
+    with ijson, so the whole collection never has to be in memory.
+    """
+    if isinstance(source, dict):
+        yield from source.get('features', [])
+        return
+
+    if isinstance(source, (bytes, bytearray)):
+        f = io.BytesIO(source)
+    elif isinstance(source, (str, os.PathLike)):
+        f = open(source, 'rb')
+    else:
+        f = source
+
+    with contextlib.ExitStack() as stack:
+        if f is not source:
+            stack.enter_context(f)
+        if f.read(4) == ZIP_MAGIC:
+            f.seek(0)
+            zip_ref = stack.enter_context(zipfile.ZipFile(f))
+            member = next(name for name in zip_ref.namelist() if name.endswith('.geojson'))
+            f = stack.enter_context(zip_ref.open(member))
+        else:
+            f.seek(0)
+
+        if iterative:
+            import ijson
+
+            yield from ijson.items(f, 'features.item', use_float=True)
+        else:
+            yield from json.load(f).get('features', [])
+
+
+def _typed_column(values):
+    """Build a column with a proper dtype from a list of JSON values."""
+    inferred_type = pd.api.types.infer_dtype(values, skipna=True)
+    has_missing = any(value is None for value in values)
+    if inferred_type == 'integer':
+        return pd.array(values, dtype='Int64' if has_missing else 'int64')
+    if inferred_type == 'boolean':
+        return pd.array(values, dtype='boolean' if has_missing else 'bool')
+    if inferred_type in ('floating', 'mixed-integer-float'):
+        return pd.array([np.nan if value is None else value for value in values], dtype='float64')
+    return pd.array(values, dtype=object)
+
+
+def load_geojson(source, iterative=False):
+    """
+    Load the Point features of a GeoJSON FeatureCollection into a DataFrame in one pass.
+    latitude and longitude come from the geometry, followed by the properties in the order
+    they first appear. Properties named latitude or longitude are replaced by the geometry.
+
+    Parameters:
+    - source: A parsed GeoJSON dict, a file path, bytes or a binary file object, zipped or not.
+    - iterative: Parse the features one at a time with ijson instead of loading the whole file.
+
+    Returns:
+    - df: A DataFrame with a typed column per property.
+    """
+    columns = {'latitude': [], 'longitude': []}
+    count = 0
+    for feature in _features_from_source(source, iterative):
+        coordinates = (feature.get('geometry') or {}).get('coordinates') or [None, None]
+        columns['longitude'].append(coordinates[0])
+        columns['latitude'].append(coordinates[1])
+        for key, value in (feature.get('properties') or {}).items():
+            if key in ('latitude', 'longitude'):
+                continue
+            if key not in columns:
+                columns[key] = [None] * count
+            columns[key].append(value)
+        count += 1
+        # Properties missing from this feature
+        for values in columns.values():
+            if len(values) < count:
+                values.append(None)
+
+    if count == 0:
+        return pd.DataFrame()
+    return pd.DataFrame({key: _typed_column(values) for key, values in columns.items()})
 
-def geojson_to_csv(geojson, csv_file):
 
+def geojson_to_csv(geojson, csv_file=None):
+    """
+    Load a GeoJSON FeatureCollection into a DataFrame, see load_geojson. The DataFrame is
+    only written to csv_file if one is given.
+    """
     # geojson is a dictionary
     # check if it has the required keys. If not, return an empty DataFrame
-    if not geojson or 'type' not in geojson or 'features' not in geojson:
+    if isinstance(geojson, dict) and ('type' not in geojson or 'features' not in geojson):
+        return pd.DataFrame()
+    if not geojson:
         return pd.DataFrame()
 
-    features = geojson['features']
-    attribute_names = set()
-
-    for feature in features:
-        attributes = feature['properties']
-        attribute_names.update(attributes.keys())
-
-    with open(csv_file, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['latitude', 'longitude'] + list(attribute_names))
-
-        for feature in features:
-            coordinates = feature['geometry']['coordinates']
-            attributes = feature['properties']
-            row = [coordinates[1], coordinates[0]] + [
-                attributes.get(attr) for attr in attribute_names
-            ]
-            writer.writerow(row)
-
-    df = pd.read_csv(csv_file)
+    df = load_geojson(geojson)
+    if csv_file:
+        df.to_csv(csv_file, index=False)
     return df
 
 
@@ -0,0 +1,171 @@
+import os
+import sys
+import glob
+import json
+import sqlite3
+import time
+import pandas as pd
+from dotenv import load_dotenv
+
+from address import normalize_address
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+
+# Found addresses rarely move, but a miss might resolve later if Nominatim is updated,
+# so misses expire a lot sooner than hits.
+HIT_TTL_DAYS = 365
+MISS_TTL_DAYS = 30
+MAX_ENTRIES = 200_000
+
+
+class GeocodeCache:
+    """
+    Persistent geocoding cache backed by SQLite, keyed on the normalized address.
+
+    Both hits and misses are stored, so an address that Nominatim could not resolve
+    is not looked up again until its entry expires.
+    """
+
+    def __init__(
+        self,
+        db_path=None,
+        hit_ttl_days=HIT_TTL_DAYS,
+        miss_ttl_days=MISS_TTL_DAYS,
+        max_entries=MAX_ENTRIES,
+    ):
+        self.db_path = db_path or f'{PATH_ROOT}/files/geocode_cache.sqlite'
+        self.hit_ttl = hit_ttl_days * 24 * 60 * 60
+        self.miss_ttl = miss_ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS geocode (
+                address TEXT PRIMARY KEY,
+                latitude REAL,
+                longitude REAL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+
+    def get(self, address):
+        """
+        Look up an address. Returns None if the address is not cached or the entry has
+        expired, otherwise a (latitude, longitude) tuple where both are None for a
+        cached miss.
+        """
+        key = normalize_address(address)
+        row = self.conn.execute(
+            'SELECT latitude, longitude, updated_at FROM geocode WHERE address = ?', (key,)
+        ).fetchone()
+        if row is None or self._expired(row[0], row[2]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], row[1]
+
+    def set(self, address, latitude, longitude, commit=True):
+        key = normalize_address(address)
+        if key is None:
+            return
+        self.conn.execute(
+            'INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)',
+            (key, latitude, longitude, time.time()),
+        )
+        if commit:
+            self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def preload(self, entries):
+        """
+        Bulk insert (address, latitude, longitude) entries without overwriting anything
+        that is already cached. Returns the number of new entries.
+        """
+        now = time.time()
+        rows = {}
+        for address, latitude, longitude in entries:
+            key = normalize_address(address)
+            if key is None or pd.isna(latitude) or pd.isna(longitude):
+                continue
+            rows[key] = (key, float(latitude), float(longitude), now)
+        before = len(self)
+        self.conn.executemany('INSERT OR IGNORE INTO geocode VALUES (?, ?, ?, ?)', rows.values())
+        self.conn.commit()
+        return len(self) - before
+
+    def preload_from_csv(self, csv_path):
+        df = pd.read_csv(csv_path, usecols=lambda c: c in ('adresse', 'latitude', 'longitude'))
+        if not {'adresse', 'latitude', 'longitude'}.issubset(df.columns):
+            return 0
+        return self.preload(df[['adresse', 'latitude', 'longitude']].itertuples(index=False))
+
+    def preload_from_geojson(self, geojson_path):
+        with open(geojson_path) as f:
+            data = json.load(f)
+        entries = []
+        for feature in data.get('features', []):
+            geometry = feature.get('geometry') or {}
+            coordinates = geometry.get('coordinates') or [None, None]
+            address = (feature.get('properties') or {}).get('adresse')
+            entries.append((address, coordinates[1], coordinates[0]))
+        return self.preload(entries)
+
+    def preload_existing(self, root=None):
+        """Preload coordinates from earlier geocoded CSVs and the merged GeoJSON."""
+        root = root or f'{PATH_ROOT}/files'
+        added = 0
+        for csv_path in sorted(glob.glob(f'{root}/geocoded_*.csv')):
+            added += self.preload_from_csv(csv_path)
+        if os.path.exists(f'{root}/merged_finn_eiendom.geojson'):
+            added += self.preload_from_geojson(f'{root}/merged_finn_eiendom.geojson')
+        print(f"Preloaded {added} addresses into the geocode cache.")
+        return added
+
+    def prune(self):
+        """Delete expired entries and evict the oldest ones above max_entries."""
+        now = time.time()
+        self.conn.execute(
+            'DELETE FROM geocode WHERE (latitude IS NOT NULL AND updated_at < ?)'
+            ' OR (latitude IS NULL AND updated_at < ?)',
+            (now - self.hit_ttl, now - self.miss_ttl),
+        )
+        self.conn.execute(
+            'DELETE FROM geocode WHERE address IN ('
+            ' SELECT address FROM geocode ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,),
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.prune()
+        self.conn.close()
+
+    def _expired(self, latitude, updated_at):
+        ttl = self.hit_ttl if latitude is not None else self.miss_ttl
+        return time.time() - updated_at > ttl
+
+
+if __name__ == '__main__':
+    # python geocode_cache.py [preload|prune]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'preload'
+    with GeocodeCache() as cache:
+        if command == 'preload':
+            cache.preload_existing()
+        print(f"Geocode cache contains {len(cache)} addresses.")
@@ -0,0 +1,252 @@
+import os
+import time
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+from offline_geocoder import get_address_index
+from metrics import get_metrics
+from atlas import RETRY_STATUSES
+
+load_dotenv()
+
+USER_AGENT = "your_geocoding_app_name"
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org'
+
+# The public Nominatim usage policy allows at most 1 request per second, without
+# parallel requests. Self-hosted geocoders can be driven much harder.
+DEFAULT_RATES = {
+    'nominatim': (1.0, 1),
+    'local-nominatim': (50.0, 8),
+    'pelias': (50.0, 8),
+    'offline': (float('inf'), 1),
+}
+
+
+def _is_retryable(error):
+    """Whether a failed geocoding request is worth sending again."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in RETRY_STATUSES
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Time spent on the request itself counts
+    towards the wait, unlike a fixed sleep after every request.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token and return how many seconds to wait before using it."""
+        if self.rate == float('inf'):
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def create_session(pool_size=1):
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class NominatimBackend:
+    """Geocode with the Nominatim search API, either the public one or a self-hosted instance."""
+
+    def __init__(self, base_url=NOMINATIM_URL, session=None, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.session = session or create_session()
+        self.timeout = timeout
+
+    def geocode(self, address):
+        response = self.session.get(
+            f'{self.base_url}/search',
+            params={'q': address, 'format': 'jsonv2', 'limit': 1},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        results = response.json()
+        if not results:
+            return None
+        return float(results[0]['lat']), float(results[0]['lon'])
+
+
+class PeliasBackend:
+    """Geocode with a (self-hosted) Pelias instance."""
+
+    def __init__(self, base_url, session=None, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.session = session or create_session()
+        self.timeout = timeout
+
+    def geocode(self, address):
+        response = self.session.get(
+            f'{self.base_url}/v1/search',
+            params={'text': address, 'size': 1},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        features = response.json().get('features', [])
+        if not features:
+            return None
+        longitude, latitude = features[0]['geometry']['coordinates'][:2]
+        return latitude, longitude
+
+
+class GeocodingEngine:
+    """
+    Geocode addresses through one backend, sharing a single client and HTTP session.
+    Requests are rate limited with a token bucket, and with concurrency > 1 they are
+    sent concurrently from an asyncio event loop. Connection errors, timeouts and
+    RETRY_STATUSES are retried with exponential backoff, and every retry waits for the
+    rate limiter like a new request.
+    """
+
+    def __init__(self, backend, rate=1.0, concurrency=1, retries=2, backoff=1.0):
+        self.backend = backend
+        self.limiter = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.request_count = 0
+        self.request_seconds = 0.0
+
+    def geocode(self, address):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                return self._timed_geocode(address)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+            time.sleep(self.backoff * 2**attempt)
+
+    def geocode_many(self, addresses, progress=None):
+        """
+        Geocode a list of addresses. Returns a dict of address to (latitude, longitude),
+        None for addresses that were not found, or the exception raised for that address.
+        progress(done, total) is called after every finished address.
+        """
+        addresses = list(dict.fromkeys(addresses))
+        if self.concurrency > 1:
+            return asyncio.run(self.geocode_many_async(addresses, progress))
+
+        results = {}
+        for address in addresses:
+            try:
+                results[address] = self.geocode(address)
+            except Exception as e:
+                results[address] = e
+            if progress:
+                progress(len(results), len(addresses))
+        return results
+
+    async def geocode_many_async(self, addresses, progress=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = {}
+
+        async def geocode_one(address):
+            async with semaphore:
+                try:
+                    results[address] = await self._geocode_async(address)
+                except Exception as e:
+                    results[address] = e
+            if progress:
+                progress(len(results), len(addresses))
+
+        await asyncio.gather(*(geocode_one(address) for address in addresses))
+        return {address: results[address] for address in addresses}
+
+    async def _geocode_async(self, address):
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire_async()
+            try:
+                return await asyncio.to_thread(self._timed_geocode, address)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+            await asyncio.sleep(self.backoff * 2**attempt)
+
+    def _should_retry(self, error, attempt):
+        if attempt == self.retries or not _is_retryable(error):
+            return False
+        get_metrics().count('geocoder.retries')
+        return True
+
+    def _timed_geocode(self, address):
+        start = time.perf_counter()
+        try:
+            return self.backend.geocode(address)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.request_count += 1
+            self.request_seconds += elapsed
+            get_metrics().observe_latency('geocoder', elapsed)
+
+
+def create_engine(backend_name=None, url=None, rate=None, concurrency=None, retries=None, backoff=1.0):
+    """
+    Create a geocoding engine from arguments or the GEOCODER_* environment variables.
+    backend_name is one of 'nominatim', 'local-nominatim', 'pelias' or 'offline'.
+    """
+    backend_name = backend_name or os.getenv('GEOCODER_BACKEND') or 'nominatim'
+    if backend_name not in DEFAULT_RATES:
+        raise ValueError(f"Unknown geocoder backend: {backend_name}")
+    url = url or os.getenv('GEOCODER_URL')
+    default_rate, default_concurrency = DEFAULT_RATES[backend_name]
+    rate = rate or float(os.getenv('GEOCODER_RATE') or default_rate)
+    concurrency = concurrency or int(os.getenv('GEOCODER_CONCURRENCY') or default_concurrency)
+    if retries is None:
+        retries = int(os.getenv('GEOCODER_RETRIES') or 2)
+
+    if backend_name == 'nominatim':
+        backend = NominatimBackend(session=create_session(concurrency))
+    elif backend_name == 'local-nominatim':
+        backend = NominatimBackend(url or 'http://localhost:8080', create_session(concurrency))
+    elif backend_name == 'pelias':
+        backend = PeliasBackend(url or 'http://localhost:4000', create_session(concurrency))
+    else:
+        backend = get_address_index()
+        if backend is None:
+            raise FileNotFoundError("No address register found for the offline geocoder.")
+    return GeocodingEngine(backend, rate=rate, concurrency=concurrency, retries=retries, backoff=backoff)
+
+
+_engine = None
+
+
+def get_engine():
+    """Get the shared geocoding engine, creating it on first use."""
+    global _engine
+    if _engine is None:
+        _engine = create_engine()
+    return _engine
@@ -0,0 +1,203 @@
+import json
+import numpy as np
+import pandas as pd
+
+# C accelerated JSON string encoder, without escaping non-ASCII characters
+encode_string = json.encoder.encode_basestring
+
+CHUNK_SIZE = 10_000
+
+
+def encode_column(values):
+    """Encode a Series as an array of JSON values, with null for missing values."""
+    missing = values.isna().to_numpy()
+    dtype = values.dtype
+
+    if pd.api.types.is_bool_dtype(dtype):
+        encoded = np.where(values.fillna(False).to_numpy(dtype=bool), 'true', 'false')
+    elif pd.api.types.is_integer_dtype(dtype):
+        encoded = values.fillna(0).to_numpy(dtype=np.int64).astype(str)
+    elif pd.api.types.is_float_dtype(dtype):
+        numbers = values.to_numpy(dtype=float, na_value=np.nan)
+        missing = missing | ~np.isfinite(numbers)
+        # Whole numbers are written without a decimal, like integers
+        whole = ~missing & (numbers == np.round(numbers)) & (np.abs(numbers) < 2**53)
+        fractional = ~missing & ~whole
+        encoded = np.empty(len(numbers), dtype=object)
+        encoded[whole] = numbers[whole].astype(np.int64).astype(str)
+        encoded[fractional] = [repr(number) for number in numbers[fractional].tolist()]
+    else:
+        try:
+            # Text columns repeat a lot, so encode each distinct value once
+            codes, uniques = pd.factorize(values)
+            encoded = np.array([_encode_value(value) for value in uniques] + ['null'], dtype=object)
+            encoded = encoded[codes]
+        except TypeError:
+            # Unhashable values like lists
+            encoded = np.array([_encode_value(value) for value in values.tolist()], dtype=object)
+
+    encoded = encoded.astype(object)
+    encoded[missing] = 'null'
+    return encoded
+
+
+def _encode_value(value):
+    if isinstance(value, str):
+        return encode_string(value)
+    if isinstance(value, (bool, np.bool_)):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        if not np.isfinite(value):
+            return 'null'
+        if float(value).is_integer() and abs(value) < 2**53:
+            return str(int(value))
+        return repr(float(value))
+    if isinstance(value, (list, tuple)):
+        # Lists are written as comma separated text, which is what Atlas can show
+        return encode_string(', '.join(map(str, value)))
+    if value is None or value is pd.NA:
+        return 'null'
+    return encode_string(str(value))
+
+
+def _format(compact):
+    """The separators and templates of the output, compact or formatted like GDAL writes GeoJSON."""
+    if compact:
+        return {
+            'feature_separator': ',',
+            'property_separator': ',',
+            'key_separator': ':',
+            'feature': '{{"type":"Feature","properties":{{{}}},"geometry":{}}}',
+            'properties_only': '{{"type":"Feature","properties":{{{}}}}}',
+            'point': '{{"type":"Point","coordinates":[{},{}]}}',
+        }
+    return {
+        'feature_separator': ',\n',
+        'property_separator': ', ',
+        'key_separator': ': ',
+        'feature': '{{ "type": "Feature", "properties": {{ {} }}, "geometry": {} }}',
+        'properties_only': '{{ "type": "Feature", "properties": {{ {} }} }}',
+        'point': '{{ "type": "Point", "coordinates": [ {}, {} ] }}',
+    }
+
+
+def _encode_points(encoded_longitudes, encoded_latitudes, point_template):
+    return [
+        'null' if 'null' in (longitude, latitude) else point_template.format(longitude, latitude)
+        for longitude, latitude in zip(encoded_longitudes, encoded_latitudes)
+    ]
+
+
+def _encode_features(df, fmt, properties=None):
+    columns = list(range(df.shape[1])) if properties is None else [df.columns.get_loc(col) for col in properties]
+    keys = [encode_string(str(df.columns[i])) + fmt['key_separator'] for i in columns]
+    encoded = [encode_column(df.iloc[:, i]) for i in columns]
+
+    def encoded_coordinates(column):
+        # The coordinates are usually properties too, and are then only encoded once
+        i = df.columns.get_loc(column)
+        return encoded[columns.index(i)] if i in columns else encode_column(df[column])
+
+    points = _encode_points(encoded_coordinates('longitude'), encoded_coordinates('latitude'), fmt['point'])
+    properties = [[key + value for value in values] for key, values in zip(keys, encoded)]
+    return [
+        fmt['feature'].format(fmt['property_separator'].join(feature_properties), point)
+        for feature_properties, point in zip(zip(*properties), points)
+    ]
+
+
+def encode_features(df, properties=None, compact=False):
+    """
+    Encode every row of df as the text of a GeoJSON Point feature, with the given columns
+    (all of them by default) as properties. Returns a list with a string per row.
+    """
+    return _encode_features(df, _format(compact), properties)
+
+
+def _iter_features(df, fmt, chunk_size=CHUNK_SIZE):
+    """Yield the features of df as text, chunk_size features at a time."""
+    for start in range(0, len(df), chunk_size):
+        features = _encode_features(df.iloc[start : start + chunk_size], fmt)
+        yield ('' if start == 0 else fmt['feature_separator']) + fmt['feature_separator'].join(features)
+
+
+def iter_feature_collection(df, compact=False, chunk_size=CHUNK_SIZE):
+    """
+    Yield a GeoJSON FeatureCollection of Point features for df as text chunks. The geometry
+    is taken from the longitude and latitude columns, and every column is a property.
+    The output only depends on the contents of df, so it is byte-for-byte reproducible.
+    """
+    if compact:
+        header, footer = '{"type":"FeatureCollection","features":[', ']}\n'
+    else:
+        header, footer = '{\n"type": "FeatureCollection",\n"features": [\n', '\n]\n}\n'
+    yield header
+    yield from _iter_features(df, _format(compact), chunk_size)
+    yield footer
+
+
+def write_feature_collection(df, path, compact=False, chunk_size=CHUNK_SIZE):
+    """Write df to path as a GeoJSON FeatureCollection of Point features, one chunk at a time."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for text in iter_feature_collection(df, compact, chunk_size):
+            f.write(text)
+
+
+def _iter_updated_features(updated, changed, unique_columns, fmt):
+    """
+    Yield a feature for every updated listing with its unique columns and only the changed
+    properties. The geometry is only included if the coordinates changed.
+    """
+    keys = [encode_string(str(col)) + fmt['key_separator'] for col in updated.columns]
+    encoded = [encode_column(updated.iloc[:, i]) for i in range(len(keys))]
+    points = _encode_points(
+        encoded[list(updated.columns).index('longitude')],
+        encoded[list(updated.columns).index('latitude')],
+        fmt['point'],
+    )
+    key_mask = updated.columns.isin(unique_columns)
+    geometry_changed = changed[['longitude', 'latitude']].any(axis=1).to_numpy()
+    for row, properties_changed in enumerate(changed.to_numpy() | key_mask):
+        properties = fmt['property_separator'].join(
+            keys[i] + encoded[i][row] for i in np.flatnonzero(properties_changed)
+        )
+        if geometry_changed[row]:
+            yield fmt['feature'].format(properties, points[row])
+        else:
+            yield fmt['properties_only'].format(properties)
+
+
+def write_change_set(change_set, path, unique_columns=['annonse-href'], compact=False):
+    """
+    Write a change set from merge.build_change_set to path as JSON, with the added listings
+    as full features, the updated listings as features with only the changed properties,
+    and the unique columns of the removed listings.
+    """
+    fmt = _format(compact)
+    newline = '' if compact else '\n'
+    separator = fmt['feature_separator']
+    removed = change_set['removed']
+    removed_keys = [encode_string(str(col)) + fmt['key_separator'] for col in removed.columns]
+    removed_values = [encode_column(removed.iloc[:, i]) for i in range(len(removed_keys))]
+    removed_entries = [
+        '{' + fmt['property_separator'].join(key + value for key, value in zip(removed_keys, values)) + '}'
+        for values in zip(*removed_values)
+    ]
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{' + newline)
+        f.write(f'"key"{fmt["key_separator"]}{json.dumps(list(unique_columns), ensure_ascii=False)},{newline}')
+        f.write(f'"added"{fmt["key_separator"]}[{newline}')
+        for text in _iter_features(change_set['added'], fmt):
+            f.write(text)
+        f.write(f'{newline}],{newline}"updated"{fmt["key_separator"]}[{newline}')
+        f.write(
+            separator.join(
+                _iter_updated_features(change_set['updated'], change_set['changed'], unique_columns, fmt)
+            )
+        )
+        f.write(f'{newline}],{newline}"removed"{fmt["key_separator"]}[{newline}')
+        f.write(separator.join(removed_entries))
+        f.write(f'{newline}]{newline}}}{newline}')
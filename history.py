@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import glob
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+from geojson_writer import encode_column, write_feature_collection
+from store import apply_schema
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+HISTORY_PATH = f'{PATH_ROOT}/files/history'
+
+PRICE_COLUMNS = ['pris', 'prisantydning', 'pris/m2', 'prisantydning/m2', 'solgt-pris']
+STATUS_COLUMNS = ['solgt']
+
+# Kinds of events: a listing was added, one of its properties changed, or it was removed
+EVENT_NEW = 'ny'
+EVENT_PRICE = 'prisendring'
+EVENT_STATUS = 'statusendring'
+EVENT_CHANGE = 'endring'
+EVENT_REMOVED = 'fjernet'
+
+EVENT_SCHEMA = pa.schema(
+    [
+        ('annonse-href', pa.string()),
+        ('tidspunkt', pa.timestamp('s')),
+        ('hendelse', pa.dictionary(pa.int8(), pa.string())),
+        ('felt', pa.dictionary(pa.int32(), pa.string())),
+        # The new value of felt as JSON
+        ('verdi', pa.string()),
+    ]
+)
+
+
+def _event_kind(column):
+    if column in PRICE_COLUMNS:
+        return EVENT_PRICE
+    if column in STATUS_COLUMNS:
+        return EVENT_STATUS
+    return EVENT_CHANGE
+
+
+def _property_events(df, mask, unique_column, kind=None, skip_missing=False):
+    """
+    Turn the properties of df where mask is set into events, one per listing and property.
+    The kind of event is derived from the property unless kind is given.
+    """
+    hrefs = df[unique_column].to_numpy()
+    frames = []
+    for i, col in enumerate(df.columns):
+        rows = mask[:, i]
+        if not rows.any():
+            continue
+        values = encode_column(df[col].iloc[np.flatnonzero(rows)])
+        keep = values != 'null' if skip_missing else np.ones(len(values), dtype=bool)
+        frames.append(
+            pd.DataFrame(
+                {
+                    'annonse-href': hrefs[rows][keep],
+                    'hendelse': kind or _event_kind(col),
+                    'felt': col,
+                    'verdi': values[keep],
+                }
+            )
+        )
+    return frames
+
+
+def change_events(change_set, unique_column='annonse-href'):
+    """
+    Turn a change set from merge.build_change_set into events: all properties of the added
+    listings, the changed properties of the updated listings, and the removed listings.
+    """
+    added = change_set['added']
+    updated = change_set['updated']
+    frames = _property_events(
+        added, np.ones(added.shape, dtype=bool), unique_column, EVENT_NEW, skip_missing=True
+    )
+    frames += _property_events(updated, change_set['changed'].to_numpy(), unique_column)
+    removed = change_set['removed']
+    frames.append(
+        pd.DataFrame(
+            {
+                'annonse-href': removed[unique_column].to_numpy(),
+                'hendelse': EVENT_REMOVED,
+                'felt': None,
+                'verdi': None,
+            }
+        )
+    )
+    events = pd.concat(frames, ignore_index=True)
+    return events[['annonse-href', 'hendelse', 'felt', 'verdi']]
+
+
+def append_events(events, timestamp=None, path=None):
+    """
+    Append events to the history as a new Parquet file, sorted by listing so reads for
+    one listing can skip most of the file. Events without a tidspunkt get timestamp, or
+    the current time. Returns the path of the file, or None if there were no events.
+    """
+    if events.empty:
+        return None
+    path = path or HISTORY_PATH
+    os.makedirs(path, exist_ok=True)
+    timestamp = pd.Timestamp(timestamp or pd.Timestamp.now()).floor('s')
+    if 'tidspunkt' in events:
+        events = events.assign(tidspunkt=events['tidspunkt'].fillna(timestamp))
+    else:
+        events = events.assign(tidspunkt=timestamp)
+    events = events.sort_values(['annonse-href', 'tidspunkt'], kind='stable')
+    table = pa.Table.from_pandas(events[EVENT_SCHEMA.names], schema=EVENT_SCHEMA, preserve_index=False)
+    part = len(glob.glob(f'{path}/*.parquet'))
+    file_path = f"{path}/events-{part:06d}-{timestamp.strftime('%Y%m%dT%H%M%S')}.parquet"
+    pq.write_table(table, file_path, compression='zstd')
+    return file_path
+
+
+def record_changes(existing_df, change_set, timestamp=None, path=None, unique_column='annonse-href'):
+    """
+    Record a merge change set in the history. The first time, the listings of the existing
+    dataset are recorded as well, as added at their first-seen time.
+    """
+    path = path or HISTORY_PATH
+    if not glob.glob(f'{path}/*.parquet') and existing_df is not None and not existing_df.empty:
+        existing_df = existing_df.drop_duplicates(subset=[unique_column], keep='last')
+        empty = existing_df.iloc[:0]
+        events = change_events(
+            {'added': existing_df, 'updated': empty, 'changed': empty, 'removed': empty[[unique_column]]},
+            unique_column,
+        )
+        if 'first-seen' in existing_df:
+            first_seen = pd.to_datetime(existing_df['first-seen'], errors='coerce')
+            events['tidspunkt'] = events[unique_column].map(
+                pd.Series(first_seen.to_numpy(), index=existing_df[unique_column])
+            )
+        append_events(events, timestamp, path)
+        print(f"Started the listing history with {len(existing_df)} listings.")
+
+    events = change_events(change_set, unique_column)
+    append_events(events, timestamp, path)
+    print(f"Recorded {len(events)} events in the listing history.")
+    return events
+
+
+def read_events(until=None, hrefs=None, path=None):
+    """Read the events up to and including the time until, optionally only for the listings hrefs."""
+    path = path or HISTORY_PATH
+    if not glob.glob(f'{path}/*.parquet'):
+        return pd.DataFrame(columns=EVENT_SCHEMA.names)
+    filters = []
+    if until is not None:
+        filters.append(('tidspunkt', '<=', pd.Timestamp(until).to_pydatetime()))
+    if hrefs is not None:
+        filters.append(('annonse-href', 'in', list(hrefs)))
+    table = pq.read_table(path, filters=filters or None, schema=EVENT_SCHEMA)
+    events = table.to_pandas()
+    events['hendelse'] = events['hendelse'].astype(object)
+    events['felt'] = events['felt'].astype(object)
+    return events.sort_values('tidspunkt', kind='stable', ignore_index=True)
+
+
+def dataset_as_of(when, path=None, unique_column='annonse-href'):
+    """Rebuild the dataset as it was at the time when by replaying the history up to it."""
+    events = read_events(until=when, path=path)
+    if events.empty:
+        return pd.DataFrame()
+
+    # Forget everything before the last time a listing was removed
+    removed_at = events[events['hendelse'] == EVENT_REMOVED].groupby('annonse-href')['tidspunkt'].max()
+    cutoff = events['annonse-href'].map(removed_at)
+    events = events[cutoff.isna() | (events['tidspunkt'] > cutoff)]
+    events = events[events['hendelse'] != EVENT_REMOVED]
+
+    columns = list(pd.unique(events['felt']))
+    latest = events.drop_duplicates(subset=['annonse-href', 'felt'], keep='last')
+    codes, uniques = pd.factorize(latest['verdi'])
+    decoded = np.array([json.loads(value) for value in uniques] + [None], dtype=object)
+    latest = latest.assign(verdi=decoded[codes])
+
+    df = latest.pivot(index='annonse-href', columns='felt', values='verdi').reindex(columns=columns)
+    df = df.reset_index(drop=unique_column in columns).infer_objects()
+    return apply_schema(df)
+
+
+def listing_history(href, path=None):
+    """Get the events of one listing, oldest first."""
+    return read_events(hrefs=[href], path=path)
+
+
+if __name__ == '__main__':
+    # python history.py as-of <date> [output path without extension]
+    # python history.py listing <annonse-href>
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'as-of':
+        df = dataset_as_of(sys.argv[2])
+        output_path = sys.argv[3] if len(sys.argv) > 3 else f'{PATH_ROOT}/files/as_of_{sys.argv[2]}'
+        df.to_csv(output_path + '.csv', index=False)
+        write_feature_collection(df, output_path + '.geojson')
+        print(f"Saved {len(df)} listings as of {sys.argv[2]} to {output_path}.csv and .geojson.")
+    elif command == 'listing':
+        print(listing_history(sys.argv[2]).to_string(index=False))
+    else:
+        print("Usage: python history.py as-of <date> [output path] | listing <annonse-href>")
@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+import datetime
+from dotenv import load_dotenv
+
+from metrics import get_metrics
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+MANIFEST_PATH = f'{PATH_ROOT}/files/build_manifest.json'
+
+
+def _normalize(params):
+    """Round trip params through JSON, so they compare equal to the recorded ones."""
+    return json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+
+
+class BuildManifest:
+    """
+    The content hashes of the inputs and outputs of each pipeline stage, and the parameters
+    it ran with, from the last time it ran. Like make, but on content: a stage only has to
+    run again when an input or parameter changed, or an output was changed or deleted
+    since. Copying or touching a file does not count as a change.
+
+    Hashes are cached by path, size and modification time, so unchanged files are not
+    read again.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or MANIFEST_PATH
+        self.files = {}
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.files = manifest.get('files', {})
+            self.stages = manifest.get('stages', {})
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'files': self.files, 'stages': self.stages}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def file_hash(self, path):
+        """Get the sha256 of a file, or None if it does not exist."""
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.files.get(key)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+        with open(path, 'rb') as f:
+            sha256 = hashlib.file_digest(f, 'sha256').hexdigest()
+        self.files[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+        return sha256
+
+    def _hashes(self, paths):
+        return {os.path.abspath(path): self.file_hash(path) for path in paths}
+
+    def is_current(self, stage, inputs=(), params=None, outputs=()):
+        """Check if stage ran with the same inputs and params before, and its outputs are unchanged."""
+        record = self.stages.get(stage)
+        current = (
+            record is not None
+            and record['params'] == _normalize(params)
+            and record['inputs'] == self._hashes(inputs)
+            and record['outputs'] == self._hashes(outputs)
+            and None not in record['outputs'].values()
+        )
+        get_metrics().count('build_manifest.hits' if current else 'build_manifest.misses')
+        return current
+
+    def record(self, stage, inputs=(), params=None, outputs=()):
+        """Record that stage ran with inputs and params, producing outputs."""
+        self.stages[stage] = {
+            'inputs': self._hashes(inputs),
+            'params': _normalize(params),
+            'outputs': self._hashes(outputs),
+            'finished': datetime.datetime.now().isoformat(),
+        }
+        self.save()
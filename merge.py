@@ -1,97 +1,291 @@
+import os
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 from clean_data import geocode_data, NUMERIC_COLUMNS
+from delta import HASH_COLUMN, VOLATILE_COLUMNS
+from geojson_writer import write_feature_collection, write_change_set
+from postcodes import add_postcodes
+from rollups import update_price_rollups
+from query import update_listing_index
+from history import record_changes
+from metrics import get_metrics
 
 import time
 
 
-def merge_dataframes(
-    existing_dataframe,
-    new_dataframe,
-    merged_file_path='./files/merged_finn_eiendom',
-    unique_columns=['annonse-href'],
-):
+# Columns set by the user in Atlas, or when we first saw the listing, that a new
+# scrape must never overwrite
+PRESERVED_COLUMNS = ['first-seen', 'pin', 'gjem']
+
+# Columns the merge fills in for listings that do not have them yet. Filling them in
+# is not a change of the listing, so they are left out of the change set.
+BACKFILLED_COLUMNS = ['first-seen']
+
+LISTING_STATUSES = ['new', 'updated', 'unchanged', 'disappeared']
+
+
+def _prepare_for_merge(df):
     """
-    Processes, merges two DataFrames, ensures all attributes are retained in case of duplicates,
-    prints rows missing in the new DataFrame, and saves new entries to a separate file.
+    Drop export artifacts, make sure numeric columns are Int64 and turn categoricals into
+    plain values, without copying the other columns.
+    """
+    drop_columns = [
+        col
+        for col in df.columns
+        if col in ('__area', '__length')
+        or (col.split('.')[0] in ('longitude', 'latitude') and col.split('.')[-1].isdigit())
+    ]
+    df = df.drop(columns=drop_columns)
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns and df[col].dtype.name != 'Int64':
+            df[col] = pd.to_numeric(df[col], errors='coerce').round(0).astype('Int64')
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    return df
 
-    Parameters:
-    - existing_file_path: Path to the existing processed CSV file.
-    - new_file_path: Path to the new CSV file to process.
-    - unique_columns: List of column names to use for identifying duplicates.
 
-    Returns:
-    - merged_df: The merged DataFrame with updated entries.
+def _key_index(df, unique_columns):
+    if len(unique_columns) == 1:
+        return pd.Index(df[unique_columns[0]])
+    return pd.MultiIndex.from_frame(df[unique_columns])
+
+
+def _take(values, positions):
+    """Take values by position, with missing values where the position is -1."""
+    return pd.Series(values.array.take(positions, allow_fill=True), name=values.name)
+
+
+def _unchanged_values(existing, new):
     """
+    Compare two aligned Series element-wise. A value is unchanged if the new value is
+    missing, since missing values never overwrite existing ones, or equal to the existing one.
+    """
+    existing_values = existing.astype(object).where(existing.notna(), None).to_numpy()
+    new_values = new.astype(object).where(new.notna(), None).to_numpy()
+    return new.isna().to_numpy() | (existing_values == new_values)
 
-    new_df = new_dataframe.copy()
 
-    existing_df = existing_dataframe.copy()
+def _same_values(existing, new):
+    """Compare two aligned Series element-wise, with missing values equal to each other."""
+    existing_missing = existing.isna().to_numpy()
+    new_missing = new.isna().to_numpy()
+    existing_values = existing.astype(object).where(~existing_missing, None).to_numpy()
+    new_values = new.astype(object).where(~new_missing, None).to_numpy()
+    return (existing_missing & new_missing) | (existing_values == new_values)
 
-    # TODO: do I need this?
-    # go through the columns in NUMERIC_COLUMNS and ensure they are ints in both DataFrames if they exist
-    for col in NUMERIC_COLUMNS:
-        if col in existing_df.columns:
-            existing_df[col] = (
-                existing_df[col].apply(pd.to_numeric, errors='coerce').round(0).astype('Int64')
-            )
-        if col in new_df.columns:
-            new_df[col] = new_df[col].apply(pd.to_numeric, errors='coerce').round(0).astype('Int64')
 
-    # remove the columns __area and __length from existing_df if they exist
-    if '__area' in existing_df.columns:
-        existing_df.drop(columns=['__area', '__length'], inplace=True)
+def _upsert_rows(existing_values, new_values, rows, new_rows, prefer_existing=False):
+    """
+    Combine the values of the existing rows at positions rows with new_values at positions
+    new_rows. Missing values are filled from the other side, otherwise the new value wins
+    unless prefer_existing is set.
+    """
+    if not len(rows):
+        return existing_values
+    dtype = pd.concat([existing_values.iloc[:0], new_values.iloc[:0]]).dtype
+    existing_part = existing_values.iloc[rows].reset_index(drop=True).astype(dtype)
+    new_part = new_values.iloc[new_rows].reset_index(drop=True).astype(dtype)
+    if prefer_existing:
+        combined = existing_part.combine_first(new_part)
+    else:
+        combined = new_part.combine_first(existing_part)
 
-    if existing_df.empty:
-        new_df.to_csv(merged_file_path + '.csv', index=False)
-        # save the merged DataFrame as geojson
-        new_df = preprocess_gdf_for_geojson(new_df)
-        gdf = gpd.GeoDataFrame(
-            new_df, geometry=gpd.points_from_xy(new_df.longitude, new_df.latitude)
-        )
-        gdf.to_file(merged_file_path + ".geojson", driver='GeoJSON')
-        print(f"Updated dataset saved to {merged_file_path}.csv and .geojson.")
-        return new_df
+    values = existing_values.astype(dtype, copy=True)
+    values.iloc[rows] = combined.astype(dtype).to_numpy()
+    return values
 
-    if new_df.empty:
-        existing_df.to_csv(merged_file_path + '.csv', index=False)
-        # save the merged DataFrame as geojson
-        existing_df = preprocess_gdf_for_geojson(existing_df)
-        gdf = gpd.GeoDataFrame(
-            existing_df, geometry=gpd.points_from_xy(existing_df.longitude, existing_df.latitude)
-        )
-        gdf.to_file(merged_file_path + ".geojson", driver='GeoJSON')
-        print(f"Updated dataset saved to {merged_file_path}.csv and .geojson.")
-        return existing_df
 
-    # Set index to unique_columns for both DataFrames to use combine_first or merge properly
-    existing_df.set_index(unique_columns, inplace=True)
-    new_df.set_index(unique_columns, inplace=True)
+def upsert_listings(existing_df, new_df, unique_columns=['annonse-href']):
+    """
+    Upsert freshly scraped listings into the existing dataset in one pass over the columns.
 
-    # Identify old unique entries not in new DataFrame
-    old_unique = existing_df[~existing_df.index.isin(new_df.index)].copy()
-    old_unique['solgt'] = True
+    Listings in both are updated with the new values, except for PRESERVED_COLUMNS, which
+    keep their existing value. Listings only in the existing dataset are marked as sold.
 
-    merged_df = existing_df.combine_first(new_df)
+    Parameters:
+    - existing_df: The existing dataset.
+    - new_df: The freshly scraped and processed listings.
+    - unique_columns: List of column names identifying a listing.
 
-    # Update the merged_df with the modified old_unique entries
-    merged_df.update(old_unique)
+    Returns:
+    - merged_df: The existing listings, followed by the new ones.
+    - status: Series aligned with merged_df classifying each listing as 'new', 'updated',
+      'unchanged' or 'disappeared'. Listings that were already sold and are still
+      missing from the scrape count as unchanged.
+    """
+    existing_df = _prepare_for_merge(existing_df)
+    new_df = _prepare_for_merge(new_df)
+    scrape_is_empty = new_df.empty
+    if existing_df.empty:
+        existing_df = new_df.iloc[:0]
+    if new_df.empty:
+        new_df = existing_df.iloc[:0]
+
+    existing_keys = _key_index(existing_df, unique_columns)
+    new_keys = _key_index(new_df, unique_columns)
+    if existing_keys.has_duplicates:
+        existing_df = existing_df[~existing_keys.duplicated(keep='last')]
+        existing_keys = _key_index(existing_df, unique_columns)
+    if new_keys.has_duplicates:
+        new_df = new_df[~new_keys.duplicated(keep='last')]
+        new_keys = _key_index(new_df, unique_columns)
+
+    # Position of each existing listing in new_df (-1 if it disappeared), and the positions
+    # of the listings that are not in the existing dataset
+    new_positions = new_keys.get_indexer(existing_keys)
+    matched = new_positions >= 0
+    added_positions = np.flatnonzero(existing_keys.get_indexer(new_keys) < 0)
+
+    # Classify the existing listings. Unchanged listings are kept as they are, so only
+    # the updated ones need their values combined with the new scrape.
+    if HASH_COLUMN in existing_df and HASH_COLUMN in new_df:
+        compare_columns = [HASH_COLUMN]
+    else:
+        compare_columns = [
+            col
+            for col in existing_df.columns
+            if col in new_df and col not in PRESERVED_COLUMNS + VOLATILE_COLUMNS + ['solgt']
+        ]
+    existing_solgt = (
+        existing_df['solgt'].astype('boolean').fillna(False).to_numpy(dtype=bool)
+        if 'solgt' in existing_df
+        else np.zeros(len(existing_df), dtype=bool)
+    )
+    # Listings that were sold and show up in the scrape again are updated as well
+    unchanged = matched & ~existing_solgt
+    for col in compare_columns:
+        unchanged[matched] &= _unchanged_values(
+            existing_df[col].iloc[matched], new_df[col].iloc[new_positions[matched]]
+        )
+    updated_rows = np.flatnonzero(matched & ~unchanged)
+    disappeared = ~matched & ~existing_solgt & (not scrape_is_empty)
+
+    columns = list(existing_df.columns) + [col for col in new_df.columns if col not in existing_df]
+    merged = {}
+    for col in columns:
+        if col not in new_df:
+            merged[col] = existing_df[col].reset_index(drop=True)
+            continue
+        new_values = new_df[col].reset_index(drop=True)
+        if col not in existing_df:
+            head = _take(new_values, new_positions)
+        else:
+            head = _upsert_rows(
+                existing_df[col].reset_index(drop=True),
+                new_values,
+                updated_rows,
+                new_positions[updated_rows],
+                prefer_existing=col in PRESERVED_COLUMNS,
+            )
+        tail = _take(new_values, added_positions)
+        merged[col] = pd.concat([head, tail], ignore_index=True) if len(tail) else head
+
+    merged_df = pd.DataFrame(merged, columns=columns)
 
-    merged_df.reset_index(inplace=True)
-    merged_df.drop_duplicates(subset=unique_columns, keep='last', inplace=True)
+    status = np.where(matched & ~unchanged, 'updated', 'unchanged').astype(object)
+    status[disappeared] = 'disappeared'
+    status = np.concatenate([status, np.full(len(added_positions), 'new', dtype=object)])
 
+    # Listings in the scrape are for sale, the ones missing from it are sold
+    solgt = (
+        merged_df['solgt'].astype('boolean').fillna(False).to_numpy(dtype=bool)
+        if 'solgt' in merged_df
+        else np.zeros(len(merged_df), dtype=bool)
+    )
+    if not scrape_is_empty:
+        solgt[: len(existing_df)] = ~matched
+    merged_df['solgt'] = solgt
+
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
     if 'first-seen' not in merged_df.columns:
-        merged_df['first-seen'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        merged_df['first-seen'] = now
     else:
-        merged_df['first-seen'] = merged_df['first-seen'].fillna(time.strftime("%Y-%m-%d %H:%M:%S"))
+        merged_df['first-seen'] = merged_df['first-seen'].fillna(now)
+
+    return merged_df, pd.Series(status, index=merged_df.index, name='status')
+
+
+def build_change_set(existing_df, merged_df, unique_columns=['annonse-href']):
+    """
+    Find what changed between the existing dataset and the merged one, so only the
+    changes have to be uploaded.
+
+    Returns a dict with:
+    - added: Rows of merged_df for listings that are not in existing_df.
+    - updated: Rows of merged_df for listings with at least one changed property.
+    - changed: Boolean DataFrame aligned with updated, marking the changed properties.
+      BACKFILLED_COLUMNS are never marked as changed.
+    - removed: The unique columns of the listings in existing_df that are not in merged_df.
+    """
+    existing_df = _prepare_for_merge(existing_df)
+    merged_df = merged_df.reset_index(drop=True)
+    if existing_df.empty:
+        existing_df = merged_df.iloc[:0]
+    existing_keys = _key_index(existing_df, unique_columns)
+    if existing_keys.has_duplicates:
+        existing_df = existing_df[~existing_keys.duplicated(keep='last')]
+        existing_keys = _key_index(existing_df, unique_columns)
+    merged_keys = _key_index(merged_df, unique_columns)
+
+    positions = existing_keys.get_indexer(merged_keys)
+    matched = np.flatnonzero(positions >= 0)
+    changed = {}
+    for col in merged_df.columns:
+        new_values = merged_df[col].iloc[matched].reset_index(drop=True)
+        if col in BACKFILLED_COLUMNS:
+            changed[col] = np.zeros(len(matched), dtype=bool)
+        elif col in existing_df:
+            existing_values = _take(existing_df[col].reset_index(drop=True), positions[matched])
+            changed[col] = ~_same_values(existing_values, new_values)
+        else:
+            changed[col] = new_values.notna().to_numpy()
+    changed = pd.DataFrame(changed, columns=merged_df.columns)
+    updated_rows = changed.any(axis=1).to_numpy()
+
+    return {
+        'added': merged_df[positions < 0],
+        'updated': merged_df.iloc[matched[updated_rows]],
+        'changed': changed[updated_rows].reset_index(drop=True),
+        'removed': existing_df.loc[merged_keys.get_indexer(existing_keys) < 0, unique_columns],
+    }
+
+
+def merge_dataframes(
+    existing_dataframe,
+    new_dataframe,
+    merged_file_path='./files/merged_finn_eiendom',
+    unique_columns=['annonse-href'],
+    published_dataframe=None,
+):
+    """
+    Upserts the new DataFrame into the existing one, marks listings missing from the new
+    DataFrame as sold, and saves the result as CSV and GeoJSON. Entries without
+    coordinates are saved to a separate file, and the changes compared to the existing
+    dataset to merged_file_path + '_changes.json'. The changes are recorded in the listing
+    history, and the price rollups and the listing index are updated with them.
 
-    merged_df = merged_df.drop_duplicates(subset=unique_columns)
+    Parameters:
+    - existing_dataframe: The existing dataset.
+    - new_dataframe: The freshly scraped and processed listings.
+    - merged_file_path: Path to save the merged data to, without file extension.
+    - unique_columns: List of column names to use for identifying duplicates.
+    - published_dataframe: The dataset currently in Atlas, which the change set is
+      computed against. Defaults to existing_dataframe.
 
-    # TODO: remove this if we do not geocode
-    # from 1 to 10 delete columns named longitude.x and latitude.x if they exist
-    for i in range(1, 11):
-        if f'longitude.{i}' in merged_df.columns:
-            merged_df.drop(columns=[f'longitude.{i}', f'latitude.{i}'], inplace=True)
+    Returns:
+    - merged_df: The merged DataFrame with updated entries.
+    """
+    merged_df, status = upsert_listings(existing_dataframe, new_dataframe, unique_columns)
+    counts = status.value_counts()
+    print(
+        "Merged listings: "
+        + ", ".join(f"{counts.get(name, 0)} {name}" for name in LISTING_STATUSES)
+        + "."
+    )
+    metrics = get_metrics()
+    for name in LISTING_STATUSES:
+        metrics.count(f'listings.{name}', int(counts.get(name, 0)))
 
     # split out entries without coordinates
     no_coords = merged_df[merged_df['longitude'].isnull()]
@@ -100,54 +294,41 @@ def merge_dataframes(
         no_coords.to_csv(merged_file_path + '_no_coords.csv', index=False)
 
     merged_df = merged_df.dropna(subset=['longitude', 'latitude'])
+    # Listings carried over from the existing dataset may not have postal codes yet
+    merged_df = add_postcodes(merged_df.copy())
+
+    with metrics.stage('export'):
+        merged_df.to_csv(merged_file_path + '.csv', index=False)
 
-    merged_df.to_csv(merged_file_path + '.csv', index=False)
+        write_feature_collection(merged_df, merged_file_path + '.geojson')
 
-    preprocessed_df = preprocess_gdf_for_geojson(merged_df)
-    gdf = gpd.GeoDataFrame(
-        preprocessed_df,
-        geometry=gpd.points_from_xy(preprocessed_df.longitude, preprocessed_df.latitude),
+    # The history and rollups follow the existing dataset, the upload follows what is in Atlas
+    dataset_changes = build_change_set(existing_dataframe, merged_df, unique_columns)
+    if published_dataframe is None:
+        change_set = dataset_changes
+    else:
+        change_set = build_change_set(published_dataframe, merged_df, unique_columns)
+    write_change_set(change_set, merged_file_path + '_changes.json', unique_columns)
+    print(
+        f"Changes: {len(change_set['added'])} added, {len(change_set['updated'])} updated, "
+        f"{len(change_set['removed'])} removed."
     )
-    gdf.to_file(merged_file_path + ".geojson", driver='GeoJSON')
+    for name in ('added', 'updated', 'removed'):
+        metrics.count(f'changes.{name}', len(change_set[name]))
+    output_dir = os.path.dirname(merged_file_path)
+    with metrics.stage('history'):
+        record_changes(existing_dataframe, dataset_changes, path=os.path.join(output_dir, 'history'))
+    with metrics.stage('rollups'):
+        update_price_rollups(merged_df, dataset_changes, os.path.join(output_dir, 'price_rollups'))
+    with metrics.stage('listing_index'):
+        update_listing_index(merged_df, dataset_changes, os.path.join(output_dir, 'listing_index.pkl'))
 
     print(f"Updated dataset saved to {merged_file_path}.csv and .geojson.")
 
     return merged_df
 
 
-def df_to_geojson(df, output_path):
+def df_to_geojson(df, output_path, compact=False):
     """Convert a DataFrame with longitude/latitude columns to GeoJSON."""
-    preprocessed_df = preprocess_gdf_for_geojson(df.copy())
-    # Convert nullable dtypes to standard numpy dtypes for GeoJSON compatibility
-    for col in preprocessed_df.columns:
-        if preprocessed_df[col].dtype.name in ('Int64', 'Float64', 'boolean'):
-            preprocessed_df[col] = preprocessed_df[col].astype(object).where(preprocessed_df[col].notna(), None)
-    gdf = gpd.GeoDataFrame(
-        preprocessed_df,
-        geometry=gpd.points_from_xy(preprocessed_df.longitude, preprocessed_df.latitude),
-    )
-    gdf.to_file(output_path + ".geojson", driver='GeoJSON')
+    write_feature_collection(df, output_path + '.geojson', compact=compact)
     print(f"Saved to {output_path}.geojson")
-
-
-def preprocess_gdf_for_geojson(gdf):
-    """
-    Preprocess a GeoDataFrame to ensure it can be saved to GeoJSON format by converting
-    lists to strings and handling other necessary data transformations.
-
-    Parameters:
-    - gdf: The GeoDataFrame to preprocess.
-
-    Returns:
-    - gdf: The preprocessed GeoDataFrame.
-    """
-    print("Preprocessing GeoDataFrame for GeoJSON export...")
-    for column in gdf.columns:
-        # Check if any element in the column is a list
-        if any(isinstance(x, list) for x in gdf[column]):
-            print(f"Column '{column}' contains lists. Converting to strings.")
-            gdf[column] = gdf[column].apply(
-                lambda x: ', '.join(map(str, x)) if isinstance(x, list) else x
-            )
-
-    return gdf
@@ -0,0 +1,190 @@
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import bisect
+import datetime
+import statistics
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+REPORT_PATH = f'{PATH_ROOT}/files/run_reports'
+
+# Upper bounds in seconds of the buckets of the HTTP latency histograms
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+def _peak_rss_mb():
+    """The peak resident memory of the process so far. ru_maxrss is in bytes on macOS, KB elsewhere."""
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def _rss_mb():
+    """The current resident memory of the process, from /proc. NaN where there is no /proc."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+class RunMetrics:
+    """
+    Timings and counters of one run of the pipeline: the wall time, rows in and out and
+    memory of each stage, counters such as cache hits, and the latency of the HTTP
+    requests by service. With profile_path, every top level stage is also run under
+    cProfile and tracemalloc, and their results are written to profile_path.
+
+    The memory of a stage is rss_growth_mb, how much the resident memory of the process
+    grew during it, and with profiling peak_traced_mb, the peak of the memory allocated
+    by Python during the stage. process_peak_rss_mb is the peak of the whole process so
+    far, which stays the same after the heaviest stage.
+    """
+
+    def __init__(self, profile_path=None):
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self.counters = {}
+        self.latencies = {}
+        self.profile_path = profile_path
+        self._active = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Time the code in the with block as a stage. Set 'rows_out', or any other value, on
+        the yielded dict to add it to the stage in the report.
+        """
+        path = '/'.join([*self._active, name])
+        record = {'stage': path, 'rows_in': rows_in}
+        profiler = None
+        if self.profile_path and not self._active:
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            profiler.enable()
+        self._active.append(name)
+        self.stages.append(record)
+        rss_start = _rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 3)
+            self._active.pop()
+            record['rss_growth_mb'] = round(_rss_mb() - rss_start, 1)
+            record['process_peak_rss_mb'] = round(_peak_rss_mb(), 1)
+            if profiler is not None:
+                profiler.disable()
+                record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+                self._write_profile(name, profiler, tracemalloc.take_snapshot())
+                tracemalloc.stop()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_latency(self, service, seconds):
+        """Record the latency of an HTTP request to service."""
+        with self._lock:
+            self.latencies.setdefault(service, []).append(seconds)
+
+    def _latency_summary(self, latencies):
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in latencies:
+            counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        percentiles = statistics.quantiles(latencies, n=20, method='inclusive') if len(latencies) > 1 else latencies * 19
+        return {
+            'count': len(latencies),
+            'p50': round(percentiles[9], 4),
+            'p95': round(percentiles[18], 4),
+            'max': round(max(latencies), 4),
+            'histogram': {
+                **{f'<={bound}': count for bound, count in zip(LATENCY_BUCKETS, counts)},
+                f'>{LATENCY_BUCKETS[-1]}': counts[-1],
+            },
+        }
+
+    def _hit_rates(self):
+        """The hit rate of every cache with '<name>.hits' and '<name>.misses' counters."""
+        rates = {}
+        for name, hits in self.counters.items():
+            if name.endswith('.hits'):
+                cache = name.removesuffix('.hits')
+                total = hits + self.counters.get(f'{cache}.misses', 0)
+                rates[cache] = round(hits / total, 3) if total else None
+        return rates
+
+    def report(self):
+        return {
+            'started': self.started.isoformat(),
+            'seconds': round((datetime.datetime.now() - self.started).total_seconds(), 3),
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+            'stages': self.stages,
+            'counters': self.counters,
+            'cache_hit_rates': self._hit_rates(),
+            'http_latency': {
+                service: self._latency_summary(latencies) for service, latencies in self.latencies.items()
+            },
+        }
+
+    def write_report(self, path=None):
+        """Save the report as JSON and print the time spent in each stage. Returns the path."""
+        path = path or f"{REPORT_PATH}/run_{self.started.strftime('%Y%m%dT%H%M%S')}.json"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+        for stage in report['stages']:
+            rows = ''
+            if stage['rows_in'] is not None or stage.get('rows_out') is not None:
+                rows = f"  {stage['rows_in']} -> {stage.get('rows_out')} rows"
+            print(f"{stage['stage']:<30} {stage['seconds']:8.2f} s{rows}")
+        print(f"Saved the run report to {path}.")
+        return path
+
+    def _write_profile(self, name, profiler, snapshot):
+        os.makedirs(self.profile_path, exist_ok=True)
+        profiler.dump_stats(f'{self.profile_path}/{name}.prof')
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+        summary.write('\nLargest allocations still held at the end of the stage:\n')
+        for statistic in snapshot.statistics('lineno')[:25]:
+            summary.write(f'{statistic}\n')
+        with open(f'{self.profile_path}/{name}.txt', 'w') as f:
+            f.write(summary.getvalue())
+
+
+_metrics = RunMetrics()
+
+
+def get_metrics():
+    """Get the metrics of the current run."""
+    return _metrics
+
+
+def start_run(profile=False):
+    """Start collecting the metrics of a new run, profiling the stages if profile is set."""
+    global _metrics
+    started = datetime.datetime.now()
+    profile_path = f"{REPORT_PATH}/profile_{started.strftime('%Y%m%dT%H%M%S')}" if profile else None
+    _metrics = RunMetrics(profile_path)
+    return _metrics
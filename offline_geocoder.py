@@ -0,0 +1,168 @@
+import os
+import glob
+import json
+import difflib
+import pandas as pd
+from dotenv import load_dotenv
+
+from address import parse_address, street_key
+from projection import epsg_zone, utm_to_wgs84
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+
+# Street names at least this similar are considered spelling variants of each other
+FUZZY_CUTOFF = 0.85
+
+
+class AddressIndex:
+    """
+    In-memory address point index keyed on normalized street, house number and postcode.
+    Can be used as a backend for the geocoding engine.
+    """
+
+    def __init__(self, streets, numbers, postcodes, latitudes, longitudes):
+        self.exact = {}
+        self.by_street_number = {}
+        self.streets_by_postcode = {}
+        for street, number, postcode, latitude, longitude in zip(
+            streets, numbers, postcodes, latitudes, longitudes
+        ):
+            location = (float(latitude), float(longitude))
+            self.exact[(street, number, postcode)] = location
+            self.by_street_number.setdefault((street, number), location)
+            self.streets_by_postcode.setdefault(postcode, set()).add(street)
+        self.all_streets = sorted(set().union(*self.streets_by_postcode.values()))
+        self.streets_by_postcode = {
+            postcode: sorted(streets) for postcode, streets in self.streets_by_postcode.items()
+        }
+        self._fuzzy_matches = {}
+
+    def __len__(self):
+        return len(self.exact)
+
+    def geocode(self, address):
+        """Look up an address. Returns (latitude, longitude), or None if it is not in the index."""
+        parsed = parse_address(address)
+        if parsed is None:
+            return None
+        street, number, postcode = parsed
+
+        location = self._lookup(street, number, postcode)
+        if location is None:
+            fuzzy_street = self._fuzzy_street(street, postcode)
+            if fuzzy_street is not None:
+                location = self._lookup(fuzzy_street, number, postcode)
+        return location
+
+    def geocode_many(self, addresses):
+        return {address: self.geocode(address) for address in dict.fromkeys(addresses)}
+
+    def _lookup(self, street, number, postcode):
+        house_number = number.rstrip('abcdefghijklmnopqrstuvwxyzæøå')
+        return (
+            self.exact.get((street, number, postcode))
+            or self.exact.get((street, house_number, postcode))
+            # Postcodes in ads are sometimes wrong, so fall back to the street and number
+            or self.by_street_number.get((street, number))
+        )
+
+    def _fuzzy_street(self, street, postcode):
+        key = (street, postcode)
+        if key not in self._fuzzy_matches:
+            candidates = self.streets_by_postcode.get(postcode) or self.all_streets
+            matches = difflib.get_close_matches(street, candidates, n=1, cutoff=FUZZY_CUTOFF)
+            self._fuzzy_matches[key] = matches[0] if matches else None
+        return self._fuzzy_matches[key]
+
+
+def _index_from_dataframe(df, zone=None):
+    """
+    Build an index from a DataFrame with Kartverket column names: adressenavn, nummer,
+    bokstav, postnummer, and either Nord/Øst in UTM or latitude/longitude.
+    """
+    df = df.dropna(subset=['adressenavn', 'nummer', 'postnummer'])
+    if 'latitude' in df.columns and 'longitude' in df.columns:
+        latitudes, longitudes = df['latitude'].astype(float), df['longitude'].astype(float)
+    else:
+        if zone is None:
+            zone = epsg_zone(df['EPSG-kode'].iloc[0]) if 'EPSG-kode' in df.columns else 32
+        latitudes, longitudes = utm_to_wgs84(df['Øst'].astype(float), df['Nord'].astype(float), zone)
+
+    letters = df['bokstav'].fillna('') if 'bokstav' in df.columns else ''
+    numbers = df['nummer'].astype(str).str.split('.').str[0].str.lstrip('0') + letters
+    return AddressIndex(
+        df['adressenavn'].map(street_key),
+        numbers.str.casefold(),
+        df['postnummer'].astype(str).str.split('.').str[0].str.zfill(4),
+        latitudes,
+        longitudes,
+    )
+
+
+def _geojson_features(data):
+    """Yield (features, crs) for a FeatureCollection, or for every FeatureCollection nested one level down."""
+    if data.get('type') == 'FeatureCollection':
+        yield data['features'], data.get('crs')
+        return
+    for value in data.values():
+        if isinstance(value, dict) and value.get('type') == 'FeatureCollection':
+            yield value['features'], value.get('crs')
+
+
+def load_address_index(path):
+    """Load an address register CSV (semicolon or comma separated) or GeoJSON file into an AddressIndex."""
+    print(f"Loading address register {path}...")
+    if path.endswith('.geojson') or path.endswith('.json'):
+        with open(path) as f:
+            data = json.load(f)
+        frames = []
+        for features, crs in _geojson_features(data):
+            rows = []
+            for feature in features:
+                properties = dict(feature.get('properties') or {})
+                coordinates = (feature.get('geometry') or {}).get('coordinates') or [None, None]
+                properties['Øst'], properties['Nord'] = coordinates[:2]
+                rows.append(properties)
+            df = pd.DataFrame(rows, dtype=object)
+            if crs:
+                df['EPSG-kode'] = crs['properties']['name']
+            else:
+                df = df.rename(columns={'Øst': 'longitude', 'Nord': 'latitude'})
+            frames.append(_index_from_dataframe(df))
+        if len(frames) != 1:
+            raise ValueError(f"Expected one address layer in {path}, found {len(frames)}")
+        index = frames[0]
+    else:
+        with open(path, encoding='utf-8-sig') as f:
+            separator = ';' if ';' in f.readline() else ','
+        df = pd.read_csv(path, sep=separator, dtype=str, encoding='utf-8-sig')
+        index = _index_from_dataframe(df)
+    print(f"Loaded {len(index)} addresses.")
+    return index
+
+
+def find_address_register(root=None):
+    """Find the address register file, from ADDRESS_REGISTER_PATH or next to the postcode file."""
+    if os.getenv('ADDRESS_REGISTER_PATH'):
+        return os.getenv('ADDRESS_REGISTER_PATH')
+    root = root or PATH_ROOT
+    candidates = sorted(
+        glob.glob(f'{root}/Basisdata_*Adresse*.csv') + glob.glob(f'{root}/Basisdata_*Adresse*.geojson')
+    )
+    return candidates[0] if candidates else None
+
+
+_index = None
+
+
+def get_address_index():
+    """Get the shared address index, or None if there is no address register file."""
+    global _index
+    if _index is None:
+        path = find_address_register()
+        if path is None or not os.path.exists(path):
+            return None
+        _index = load_address_index(path)
+    return _index
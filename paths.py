@@ -0,0 +1,11 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+
+# Paths shared by automatic_upload.py and the modules it imports lazily. They are kept
+# here, away from pandas, so the CLI can use them without loading it.
+MASTER_PATH = f'{PATH_ROOT}/files/master_finn_eiendom.parquet'
+TILES_PATH = f'{PATH_ROOT}/files/tiles'
@@ -0,0 +1,191 @@
+import os
+import glob
+import json
+import pickle
+import numpy as np
+import shapely
+from dotenv import load_dotenv
+
+from projection import epsg_zone, wgs84_to_utm
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+
+# The postcode written in an ad, e.g. 'Sverdrups gate 5 C, 0559 Oslo'
+POSTCODE_PATTERN = r',\s*(\d{4})\b'
+
+# Size in metres of the grid cells used to look up points without testing them against polygons
+CELL_SIZE = 100.0
+OUTSIDE = -1
+BORDER = -2
+
+
+class PostcodeIndex:
+    """
+    Postal code polygons in UTM, for looking up which postal code area many points are in
+    at once. A grid over the polygons gives the area of every cell that is completely
+    inside one of them, so only points in cells on a border are tested against the
+    polygons, using an STRtree.
+    """
+
+    def __init__(self, polygons, postcodes, places, zone=32, grid=None):
+        self.polygons = polygons
+        self.postcodes = np.asarray(postcodes, dtype=object)
+        self.places = np.asarray(places, dtype=object)
+        self.zone = zone
+        self.tree = shapely.STRtree(polygons)
+        self.origin, self.cells = grid if grid is not None else self._build_grid()
+
+    def _build_grid(self, cell_size=CELL_SIZE):
+        min_x, min_y, max_x, max_y = shapely.total_bounds(self.polygons)
+        columns = int(np.ceil((max_x - min_x) / cell_size))
+        rows = int(np.ceil((max_y - min_y) / cell_size))
+        xs = min_x + np.arange(columns) * cell_size
+        ys = min_y + np.arange(rows) * cell_size
+        x0, y0 = (a.ravel() for a in np.meshgrid(xs, ys))
+        boxes = shapely.box(x0, y0, x0 + cell_size, y0 + cell_size)
+
+        cells = np.full(len(boxes), OUTSIDE, dtype=np.int32)
+        cells[np.unique(self.tree.query(boxes)[0])] = BORDER
+        box_rows, polygon_rows = self.tree.query(boxes, predicate='within')
+        cells[box_rows] = polygon_rows
+        return (min_x, min_y, cell_size), cells.reshape(rows, columns)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def lookup(self, latitudes, longitudes):
+        """
+        Find the postal code area of each point. Returns the position of the polygon
+        containing each point, or -1 for points outside all of them or without coordinates.
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        positions = np.full(len(latitudes), -1, dtype=np.int64)
+        valid = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        if not len(valid):
+            return positions
+
+        eastings, northings = wgs84_to_utm(latitudes[valid], longitudes[valid], self.zone)
+        min_x, min_y, cell_size = self.origin
+        rows = np.floor((northings - min_y) / cell_size).astype(np.int64)
+        columns = np.floor((eastings - min_x) / cell_size).astype(np.int64)
+        in_grid = (rows >= 0) & (rows < self.cells.shape[0]) & (columns >= 0) & (columns < self.cells.shape[1])
+        cells = np.full(len(valid), OUTSIDE, dtype=np.int64)
+        cells[in_grid] = self.cells[rows[in_grid], columns[in_grid]]
+        positions[valid] = np.where(cells == BORDER, OUTSIDE, cells)
+
+        border = np.flatnonzero(cells == BORDER)
+        points = shapely.points(eastings[border], northings[border])
+        point_rows, polygon_rows = self.tree.query(points, predicate='intersects')
+        # A point on the border between two areas matches both, keep the first
+        first = np.unique(point_rows, return_index=True)[1]
+        positions[valid[border[point_rows[first]]]] = polygon_rows[first]
+        return positions
+
+
+def _load_polygons(path):
+    """Read the postal code polygons, postcodes, places and UTM zone from a Kartverket GeoJSON file."""
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('type') != 'FeatureCollection':
+        # Kartverket nests the layer under its name
+        data = next(value for value in data.values() if isinstance(value, dict))
+    crs = (data.get('crs') or {}).get('properties', {}).get('name', 'EPSG:25832')
+    features = data['features']
+    polygons = shapely.from_geojson([json.dumps(feature['geometry']) for feature in features])
+    postcodes = [feature['properties']['postnummer'] for feature in features]
+    places = [feature['properties'].get('poststed') for feature in features]
+    return polygons, postcodes, places, epsg_zone(crs)
+
+
+def find_postcode_file(root=None):
+    """Find the Kartverket postal code area GeoJSON file in the project root."""
+    if os.getenv('POSTCODE_AREAS_PATH'):
+        return os.getenv('POSTCODE_AREAS_PATH')
+    candidates = sorted(glob.glob(f'{root or PATH_ROOT}/Basisdata_*Postnummeromrader*.geojson'))
+    return candidates[0] if candidates else None
+
+
+def load_postcode_index(path, cache_path=None):
+    """
+    Load a PostcodeIndex from the postal code GeoJSON file. The parsed polygons and the grid
+    are cached in cache_path, which is rebuilt when the GeoJSON file changes.
+    """
+    cache_path = cache_path or f'{PATH_ROOT}/files/postcode_index.pkl'
+    stat = os.stat(path)
+    source = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['source'] == source:
+            return PostcodeIndex(
+                shapely.from_wkb(cached['polygons']),
+                cached['postcodes'],
+                cached['places'],
+                cached['zone'],
+                cached['grid'],
+            )
+
+    print(f"Building postal code index from {path}...")
+    polygons, postcodes, places, zone = _load_polygons(path)
+    index = PostcodeIndex(polygons, postcodes, places, zone)
+    if os.path.isdir(os.path.dirname(cache_path)):
+        with open(cache_path, 'wb') as f:
+            pickle.dump(
+                {
+                    'source': source,
+                    'polygons': shapely.to_wkb(polygons),
+                    'postcodes': postcodes,
+                    'places': places,
+                    'zone': zone,
+                    'grid': (index.origin, index.cells),
+                },
+                f,
+            )
+    return index
+
+
+_index = None
+
+
+def get_postcode_index():
+    """Get the shared postal code index, or None if there is no postal code file."""
+    global _index
+    if _index is None:
+        path = find_postcode_file()
+        if path is None or not os.path.exists(path):
+            return None
+        _index = load_postcode_index(path)
+    return _index
+
+
+def add_postcodes(df, index=None):
+    """
+    Add the postnummer and poststed of the postal code area each listing is in, and flag
+    listings whose coordinates are in another postal code area than the one in adresse,
+    which usually means the address was geocoded to the wrong place.
+    """
+    # Imported here, so finding the postal code file does not need pandas
+    import pandas as pd
+
+    if index is None:
+        index = get_postcode_index()
+    if index is None:
+        print("No postal code areas found. Skipping postal code lookup.")
+        return df
+
+    positions = index.lookup(df['latitude'], df['longitude'])
+    found = positions >= 0
+    postcodes = np.where(found, index.postcodes[positions], None)
+    df['postnummer'] = postcodes
+    df['poststed'] = np.where(found, index.places[positions], None)
+
+    address_postcodes = df['adresse'].str.extract(POSTCODE_PATTERN, expand=False)
+    # Only listings inside the covered area, with a postcode in the address, can be checked
+    checked = found & address_postcodes.notna().to_numpy()
+    mismatch = pd.array(np.where(checked, address_postcodes.to_numpy() != postcodes, False), dtype='boolean')
+    mismatch[~checked] = pd.NA
+    df['postnummer-avvik'] = mismatch
+    return df
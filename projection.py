@@ -0,0 +1,76 @@
+import numpy as np
+
+# Conversion between WGS84 longitude/latitude and UTM (ETRS89 / EPSG:258xx), using the
+# Krüger series to third order. Accurate to well below a millimetre within a UTM zone,
+# which is plenty for addresses and postal-code polygons.
+
+A_AXIS = 6378137.0
+FLATTENING = 1 / 298.257222101  # GRS80, which ETRS89 uses
+K0 = 0.9996
+FALSE_EASTING = 500000.0
+
+_n = FLATTENING / (2 - FLATTENING)
+_A = A_AXIS / (1 + _n) * (1 + _n**2 / 4 + _n**4 / 64)
+_ALPHA = (
+    _n / 2 - 2 / 3 * _n**2 + 5 / 16 * _n**3,
+    13 / 48 * _n**2 - 3 / 5 * _n**3,
+    61 / 240 * _n**3,
+)
+_BETA = (
+    _n / 2 - 2 / 3 * _n**2 + 37 / 96 * _n**3,
+    1 / 48 * _n**2 + 1 / 15 * _n**3,
+    17 / 480 * _n**3,
+)
+_DELTA = (
+    2 * _n - 2 / 3 * _n**2 - 2 * _n**3,
+    7 / 3 * _n**2 - 8 / 5 * _n**3,
+    56 / 15 * _n**3,
+)
+
+
+def epsg_zone(epsg):
+    """Get the UTM zone of an ETRS89 or WGS84 UTM EPSG code, e.g. 25832 -> 32."""
+    epsg = int(str(epsg).rsplit(':', 1)[-1])
+    if 25828 <= epsg <= 25838 or 32601 <= epsg <= 32660:
+        return epsg % 100
+    raise ValueError(f"Unsupported EPSG code: {epsg}")
+
+
+def _central_meridian(zone):
+    return np.radians(zone * 6 - 183)
+
+
+def wgs84_to_utm(latitude, longitude, zone=32):
+    """Project latitude/longitude arrays to UTM easting/northing arrays in the given zone."""
+    phi = np.radians(np.asarray(latitude, dtype=float))
+    dlambda = np.radians(np.asarray(longitude, dtype=float)) - _central_meridian(zone)
+    c = 2 * np.sqrt(_n) / (1 + _n)
+    t = np.sinh(np.arctanh(np.sin(phi)) - c * np.arctanh(c * np.sin(phi)))
+    xi = np.arctan2(t, np.cos(dlambda))
+    eta = np.arctanh(np.sin(dlambda) / np.sqrt(1 + t**2))
+
+    easting = eta.copy()
+    northing = xi.copy()
+    for j, alpha in enumerate(_ALPHA, start=1):
+        easting += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        northing += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+    return FALSE_EASTING + K0 * _A * easting, K0 * _A * northing
+
+
+def utm_to_wgs84(easting, northing, zone=32):
+    """Unproject UTM easting/northing arrays in the given zone to latitude/longitude arrays."""
+    xi = np.asarray(northing, dtype=float) / (K0 * _A)
+    eta = (np.asarray(easting, dtype=float) - FALSE_EASTING) / (K0 * _A)
+
+    xi_prime = xi.copy()
+    eta_prime = eta.copy()
+    for j, beta in enumerate(_BETA, start=1):
+        xi_prime -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        eta_prime -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+
+    chi = np.arcsin(np.sin(xi_prime) / np.cosh(eta_prime))
+    phi = chi.copy()
+    for j, delta in enumerate(_DELTA, start=1):
+        phi += delta * np.sin(2 * j * chi)
+    dlambda = np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+    return np.degrees(phi), np.degrees(_central_meridian(zone) + dlambda)
@@ -0,0 +1,422 @@
+import os
+import re
+import sys
+import time
+import pickle
+import argparse
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+INDEX_PATH = f'{PATH_ROOT}/files/listing_index.pkl'
+
+UNIQUE_COLUMN = 'annonse-href'
+
+# Columns with a sorted array index, for range filters and sorting without a scan
+SORTED_COLUMNS = ['pris', 'pris/m2', 'first-seen']
+
+# Text columns kept for equality filters and for showing the results
+TEXT_COLUMNS = ['annonse-href', 'adresse', 'first-seen', 'postnummer', 'poststed', 'eieform', 'leilighetstype']
+
+DEFAULT_COLUMNS = ['adresse', 'pris', 'pris/m2', 'antall-rom', 'bruksareal', 'first-seen', 'solgt', 'annonse-href']
+
+# Size in degrees of the cells of the spatial grid, about 1.1 km north-south and 0.55 km
+# east-west in Oslo
+GRID_CELL_DEGREES = 0.01
+GRID_COLUMNS = round(360 / GRID_CELL_DEGREES)
+
+# Deleted and replaced listings are only marked as such. The index is rebuilt from the
+# live listings when they are more than this share of it.
+MAX_DEAD_FRACTION = 0.25
+
+# 'pris<6000000', 'antall-rom=3', 'solgt=false', 'heis' or '!balkong'
+FILTER_PATTERN = re.compile(r'^(.+?)\s*(<=|>=|!=|=|<|>)\s*(.+)$')
+COMPARISONS = {
+    '=': np.equal,
+    '!=': np.not_equal,
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+}
+
+
+def _timestamps(values):
+    """Convert dates and times, as text, to seconds since the epoch. Missing or invalid ones become NaN."""
+    import pandas as pd
+
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), errors='coerce', format='mixed')
+    seconds = (parsed - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+    return seconds.to_numpy(dtype=float, na_value=np.nan)
+
+
+def _grid_cells(latitudes, longitudes):
+    rows = np.floor((latitudes + 90) / GRID_CELL_DEGREES).astype(np.int64)
+    columns = np.floor((longitudes + 180) / GRID_CELL_DEGREES).astype(np.int64)
+    return rows * GRID_COLUMNS + columns
+
+
+def _insert_sorted(sorted_values, positions, values, new_positions):
+    """Insert values, with their row positions, into a sorted array index. NaN values are left out."""
+    keep = ~np.isnan(values)
+    values, new_positions = values[keep], new_positions[keep]
+    order = np.argsort(values, kind='stable')
+    values, new_positions = values[order], new_positions[order]
+    at = np.searchsorted(sorted_values, values, side='right')
+    return np.insert(sorted_values, at, values), np.insert(positions, at, new_positions)
+
+
+class ListingIndex:
+    """
+    Secondary indexes over the merged listings, for answering compound filters and top-k
+    queries without reading the dataset:
+
+    - sorted arrays of the values of SORTED_COLUMNS, with the row of each value
+    - a grid over latitude and longitude, as the sorted cells of the rows
+    - a bitmap per boolean column, e.g. solgt, heis and balkong
+
+    Other numeric and text columns are kept as arrays and scanned. Rows are never moved:
+    a listing that is removed or updated is marked as dead and the new version appended,
+    until the dead rows are more than MAX_DEAD_FRACTION of the index and it is compacted.
+    """
+
+    def __init__(self):
+        self.keys = np.array([], dtype=object)
+        self.alive = np.array([], dtype=bool)
+        self.numbers = {}
+        self.flags = {}
+        self.texts = {}
+        self.sorted = {}
+        self.grid = (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_dataframe(cls, df):
+        index = cls()
+        index.append(df)
+        return index
+
+    def _arrays(self, df):
+        """Split df into the numeric, boolean and text arrays that are indexed."""
+        import pandas as pd
+        from store import apply_schema
+
+        df = apply_schema(df.copy())
+        numbers, flags, texts = {}, {}, {}
+        for col in df.columns:
+            values = df[col]
+            if pd.api.types.is_bool_dtype(values.dtype):
+                flags[col] = values.astype('boolean').fillna(False).to_numpy(dtype=bool)
+            elif pd.api.types.is_numeric_dtype(values.dtype):
+                numbers[col] = values.to_numpy(dtype=float, na_value=np.nan)
+            if col in TEXT_COLUMNS:
+                texts[col] = values.astype(object).where(values.notna(), None).to_numpy(dtype=object)
+        if 'first-seen' in df:
+            numbers['first-seen'] = _timestamps(df['first-seen'])
+        return df[UNIQUE_COLUMN].astype(str).to_numpy(dtype=object), numbers, flags, texts
+
+    def append(self, df):
+        """Add the listings in df, replacing earlier versions of them."""
+        keys, numbers, flags, texts = self._arrays(df)
+        self._append_arrays(keys, numbers, flags, texts)
+
+    def _append_arrays(self, keys, numbers, flags, texts):
+        self.delete(keys)
+        start = len(self.keys)
+        count = len(keys)
+        new_positions = np.arange(start, start + count)
+        self.keys = np.concatenate([self.keys, keys])
+        self.alive = np.concatenate([self.alive, np.ones(count, dtype=bool)])
+        # Columns missing from either side are filled with NaN, False or None
+        for columns, new, dtype, fill in (
+            (self.numbers, numbers, float, np.nan),
+            (self.flags, flags, bool, False),
+            (self.texts, texts, object, None),
+        ):
+            for col in set(columns) | set(new):
+                old = columns.get(col, np.full(start, fill, dtype=dtype))
+                values = new.get(col, np.full(count, fill, dtype=dtype))
+                columns[col] = np.concatenate([old, values.astype(dtype)])
+
+        for col in SORTED_COLUMNS:
+            if col in self.numbers:
+                sorted_values, positions = self.sorted.get(col, (np.array([]), np.array([], dtype=np.int64)))
+                self.sorted[col] = _insert_sorted(sorted_values, positions, self.numbers[col][start:], new_positions)
+
+        latitudes = self.numbers['latitude'][start:]
+        longitudes = self.numbers['longitude'][start:]
+        located = np.isfinite(latitudes) & np.isfinite(longitudes)
+        cells = _grid_cells(latitudes[located], longitudes[located])
+        order = np.argsort(cells, kind='stable')
+        at = np.searchsorted(self.grid[0], cells[order], side='right')
+        self.grid = (np.insert(self.grid[0], at, cells[order]), np.insert(self.grid[1], at, new_positions[located][order]))
+        self.rows.update(zip(keys, new_positions))
+        # Only the last row of a listing that is in keys more than once is live
+        self.alive[start:] = [self.rows[key] == position for key, position in zip(keys, new_positions)]
+
+    def delete(self, keys):
+        """Remove the listings with the given keys from query results."""
+        positions = [self.rows.pop(key) for key in keys if key in self.rows]
+        self.alive[positions] = False
+
+    def apply_change_set(self, change_set):
+        """Update the index with a change set from merge.build_change_set."""
+        import pandas as pd
+
+        self.delete(change_set['removed'][UNIQUE_COLUMN].astype(str))
+        rows = pd.concat([change_set['added'], change_set['updated']])
+        if len(rows):
+            self.append(rows)
+        dead = len(self.keys) - len(self.rows)
+        if dead > MAX_DEAD_FRACTION * len(self.keys):
+            self.compact()
+
+    def compact(self):
+        """Rebuild the indexes from the live listings only."""
+        keep = self.alive
+        keys = self.keys[keep]
+        numbers = {col: values[keep] for col, values in self.numbers.items()}
+        flags = {col: values[keep] for col, values in self.flags.items()}
+        texts = {col: values[keep] for col, values in self.texts.items()}
+        self.__init__()
+        self._append_arrays(keys, numbers, flags, texts)
+
+    def save(self, path=None):
+        path = path or INDEX_PATH
+        state = dict(self.__dict__)
+        # Bitmaps are stored with one bit per listing
+        state['alive'] = (np.packbits(self.alive), len(self.alive))
+        state['flags'] = {col: np.packbits(values) for col, values in self.flags.items()}
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path=None):
+        """Load the index saved at path. Returns None if there is none."""
+        path = path or INDEX_PATH
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        packed_alive, size = state['alive']
+        state['alive'] = np.unpackbits(packed_alive, count=size).astype(bool)
+        state['flags'] = {
+            col: np.unpackbits(values, count=size).astype(bool) for col, values in state['flags'].items()
+        }
+        index = cls()
+        index.__dict__.update(state)
+        return index
+
+    def parse_filter(self, condition):
+        """
+        Parse a filter like 'pris<6000000', 'antall-rom=3', 'first-seen>=2024-06-01',
+        'solgt=false', 'heis' or '!balkong', or a (column, operator, value) tuple, into a
+        (column, operator, value) tuple with the value as stored in the index.
+        """
+        if isinstance(condition, str):
+            condition = condition.strip()
+            match = FILTER_PATTERN.match(condition)
+            if match is None:
+                condition = (condition.lstrip('!'), '=', not condition.startswith('!'))
+            else:
+                condition = match.groups()
+        column, operator, value = condition
+
+        if column in self.flags:
+            if operator not in ('=', '!='):
+                raise ValueError(f"{column} can only be compared with = or !=.")
+            if isinstance(value, str):
+                if value.lower() not in ('true', 'false', 'ja', 'nei'):
+                    raise ValueError(f"{column} is true or false, not {value}.")
+                value = value.lower() in ('true', 'ja')
+            return column, operator, bool(value)
+        if column in self.numbers:
+            try:
+                if column == 'first-seen':
+                    # Parsed with numpy, so queries do not need pandas
+                    value = float(np.datetime64(str(value).strip(), 's').astype(np.int64))
+                else:
+                    value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{column} is compared with a number, e.g. '{column}<100'.")
+            return column, operator, value
+        if column in self.texts:
+            if operator not in ('=', '!='):
+                raise ValueError(f"{column} can only be compared with = or !=.")
+            return column, operator, str(value)
+        raise ValueError(f"Unknown column {column}.")
+
+    def _flag_mask(self, column, operator, value):
+        return self.flags[column] == (value if operator == '=' else not value)
+
+    def _range_mask(self, column, operator, value):
+        """Match a comparison on a numeric column, using its sorted array index if it has one."""
+        if column not in self.sorted or operator == '!=':
+            values = self.numbers[column]
+            return ~np.isnan(values) & COMPARISONS[operator](values, value)
+        sorted_values, positions = self.sorted[column]
+        start, end = {
+            '=': (np.searchsorted(sorted_values, value, 'left'), np.searchsorted(sorted_values, value, 'right')),
+            '<': (0, np.searchsorted(sorted_values, value, 'left')),
+            '<=': (0, np.searchsorted(sorted_values, value, 'right')),
+            '>': (np.searchsorted(sorted_values, value, 'right'), len(sorted_values)),
+            '>=': (np.searchsorted(sorted_values, value, 'left'), len(sorted_values)),
+        }[operator]
+        mask = np.zeros(len(self.keys), dtype=bool)
+        mask[positions[start:end]] = True
+        return mask
+
+    def _bbox_mask(self, bbox):
+        """Match the listings in (min longitude, min latitude, max longitude, max latitude), using the grid."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        first = _grid_cells(np.array([min_lat]), np.array([min_lon]))[0]
+        last = _grid_cells(np.array([max_lat]), np.array([max_lon]))[0]
+        cells, positions = self.grid
+        candidates = []
+        # Each row of cells in the box is one range of the sorted cells
+        for row_start in range(first - first % GRID_COLUMNS, last - last % GRID_COLUMNS + 1, GRID_COLUMNS):
+            start = np.searchsorted(cells, row_start + first % GRID_COLUMNS, 'left')
+            end = np.searchsorted(cells, row_start + last % GRID_COLUMNS, 'right')
+            candidates.append(positions[start:end])
+        candidates = np.concatenate(candidates) if candidates else np.array([], dtype=np.int64)
+        latitudes = self.numbers['latitude'][candidates]
+        longitudes = self.numbers['longitude'][candidates]
+        inside = (latitudes >= min_lat) & (latitudes <= max_lat) & (longitudes >= min_lon) & (longitudes <= max_lon)
+        mask = np.zeros(len(self.keys), dtype=bool)
+        mask[candidates[inside]] = True
+        return mask
+
+    def match(self, where=(), bbox=None):
+        """Get a bitmap of the live listings matching all filters in where, and inside bbox."""
+        mask = self.alive.copy()
+        for condition in where:
+            column, operator, value = self.parse_filter(condition)
+            if column in self.flags:
+                mask &= self._flag_mask(column, operator, value)
+            elif column in self.numbers:
+                mask &= self._range_mask(column, operator, value)
+            else:
+                mask &= (self.texts[column] == value) == (operator == '=')
+        if bbox is not None:
+            mask &= self._bbox_mask(bbox)
+        return mask
+
+    def query(self, where=(), bbox=None, sort=None, descending=False, limit=None):
+        """
+        Find the listings matching all filters in where, e.g. ['solgt=false', 'antall-rom=3',
+        'pris<6000000', 'heis', 'balkong'] or (column, operator, value) tuples, and inside
+        bbox, given as (min longitude, min latitude, max longitude, max latitude). Returns
+        their rows, sorted by the numeric column sort, and at most limit of them.
+        """
+        mask = self.match(where, bbox)
+        if sort is None:
+            positions = np.flatnonzero(mask)
+        elif sort in self.sorted:
+            sorted_positions = self.sorted[sort][1]
+            positions = sorted_positions[mask[sorted_positions]]
+            if descending:
+                positions = positions[::-1]
+            # Listings without a value come last
+            missing = mask.copy()
+            missing[sorted_positions] = False
+            positions = np.concatenate([positions, np.flatnonzero(missing)])
+        elif sort in self.numbers:
+            positions = np.flatnonzero(mask)
+            values = self.numbers[sort][positions]
+            order = np.argsort(-values if descending else values, kind='stable')
+            positions = positions[order]
+        else:
+            raise ValueError(f"Can only sort by a numeric column, not {sort}.")
+        return positions[:limit] if limit is not None else positions
+
+    def records(self, positions, columns=None):
+        """Get the given rows as dicts of the columns, the DEFAULT_COLUMNS if not given."""
+        columns = columns or [col for col in DEFAULT_COLUMNS if col in self.texts or col in self.numbers or col in self.flags]
+        records = []
+        for position in positions:
+            record = {}
+            for col in columns:
+                if col in self.texts:
+                    value = self.texts[col][position]
+                elif col in self.flags:
+                    value = bool(self.flags[col][position])
+                else:
+                    value = self.numbers[col][position]
+                    value = None if np.isnan(value) else int(value) if value.is_integer() else round(float(value), 1)
+                record[col] = value
+            records.append(record)
+        return records
+
+
+def update_listing_index(merged_df, change_set=None, path=None):
+    """
+    Update the listing index with a merge change set, or rebuild it from merged_df if
+    there is no change set or no index yet. It is also rebuilt if the updated index does
+    not have the same listings as merged_df, e.g. after a backup was restored.
+    """
+    path = path or INDEX_PATH
+    index = ListingIndex.load(path) if change_set is not None else None
+    if index is not None and len(index):
+        index.apply_change_set(change_set)
+        if len(index) == merged_df[UNIQUE_COLUMN].nunique():
+            print(f"Updated the listing index, {len(index)} listings.")
+            index.save(path)
+            return index
+    index = ListingIndex.from_dataframe(merged_df)
+    print(f"Built the listing index for {len(index)} listings.")
+    index.save(path)
+    return index
+
+
+def print_table(records):
+    if not records:
+        return
+    columns = list(records[0])
+    texts = [['' if record[col] is None else str(record[col]) for col in columns] for record in records]
+    widths = [min(max(len(col), *(len(row[i]) for row in texts)), 60) for i, col in enumerate(columns)]
+    print('  '.join(col.ljust(width) for col, width in zip(columns, widths)))
+    for row in texts:
+        print('  '.join(value[:width].ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Query the merged listings, e.g. python query.py solgt=false antall-rom=3 'pris<6000000' heis balkong"
+    )
+    parser.add_argument('where', nargs='*', help="Filters like 'pris<6000000', 'antall-rom=3', 'solgt=false', 'heis' or '!balkong'")
+    parser.add_argument('--bbox', help="min_lon,min_lat,max_lon,max_lat")
+    parser.add_argument('--sort', help="Numeric column to sort by")
+    parser.add_argument('--desc', action='store_true', help="Sort in descending order")
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--columns', help="Comma separated columns to show")
+    parser.add_argument('--count', action='store_true', help="Only show the number of matches")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the index from the master dataset")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        from store import read_master
+
+        master_df = read_master()
+        if master_df is None:
+            sys.exit("No master dataset to build the index from.")
+        update_listing_index(master_df)
+
+    index = ListingIndex.load()
+    if index is None:
+        sys.exit("No listing index yet. Run a merge or python query.py --rebuild.")
+    bbox = [float(value) for value in args.bbox.split(',')] if args.bbox else None
+    start = time.perf_counter()
+    try:
+        positions = index.query(args.where, bbox, args.sort, args.desc)
+    except ValueError as e:
+        sys.exit(str(e))
+    elapsed = time.perf_counter() - start
+    if not args.count:
+        print_table(index.records(positions[: args.limit], args.columns.split(',') if args.columns else None))
+    print(f"{len(positions)} listings matched in {elapsed * 1000:.1f} ms.")
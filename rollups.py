@@ -0,0 +1,181 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import shapely
+from dotenv import load_dotenv
+
+from postcodes import get_postcode_index
+from projection import utm_to_wgs84
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+
+# Changes to other columns do not affect the rollups
+SOURCE_COLUMNS = ['postnummer', 'first-seen', 'pris/m2', 'prisantydning/m2', 'solgt', 'felleskostnader']
+
+# Polygons are simplified to this tolerance in metres before export, which keeps the layer small
+SIMPLIFY_TOLERANCE = 5.0
+
+
+def _contributions(df, unique_column='annonse-href'):
+    """Get the values each listing in df contributes to the rollups, indexed on unique_column."""
+    contributions = pd.DataFrame(index=pd.Index(df[unique_column], name=unique_column))
+    contributions['postnummer'] = df['postnummer'].to_numpy() if 'postnummer' in df else None
+    first_seen = pd.to_datetime(df['first-seen'], errors='coerce') if 'first-seen' in df else pd.NaT
+    contributions['uke'] = pd.Series(first_seen, index=df.index).dt.strftime('%G-W%V').to_numpy()
+    for col in ['pris/m2', 'prisantydning/m2', 'felleskostnader']:
+        values = df[col] if col in df else pd.Series(np.nan, index=df.index)
+        contributions[col] = pd.to_numeric(values, errors='coerce').astype(float).to_numpy()
+    solgt = df['solgt'] if 'solgt' in df else pd.Series(False, index=df.index)
+    contributions['solgt'] = solgt.astype('boolean').fillna(False).to_numpy(dtype=bool)
+    # Listings outside the postal code areas are not part of any rollup
+    return contributions[contributions['postnummer'].notna()]
+
+
+def _summarize(contributions, keys):
+    """Compute the statistics of the listings in contributions, grouped by keys."""
+    grouped = contributions.groupby(keys, sort=True)
+    summary = grouped.agg(
+        **{
+            'antall': ('solgt', 'size'),
+            'andel-solgt': ('solgt', 'mean'),
+            'prisantydning/m2-median': ('prisantydning/m2', 'median'),
+            'felleskostnader-median': ('felleskostnader', 'median'),
+        }
+    )
+    quantiles = grouped['pris/m2'].quantile([0.25, 0.5, 0.75]).unstack().reindex(columns=[0.25, 0.5, 0.75])
+    summary['pris/m2-p25'] = quantiles[0.25]
+    summary['pris/m2-median'] = quantiles[0.5]
+    summary['pris/m2-p75'] = quantiles[0.75]
+    return summary.round({'andel-solgt': 3}).round(
+        {col: 0 for col in summary.columns if col.endswith(('median', 'p25', 'p75'))}
+    )
+
+
+class PriceRollups:
+    """
+    Price statistics per postal code, and per postal code and week of first-seen. The
+    contribution of every listing is stored, so a change set only has to recompute the
+    statistics of the postal codes it touches.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or f'{PATH_ROOT}/files/price_rollups.pkl'
+        if os.path.exists(self.path):
+            state = pd.read_pickle(self.path)
+            self.contributions = state['contributions']
+            self.by_postcode = state['by_postcode']
+            self.by_week = state['by_week']
+        else:
+            self.contributions = _contributions(pd.DataFrame(columns=['annonse-href', 'postnummer']))
+            self.by_postcode = _summarize(self.contributions, ['postnummer'])
+            self.by_week = _summarize(self.contributions, ['postnummer', 'uke'])
+
+    def __len__(self):
+        return len(self.contributions)
+
+    def rebuild(self, df):
+        """Compute all rollups from scratch from the full dataset."""
+        self.contributions = _contributions(df)
+        self.by_postcode = _summarize(self.contributions, ['postnummer'])
+        self.by_week = _summarize(self.contributions, ['postnummer', 'uke'])
+
+    def apply_change_set(self, change_set, unique_column='annonse-href'):
+        """
+        Update the rollups with a change set from merge.build_change_set. Returns the
+        postal codes whose statistics were recomputed.
+        """
+        updated = change_set['updated']
+        relevant = change_set['changed'].reindex(columns=SOURCE_COLUMNS, fill_value=False).any(axis=1)
+        rows = pd.concat([change_set['added'], updated[relevant.to_numpy()]])
+        new = _contributions(rows, unique_column)
+        touched = pd.Index(rows[unique_column]).append(pd.Index(change_set['removed'][unique_column]))
+        old = self.contributions[self.contributions.index.isin(touched)]
+
+        dirty = pd.Index(old['postnummer']).append(pd.Index(new['postnummer'])).unique()
+        if not len(dirty):
+            return dirty
+        self.contributions = pd.concat(
+            [self.contributions[~self.contributions.index.isin(touched)], new]
+        )
+        self._recompute(dirty)
+        return dirty
+
+    def _recompute(self, postcodes):
+        affected = self.contributions[self.contributions['postnummer'].isin(postcodes)]
+        by_postcode = self.by_postcode[~self.by_postcode.index.isin(postcodes)]
+        self.by_postcode = pd.concat([by_postcode, _summarize(affected, ['postnummer'])]).sort_index()
+        by_week = self.by_week[~self.by_week.index.get_level_values('postnummer').isin(postcodes)]
+        self.by_week = pd.concat([by_week, _summarize(affected, ['postnummer', 'uke'])]).sort_index()
+
+    def save(self):
+        pd.to_pickle(
+            {
+                'contributions': self.contributions,
+                'by_postcode': self.by_postcode,
+                'by_week': self.by_week,
+            },
+            self.path,
+        )
+
+    def to_geojson(self, path, index=None):
+        """
+        Write the statistics per postal code as a GeoJSON layer of the postal code areas,
+        in WGS84, for showing choropleths in Atlas. Areas without listings are left out.
+        """
+        if index is None:
+            index = get_postcode_index()
+        areas = pd.DataFrame({'postnummer': index.postcodes, 'poststed': index.places})
+        areas = areas[areas['postnummer'].isin(self.by_postcode.index)]
+        statistics = json.loads(self.by_postcode.to_json(orient='index'))
+        features = []
+        for postcode, group in areas.groupby('postnummer', sort=True):
+            area = shapely.union_all(index.polygons[group.index.to_numpy()])
+            area = shapely.simplify(area, SIMPLIFY_TOLERANCE)
+            area = shapely.transform(area, _utm_to_lonlat(index.zone))
+            properties = {'postnummer': postcode, 'poststed': group['poststed'].iloc[0]}
+            properties.update(statistics[postcode])
+            features.append(
+                {
+                    'type': 'Feature',
+                    'properties': properties,
+                    'geometry': json.loads(shapely.to_geojson(area)),
+                }
+            )
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f, ensure_ascii=False)
+
+
+def _utm_to_lonlat(zone):
+    def transform(coordinates):
+        latitudes, longitudes = utm_to_wgs84(coordinates[:, 0], coordinates[:, 1], zone)
+        return np.column_stack([longitudes, latitudes]).round(6)
+
+    return transform
+
+
+def update_price_rollups(merged_df, change_set=None, output_path=None):
+    """
+    Update the price rollups with a merge change set, or rebuild them from merged_df if
+    there is no change set or no stored rollups yet, and export them. The statistics per
+    postal code and week are saved to output_path + '.csv', the postal code areas to
+    output_path + '.geojson'.
+    """
+    output_path = output_path or f'{PATH_ROOT}/files/price_rollups'
+    if get_postcode_index() is None or 'postnummer' not in merged_df:
+        print("No postal codes available. Skipping price rollups.")
+        return None
+
+    rollups = PriceRollups(output_path + '.pkl')
+    if change_set is None or not len(rollups):
+        rollups.rebuild(merged_df)
+        print(f"Built price rollups for {len(rollups.by_postcode)} postal codes.")
+    else:
+        dirty = rollups.apply_change_set(change_set)
+        print(f"Updated price rollups for {len(dirty)} postal codes.")
+    rollups.save()
+    rollups.by_week.to_csv(output_path + '.csv')
+    rollups.to_geojson(output_path + '.geojson')
+    return rollups
@@ -0,0 +1,269 @@
+import os
+import glob
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+SNAPSHOT_PATH = f'{PATH_ROOT}/old_datasets'
+
+# A delta is only stored if its chain of bases is shorter than this, so restores stay fast
+MAX_DELTA_CHAIN = 7
+CHUNK_SIZE = 1024 * 1024
+
+
+def _open_compressed(path, mode, codec):
+    """Open a compressed object file. zstd needs the optional zstandard package."""
+    if codec == 'zstd':
+        import zstandard
+
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return zstandard.ZstdCompressor(level=10).stream_writer(open(path, 'wb'), closefd=True)
+    return gzip.open(path, mode, compresslevel=6)
+
+
+def _default_codec():
+    try:
+        import zstandard  # noqa: F401
+
+        return 'zstd'
+    except ImportError:
+        return 'gzip'
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _line_key(line):
+    return hashlib.sha1(line).hexdigest()[:16]
+
+
+class SnapshotStore:
+    """
+    Compressed, content-addressed backups of the datasets downloaded from Atlas. Identical
+    downloads are stored once. With deltas, a snapshot only stores the lines that are not
+    in the previous one, which are the changed features since the GeoJSON has one feature
+    per line. Every snapshot is restored byte for byte. snapshots.json lists the snapshots with the time they were
+    taken, so the dataset as it was at any time can be restored.
+    """
+
+    def __init__(self, path=None, codec=None, deltas=None):
+        self.path = path or SNAPSHOT_PATH
+        self.codec = codec or os.getenv('SNAPSHOT_CODEC') or _default_codec()
+        if deltas is None:
+            deltas = os.getenv('SNAPSHOT_DELTAS', 'false').lower() == 'true'
+        self.deltas = deltas
+        self.objects_path = f'{self.path}/objects'
+        self.manifest_path = f'{self.path}/snapshots.json'
+        os.makedirs(self.objects_path, exist_ok=True)
+        self.snapshots = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.snapshots = json.load(f)
+
+    def _save_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.snapshots, f, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _objects(self):
+        """The stored objects by id, with their base if they are deltas."""
+        return {snapshot['id']: snapshot for snapshot in self.snapshots}
+
+    def _chain_length(self, snapshot_id):
+        objects = self._objects()
+        length = 0
+        while objects[snapshot_id].get('base'):
+            snapshot_id = objects[snapshot_id]['base']
+            length += 1
+        return length
+
+    def _object_path(self, snapshot):
+        return f"{self.objects_path}/{snapshot['object']}"
+
+    def add(self, file_path, created=None):
+        """Back up a GeoJSON file. Returns the snapshot entry."""
+        created = pd.Timestamp(created or pd.Timestamp.now()).isoformat()
+        snapshot_id = _file_sha256(file_path)
+        existing = self._objects().get(snapshot_id)
+        if existing is not None:
+            entry = {**existing, 'created': created}
+            print(f"Snapshot {snapshot_id[:12]} is identical to an earlier one, not storing it again.")
+        else:
+            entry = self._store(file_path, snapshot_id, created)
+        self.snapshots.append(entry)
+        self._save_manifest()
+        return entry
+
+    def _store(self, file_path, snapshot_id, created):
+        previous = self.snapshots[-1] if self.snapshots else None
+        use_delta = (
+            self.deltas
+            and previous is not None
+            and self._chain_length(previous['id']) + 1 < MAX_DELTA_CHAIN
+        )
+        suffix = 'zst' if self.codec == 'zstd' else 'gz'
+        entry = {
+            'id': snapshot_id,
+            'created': created,
+            'codec': self.codec,
+            'size': os.path.getsize(file_path),
+        }
+        if use_delta:
+            with open(file_path, 'rb') as f:
+                lines = f.read().splitlines(keepends=True)
+            base_lines = {_line_key(line) for line in self._lines(previous)}
+            keys = [_line_key(line) for line in lines]
+            delta = {
+                'order': keys,
+                'added': {key: line.decode('utf-8') for key, line in zip(keys, lines) if key not in base_lines},
+            }
+            entry.update(object=f'{snapshot_id}.delta.json.{suffix}', base=previous['id'])
+            with _open_compressed(self._object_path(entry), 'wb', self.codec) as f:
+                f.write(json.dumps(delta, ensure_ascii=False).encode())
+        else:
+            entry.update(object=f'{snapshot_id}.geojson.{suffix}', base=None)
+            with open(file_path, 'rb') as source, _open_compressed(self._object_path(entry), 'wb', self.codec) as f:
+                shutil.copyfileobj(source, f, CHUNK_SIZE)
+        stored = os.path.getsize(self._object_path(entry))
+        print(f"Stored snapshot {snapshot_id[:12]}: {entry['size'] / 1e6:.1f} MB -> {stored / 1e6:.2f} MB.")
+        return entry
+
+    def _read_object(self, snapshot):
+        with _open_compressed(self._object_path(snapshot), 'rb', snapshot['codec']) as f:
+            return f.read()
+
+    def _lines(self, snapshot):
+        """The lines of a snapshot, following the deltas back to a full snapshot."""
+        data = self._read_object(snapshot)
+        if not snapshot.get('base'):
+            return data.splitlines(keepends=True)
+        delta = json.loads(data)
+        base = self._objects()[snapshot['base']]
+        lines = {_line_key(line): line for line in self._lines(base)}
+        lines.update((key, line.encode('utf-8')) for key, line in delta['added'].items())
+        return [lines[key] for key in delta['order']]
+
+    def find(self, as_of=None):
+        """Get the latest snapshot taken at or before as_of, or the latest one."""
+        candidates = self.snapshots
+        if as_of is not None:
+            as_of = pd.Timestamp(as_of)
+            candidates = [s for s in candidates if pd.Timestamp(s['created']) <= as_of]
+        return max(candidates, key=lambda s: s['created'], default=None)
+
+    def restore(self, dest_path, as_of=None):
+        """Write the GeoJSON of the snapshot as of a time to dest_path. Returns the snapshot entry."""
+        snapshot = self.find(as_of)
+        if snapshot is None:
+            raise FileNotFoundError(f"No snapshot found as of {as_of}.")
+        if snapshot.get('base'):
+            with open(dest_path, 'wb') as f:
+                f.writelines(self._lines(snapshot))
+        else:
+            with _open_compressed(self._object_path(snapshot), 'rb', snapshot['codec']) as source:
+                with open(dest_path, 'wb') as f:
+                    shutil.copyfileobj(source, f, CHUNK_SIZE)
+        print(f"Restored snapshot from {snapshot['created']} to {dest_path}.")
+        return snapshot
+
+    def prune(self, keep_daily=None, keep_weekly=None, now=None):
+        """
+        Apply the retention policy: keep the last snapshot of each day for keep_daily days,
+        then the last snapshot of each week for keep_weekly weeks, and delete the rest.
+        Deltas based on a deleted snapshot are stored in full first.
+        """
+        keep_daily = keep_daily if keep_daily is not None else int(os.getenv('SNAPSHOT_KEEP_DAILY') or 14)
+        keep_weekly = keep_weekly if keep_weekly is not None else int(os.getenv('SNAPSHOT_KEEP_WEEKLY') or 52)
+        now = pd.Timestamp(now or pd.Timestamp.now())
+
+        kept = {}
+        for snapshot in sorted(self.snapshots, key=lambda s: s['created']):
+            created = pd.Timestamp(snapshot['created'])
+            age = now - created
+            if age <= pd.Timedelta(days=keep_daily):
+                period = ('day', created.date())
+            elif age <= pd.Timedelta(weeks=keep_weekly):
+                period = ('week', created.isocalendar()[:2])
+            else:
+                continue
+            # Later snapshots replace earlier ones in the same period
+            kept[period] = snapshot
+        kept = sorted(kept.values(), key=lambda s: s['created'])
+        removed = len(self.snapshots) - len(kept)
+
+        kept_ids = {snapshot['id'] for snapshot in kept}
+        for snapshot in kept:
+            if snapshot.get('base') and snapshot['base'] not in kept_ids:
+                self._make_full(snapshot)
+
+        old_objects = {s['object'] for s in self.snapshots}
+        self.snapshots = kept
+        self._save_manifest()
+        for name in old_objects - {s['object'] for s in kept}:
+            os.remove(f'{self.objects_path}/{name}')
+        print(f"Pruned {removed} snapshots, {len(kept)} left.")
+        return removed
+
+    def _make_full(self, snapshot):
+        lines = self._lines(snapshot)
+        old_object = snapshot['object']
+        suffix = 'zst' if snapshot['codec'] == 'zstd' else 'gz'
+        for entry in self.snapshots:
+            if entry['id'] == snapshot['id']:
+                entry.update(object=f"{snapshot['id']}.geojson.{suffix}", base=None)
+        with _open_compressed(self._object_path(snapshot), 'wb', snapshot['codec']) as f:
+            f.writelines(lines)
+        os.remove(f'{self.objects_path}/{old_object}')
+
+    def import_files(self, pattern, delete=False):
+        """Import the timestamped GeoJSON backups written by earlier versions into the store."""
+        for file_path in sorted(glob.glob(pattern)):
+            name = os.path.basename(file_path)
+            timestamp = name.removeprefix('existing_finn_eiendom_').removesuffix('.geojson')
+            try:
+                created = pd.Timestamp(timestamp)
+            except ValueError:
+                created = pd.Timestamp(os.path.getmtime(file_path), unit='s')
+            self.add(file_path, created)
+            if delete:
+                os.remove(file_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the backups of the Atlas dataset.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list')
+    restore_parser = subparsers.add_parser('restore')
+    restore_parser.add_argument('--as-of', help="Date and time to restore, defaults to the latest snapshot")
+    restore_parser.add_argument('--output', default='restored_finn_eiendom.geojson')
+    prune_parser = subparsers.add_parser('prune')
+    prune_parser.add_argument('--keep-daily', type=int)
+    prune_parser.add_argument('--keep-weekly', type=int)
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('--delete', action='store_true', help="Delete the imported files")
+    args = parser.parse_args()
+
+    store = SnapshotStore()
+    if args.command == 'list':
+        for snapshot in store.snapshots:
+            kind = 'delta' if snapshot.get('base') else 'full'
+            print(f"{snapshot['created']}  {snapshot['id'][:12]}  {kind:5}  {snapshot['size'] / 1e6:.1f} MB")
+    elif args.command == 'restore':
+        store.restore(args.output, args.as_of)
+    elif args.command == 'prune':
+        store.prune(args.keep_daily, args.keep_weekly)
+    elif args.command == 'import':
+        store.import_files(f'{store.path}/existing_finn_eiendom_*.geojson', delete=args.delete)
@@ -0,0 +1,96 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from clean_data import NUMERIC_COLUMNS
+from facilities import FACILITY_COLUMNS
+from paths import MASTER_PATH
+
+# Columns with few distinct values, kept as categoricals in memory and dictionaries in Arrow
+CATEGORY_COLUMNS = [
+    'eieform',
+    'leilighetstype',
+    'energiklasse',
+    'energiklasse-farge',
+    'postnummer',
+    'poststed',
+    'web-scraper-start-url',
+]
+BOOLEAN_COLUMNS = ['solgt', 'pin', 'gjem', 'postnummer-avvik', 'utvidelsesmuligheter'] + list(
+    FACILITY_COLUMNS
+)
+FLOAT_COLUMNS = ['latitude', 'longitude', 'pris/m2', 'prisantydning/m2', 'solgt-pris']
+
+# Types used for Arrow columns when reading them back into pandas
+_PANDAS_TYPES = {pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}
+
+
+def apply_schema(df):
+    """
+    Give the columns of df the types of the master dataset: Int64 numerics, nullable
+    booleans, categoricals and floats. Other text columns are kept as strings.
+    """
+    df = df.copy()
+    for col in df.columns:
+        values = df[col]
+        if col in NUMERIC_COLUMNS:
+            if values.dtype.name != 'Int64':
+                df[col] = pd.to_numeric(values, errors='coerce').round(0).astype('Int64')
+        elif col in BOOLEAN_COLUMNS:
+            if values.dtype == object:
+                values = values.replace({'True': True, 'False': False, 'true': True, 'false': False})
+            df[col] = values.astype('boolean')
+        elif col in CATEGORY_COLUMNS:
+            df[col] = values.astype('category')
+        elif col in FLOAT_COLUMNS:
+            df[col] = pd.to_numeric(values, errors='coerce').astype(float)
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) not in (
+            'string',
+            'empty',
+        ):
+            # Columns with mixed types, e.g. numbers and text, are stored as text
+            df[col] = values.where(values.isna(), values.astype(str))
+    return df
+
+
+def write_master(df, path=None):
+    """
+    Save df as the master dataset in Parquet, with the schema from apply_schema. Text is
+    dictionary encoded and compressed with zstd, and the file is replaced atomically.
+    """
+    path = path or MASTER_PATH
+    table = pa.Table.from_pandas(apply_schema(df), preserve_index=False)
+    pq.write_table(table, path + '.tmp', compression='zstd', use_dictionary=True)
+    os.replace(path + '.tmp', path)
+    print(f"Saved {len(df)} listings to {path}.")
+
+
+def read_master(path=None, columns=None):
+    """
+    Load the master dataset, memory-mapping the Parquet file. Returns None if there is
+    no master dataset yet.
+    """
+    path = path or MASTER_PATH
+    if not os.path.exists(path):
+        return None
+    table = pq.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas(types_mapper=_PANDAS_TYPES.get)
+
+
+def sync_user_columns(master_df, live_df, columns=['pin', 'gjem'], unique_column='annonse-href'):
+    """
+    Copy the columns the user edits in Atlas from the live dataset to the master dataset,
+    for the listings that are in both.
+    """
+    if live_df is None or live_df.empty:
+        return master_df
+    live = live_df.drop_duplicates(subset=[unique_column], keep='last').set_index(unique_column)
+    for col in columns:
+        if col not in live:
+            continue
+        values = master_df[unique_column].map(live[col]).astype('boolean')
+        if col in master_df:
+            values = values.fillna(master_df[col].astype('boolean'))
+        master_df[col] = values
+    return master_df
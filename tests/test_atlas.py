@@ -0,0 +1,120 @@
+import email.utils
+import gzip
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import atlas
+from atlas import AtlasClient
+
+
+class StubAtlas(BaseHTTPRequestHandler):
+    """Answers every request with the next status and headers queued on the server."""
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body = b''
+        while size := int(self.rfile.readline().strip(), 16):
+            body += self.rfile.read(size)
+            self.rfile.readline()
+        self.rfile.readline()
+        return body
+
+    def _respond(self):
+        server = self.server
+        body = self._read_body()
+        with server.lock:
+            server.requests.append(self.command)
+            server.bodies.append((self.headers.get('Content-Encoding'), body))
+            status, headers = server.responses.pop(0) if server.responses else (200, {})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubAtlas)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.bodies = []
+    server.responses = []
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retry_after_as_http_date(stub_server):
+    retry_at = email.utils.formatdate(time.time() - 5, usegmt=True)
+    stub_server.responses = [(503, {'Retry-After': retry_at}), (200, {})]
+    client = AtlasClient(base_url=stub_server.url, retries=2, backoff=0.01)
+
+    response = client.request('GET', f'{stub_server.url}/datasets')
+
+    assert response.status_code == 200
+    assert stub_server.requests == ['GET', 'GET']
+
+
+def test_retry_after_values():
+    assert atlas._retry_after('3', 1) == 3
+    assert atlas._retry_after('Wed, 21 Oct 2015 07:28:00 GMT', 1) == 0
+    assert 25 < atlas._retry_after(email.utils.formatdate(time.time() + 30, usegmt=True), 1) <= 30
+    assert atlas._retry_after('soon', 4) == 4
+    assert atlas._retry_after(None, 2) == 2
+
+
+def test_post_is_not_retried_after_reaching_the_server(stub_server):
+    stub_server.responses = [(503, {}), (200, {})]
+    client = AtlasClient(base_url=stub_server.url, retries=2, backoff=0.01)
+
+    response = client.request('POST', f'{stub_server.url}/webhook', body=lambda: b'{}')
+
+    assert response.status_code == 503
+    assert stub_server.requests == ['POST']
+
+
+def test_post_is_retried_when_no_connection_was_made():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+    client = AtlasClient(retries=2, backoff=0.01)
+    attempts = []
+    send = client.session.request
+    client.session.request = lambda *args, **kwargs: attempts.append(args[0]) or send(*args, **kwargs)
+
+    with pytest.raises(requests.ConnectionError):
+        client.request('POST', f'http://127.0.0.1:{closed_port}/webhook', body=lambda: b'{}')
+    assert attempts == ['POST'] * 3
+
+
+def test_upload_is_not_compressed_unless_asked(stub_server, tmp_path):
+    data = b'{"type": "FeatureCollection", "features": []}\n' * 1000
+    (tmp_path / 'merged.geojson').write_bytes(data)
+    client = AtlasClient(base_url=stub_server.url)
+
+    client.upload_file(str(tmp_path / 'merged.geojson'), f'{stub_server.url}/webhook')
+    client.upload_file(str(tmp_path / 'merged.geojson'), f'{stub_server.url}/webhook', compress=True)
+
+    (plain_encoding, plain), (gzip_encoding, compressed) = stub_server.bodies
+    assert plain_encoding is None
+    assert plain == data
+    assert gzip_encoding == 'gzip'
+    assert gzip.decompress(compressed) == data
@@ -0,0 +1,129 @@
+import io
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+from bs4 import BeautifulSoup
+
+from benchmark import make_raw_scrape
+import clean_data
+from clean_data import NUMERIC_COLUMNS, clean_dataframe, clean_dataframe_parallel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Listings with the values that took the slow paths of the row-wise cleaning
+EDGE_CASES = '''adresse,image-url-src,pris,prisantydning,omkostninger,antall-rom,antall-soverom,internt-bruksareal,bruksareal,byggeår,eksternt-bruksareal,etasje,felleskostnader,energiklasse,fasiliteter
+"Hovinveien 52B (Byggetrinn 2), Hasle, 0576 Oslo",https://images.finncdn.no/a.jpg https://images.finncdn.no/b.jpg,5 900 000 kr,5 750 000 kr,150 000 kr,3-4,2,60-95 m²,70-110 m²,2025,4 m²,2,4 700 kr,A - Mørkegrønn,"<div class=""py-4 break-words"">Heis</div><div class=""py-4 break-words"">Balkong/Terrasse</div>"
+"Sverdrups gate 4, 0559 Oslo",,4 500 000 kr,,,2,1,45.5 m²,48 m²,1911,,-,3 150 kr,G - Rød,
+"Bjerkelundgata 1, 2, 3, 0553 Oslo",https://images.finncdn.no/c.jpg,Solgt,4 000 000-4 200 000 kr,,1,,38 m²,,,,1. etasje,,Ikke oppgitt,"<div class=""py-4 break-words"">Peis/Ildsted</div>"
+'''
+
+
+# The row-wise cleaning of process_data before it was vectorized, kept as the reference
+def average_hyphenated_values(value):
+    try:
+        if isinstance(value, (int, float, np.number)) or '-' not in value:
+            return value
+        parts = value.split('-')
+
+        numbers = []
+        for part in parts:
+            numeric_part = re.findall(r'\d+(?:\.\d+)?', part)
+            numbers.extend([float(num) for num in numeric_part])
+        return round(sum(numbers) / len(numbers)) if numbers else pd.NA
+    except Exception:
+        return pd.NA
+
+
+def format_address(row):
+    row['adresse'] = re.sub(r"\s*\([^)]*\)", "", row['adresse'])
+    if row['adresse'].count(',') > 1:
+        row['adresse'] = f"{row['adresse'].split(',')[0]}, {row['adresse'].split(',')[-1]}"
+    return row
+
+
+def reference_clean(df):
+    df = df.apply(format_address, axis=1)
+    df['image-url-src'] = df['image-url-src'].apply(lambda x: x.split()[0] if not pd.isna(x) else None)
+
+    for col in NUMERIC_COLUMNS:
+        df[col] = df[col].apply(average_hyphenated_values)
+    df[NUMERIC_COLUMNS] = (
+        df[NUMERIC_COLUMNS]
+        .replace(r'[^\d.]', '', regex=True)
+        .apply(pd.to_numeric, errors='coerce')
+        .round(0)
+        .astype('Int64')
+    )
+
+    energimerking_parts = df['energiklasse'].str.extract(r'^([A-G]) - ([\w\s]+)$')
+    df['energiklasse'] = energimerking_parts[0]
+    df['energiklasse-farge'] = energimerking_parts[1]
+
+    df['fasiliteter'] = df['fasiliteter'].apply(
+        lambda x: (
+            [item.text for item in BeautifulSoup(x, 'html.parser').find_all('div', class_='py-4 break-words')]
+            if pd.notna(x)
+            else []
+        )
+    )
+    df['heis'] = df['fasiliteter'].apply(lambda x: 'Heis' in x)
+    df['balkong'] = df['fasiliteter'].apply(lambda x: 'Balkong/Terrasse' in x)
+    df['pris/m2'] = round(df['pris'] / df['internt-bruksareal'])
+    df['prisantydning/m2'] = round(df['prisantydning'] / df['internt-bruksareal'])
+    df['solgt'] = False
+    df['pin'] = False
+    df['gjem'] = False
+    return df
+
+
+def read_as_process_data(df):
+    """Write df to CSV and read it back, so it has the types process_data sees."""
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    buffer.seek(0)
+    return pd.read_csv(buffer)
+
+
+SAMPLES = {
+    'synthetic': lambda: read_as_process_data(make_raw_scrape(2_000, seed=3)),
+    'existing': lambda: pd.read_csv(os.path.join(ROOT, 'existing_finn_eiendom.csv')),
+    'edge_cases': lambda: pd.read_csv(io.StringIO(EDGE_CASES)),
+}
+
+
+def assert_same_as_reference(cleaned, expected):
+    # The facilities are kept as comma separated text since they are parsed without BeautifulSoup
+    expected = expected.assign(fasiliteter=expected['fasiliteter'].str.join(', '))
+    pd.testing.assert_frame_equal(cleaned[expected.columns], expected)
+
+
+@pytest.mark.parametrize('name', list(SAMPLES))
+def test_clean_dataframe_matches_row_wise_cleaning(name):
+    df = SAMPLES[name]()
+    assert_same_as_reference(clean_dataframe(df), reference_clean(df.copy()))
+
+
+def test_parallel_cleaning_matches_row_wise_cleaning(monkeypatch):
+    monkeypatch.setattr(clean_data, 'MIN_PARALLEL_ROWS', 0)
+    df = SAMPLES['synthetic']()
+    cleaned = clean_dataframe_parallel(df, workers=2, chunk_size=600)
+    assert_same_as_reference(cleaned, reference_clean(df.copy()))
+
+
+def test_process_data_with_a_one_row_delta(tmp_path):
+    # A changed listing without an energy label, facilities or image, as saved by the delta
+    delta = make_raw_scrape(1, seed=4).assign(**{'energiklasse': None, 'fasiliteter': None, 'image-url-src': None})
+    delta.to_csv(tmp_path / 'geocoded_finn-eiendom.csv', index=False)
+
+    df = clean_data.process_data(
+        str(tmp_path / 'geocoded_finn-eiendom.csv'), str(tmp_path / 'new_finn-eiendom.csv'), save_data=False
+    )
+
+    assert len(df) == 1
+    assert df[['energiklasse', 'energiklasse-farge', 'image-url-src']].isna().all(axis=None)
+    assert df.loc[0, 'fasiliteter'] == ''
+    assert not df.loc[0, 'heis']
+    assert df.loc[0, 'pris'] == int(delta.loc[0, 'pris'].removesuffix(' kr'))
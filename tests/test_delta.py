@@ -0,0 +1,41 @@
+import io
+
+import pandas as pd
+
+from delta import content_hash, split_delta
+
+EXPORT = (
+    'web-scraper-order,annonse-href,adresse,etasje,pris\n'
+    '1715256074-1,https://www.finn.no/realestate/homes/ad.html?finnkode=1,"Hovinveien 52B, 0576 Oslo",3,5900000\n'
+    '1715256074-2,https://www.finn.no/realestate/homes/ad.html?finnkode=2,"Sverdrups gate 4, 0559 Oslo",1,4500000\n'
+)
+UNRELATED_ROW = (
+    '1715256074-3,https://www.finn.no/realestate/homes/ad.html?finnkode=3,"Trondheimsveien 2, 0560 Oslo",,3900000\n'
+)
+
+
+def read_export(text):
+    return pd.read_csv(io.StringIO(text))
+
+
+def test_missing_value_in_other_row_keeps_hashes():
+    before = content_hash(read_export(EXPORT))
+    after = content_hash(read_export(EXPORT + UNRELATED_ROW))
+    # The blank etasje makes pandas read the column as floats
+    assert read_export(EXPORT + UNRELATED_ROW)['etasje'].dtype == float
+    assert after.iloc[:2].tolist() == before.tolist()
+
+
+def test_split_delta_only_returns_the_new_row():
+    previous_df = read_export(EXPORT)
+    previous_df['innhold-hash'] = content_hash(previous_df)
+
+    delta_df, carried_df = split_delta(read_export(EXPORT + UNRELATED_ROW), previous_df)
+
+    assert delta_df['annonse-href'].tolist() == ['https://www.finn.no/realestate/homes/ad.html?finnkode=3']
+    assert len(carried_df) == 2
+
+
+def test_changed_value_changes_hash():
+    changed = EXPORT.replace(',3,5900000', ',4,5900000')
+    assert content_hash(read_export(changed)).iloc[0] != content_hash(read_export(EXPORT)).iloc[0]
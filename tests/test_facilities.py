@@ -0,0 +1,29 @@
+import pandas as pd
+
+from facilities import extract_facilities, parse_facilities
+
+
+def facility(content):
+    return f'<div class="py-4 break-words">{content}</div>'
+
+
+def test_extracts_labels():
+    assert extract_facilities(facility('Heis') + facility('Hage &amp; utsikt')) == ['Heis', 'Hage & utsikt']
+    assert extract_facilities(None) == []
+
+
+def test_nested_div_does_not_cut_the_block_short():
+    html = facility('<div class="icon"></div>Heis') + facility('<div><span>Balkong/Terrasse</span></div>') + facility('Peis/Ildsted')
+    assert extract_facilities(html) == ['Heis', 'Balkong/Terrasse', 'Peis/Ildsted']
+
+
+def test_unclosed_facility_runs_to_the_end():
+    assert extract_facilities(facility('Heis') + '<div class="py-4 break-words">Hage') == ['Heis', 'Hage']
+
+
+def test_flags_facilities_after_a_nested_div():
+    fasiliteter = pd.Series([facility('<div>Heis</div>') + facility('Balkong/Terrasse'), None])
+    text, flags = parse_facilities(fasiliteter)
+    assert text.tolist() == ['Heis, Balkong/Terrasse', '']
+    assert flags['heis'].tolist() == [True, False]
+    assert flags['balkong'].tolist() == [True, False]
@@ -0,0 +1,121 @@
+import json
+
+import pandas as pd
+import pytest
+
+import clean_data
+import geocode_cache
+from clean_data import geocode_data
+from geocode_cache import GeocodeCache
+from geocoder import GeocodingEngine
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with GeocodeCache(str(tmp_path / 'geocode_cache.sqlite')) as cache:
+        yield cache
+
+
+def set_age(cache, address, days):
+    cache.conn.execute(
+        "UPDATE geocode SET updated_at = strftime('%s', 'now') - ? WHERE address = ?",
+        (days * 24 * 60 * 60, address),
+    )
+
+
+def test_key_is_the_normalized_address(cache):
+    cache.set('FAGERHEIMGATA 18,  0475 Oslo', 59.93, 10.77)
+
+    assert cache.get('Fagerheimgata 18, 0475 Oslo') == (59.93, 10.77)
+    assert cache.get('Fagerheimgata 18 (Byggetrinn 2), Rodeløkka, 0475 Oslo') == (59.93, 10.77)
+    assert cache.get('Fagerheimgata 19, 0475 Oslo') is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_misses_are_cached(cache):
+    cache.set('Finnes ikke 1, 0000 Oslo', None, None)
+    assert cache.get('Finnes ikke 1, 0000 Oslo') == (None, None)
+
+
+def test_entries_expire(cache):
+    cache.set('Fagerheimgata 18, 0475 Oslo', 59.93, 10.77)
+    cache.set('Finnes ikke 1, 0000 Oslo', None, None)
+    set_age(cache, 'finnes ikke 1, 0000 oslo', geocode_cache.MISS_TTL_DAYS + 1)
+    set_age(cache, 'fagerheimgata 18, 0475 oslo', geocode_cache.MISS_TTL_DAYS + 1)
+
+    # Hits are kept a lot longer than misses
+    assert cache.get('Finnes ikke 1, 0000 Oslo') is None
+    assert cache.get('Fagerheimgata 18, 0475 Oslo') == (59.93, 10.77)
+
+    set_age(cache, 'fagerheimgata 18, 0475 oslo', geocode_cache.HIT_TTL_DAYS + 1)
+    assert cache.get('Fagerheimgata 18, 0475 Oslo') is None
+
+    cache.prune()
+    assert len(cache) == 0
+
+
+def test_prune_keeps_the_newest_entries(tmp_path):
+    with GeocodeCache(str(tmp_path / 'geocode_cache.sqlite'), max_entries=3) as cache:
+        for number in range(5):
+            cache.set(f'Thorvald Meyers gate {number}, 0555 Oslo', 59.92, 10.76)
+            set_age(cache, f'thorvald meyers gate {number}, 0555 oslo', 5 - number)
+        cache.prune()
+
+        assert len(cache) == 3
+        assert cache.get('Thorvald Meyers gate 1, 0555 Oslo') is None
+        assert cache.get('Thorvald Meyers gate 4, 0555 Oslo') == (59.92, 10.76)
+
+
+def test_preload_existing(cache, tmp_path):
+    pd.DataFrame(
+        {
+            'adresse': ['Hovinveien 52B, 0576 Oslo', 'Sverdrups gate 4, 0559 Oslo', None],
+            'latitude': [59.922321, None, 59.9],
+            'longitude': [10.791916, None, 10.7],
+        }
+    ).to_csv(tmp_path / 'geocoded_finn-eiendom.csv', index=False)
+    feature = {
+        'type': 'Feature',
+        'properties': {'adresse': 'Bjerkelundgata 1, 0553 Oslo'},
+        'geometry': {'type': 'Point', 'coordinates': [10.771, 59.927]},
+    }
+    with open(tmp_path / 'merged_finn_eiendom.geojson', 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [feature]}, f)
+    cache.set('Hovinveien 52B, 0576 Oslo', 59.0, 10.0)
+
+    # Only new addresses with coordinates are added, and cached entries are kept
+    assert cache.preload_existing(str(tmp_path)) == 1
+    assert cache.get('Bjerkelundgata 1, 0553 Oslo') == (59.927, 10.771)
+    assert cache.get('Hovinveien 52B, 0576 Oslo') == (59.0, 10.0)
+    assert cache.get('Sverdrups gate 4, 0559 Oslo') is None
+
+
+class StubBackend:
+    def __init__(self):
+        self.addresses = []
+
+    def geocode(self, address):
+        self.addresses.append(address)
+        return 59.92, 10.76
+
+
+def test_geocode_data_skips_rows_without_address(tmp_path, monkeypatch):
+    monkeypatch.setattr(clean_data, 'get_address_index', lambda: None)
+    monkeypatch.setattr(geocode_cache, 'PATH_ROOT', str(tmp_path))
+    pd.DataFrame({'adresse': ['Hovinveien 52B, 0576 Oslo', None, '  '], 'pris': [1, 2, 3]}).to_csv(
+        tmp_path / 'finn-eiendom.csv', index=False
+    )
+    backend = StubBackend()
+
+    geocode_data(
+        str(tmp_path / 'finn-eiendom.csv'),
+        str(tmp_path / 'geocoded_finn-eiendom.csv'),
+        cache_path=str(tmp_path / 'geocode_cache.sqlite'),
+        engine=GeocodingEngine(backend, rate=1000.0),
+    )
+
+    geocoded = pd.read_csv(tmp_path / 'geocoded_finn-eiendom.csv')
+    assert backend.addresses == ['Hovinveien 52B, 0576 Oslo']
+    assert geocoded.loc[0, ['latitude', 'longitude']].tolist() == [59.92, 10.76]
+    assert geocoded.loc[1:, ['latitude', 'longitude']].isna().all(axis=None)
+    assert geocoded['pris'].tolist() == [1, 2, 3]
@@ -0,0 +1,109 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from geocoder import create_engine
+
+
+class StubNominatim(BaseHTTPRequestHandler):
+    """Answers /search like Nominatim, from the responses queued on the server for each address."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        address = params.get('q', [''])[0]
+        server = self.server
+        with server.lock:
+            server.requests.append((time.monotonic(), url.path, params))
+            queued = server.responses.get(address)
+            status, body = queued.pop(0) if queued else (200, [])
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNominatim)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.responses = {}
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stub_engine(server, rate=1000.0, concurrency=1, retries=2):
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    return create_engine('local-nominatim', url=url, rate=rate, concurrency=concurrency, retries=retries, backoff=0.01)
+
+
+def test_parses_results(stub_server):
+    stub_server.responses['Hovinveien 52B, 0576 Oslo'] = [(200, [{'lat': '59.922321', 'lon': '10.791916'}])]
+    engine = stub_engine(stub_server)
+
+    assert engine.geocode('Hovinveien 52B, 0576 Oslo') == (59.922321, 10.791916)
+    assert engine.geocode('Finnes ikke 1, 0000 Oslo') is None
+    _, path, params = stub_server.requests[0]
+    assert path == '/search'
+    assert params['format'] == ['jsonv2']
+    assert params['limit'] == ['1']
+
+
+def test_retries_temporary_errors(stub_server):
+    stub_server.responses['Hovinveien 52B, 0576 Oslo'] = [
+        (503, {}),
+        (429, {}),
+        (200, [{'lat': '59.922321', 'lon': '10.791916'}]),
+    ]
+    engine = stub_engine(stub_server)
+
+    assert engine.geocode('Hovinveien 52B, 0576 Oslo') == (59.922321, 10.791916)
+    assert len(stub_server.requests) == 3
+
+
+def test_gives_up_after_retries(stub_server):
+    stub_server.responses['Hovinveien 52B, 0576 Oslo'] = [(503, {})] * 3
+    engine = stub_engine(stub_server, retries=1)
+
+    results = engine.geocode_many(['Hovinveien 52B, 0576 Oslo'])
+
+    assert isinstance(results['Hovinveien 52B, 0576 Oslo'], requests.HTTPError)
+    assert len(stub_server.requests) == 2
+
+
+def test_does_not_retry_client_errors(stub_server):
+    stub_server.responses['Hovinveien 52B, 0576 Oslo'] = [(400, {})]
+    engine = stub_engine(stub_server)
+
+    with pytest.raises(requests.HTTPError):
+        engine.geocode('Hovinveien 52B, 0576 Oslo')
+    assert len(stub_server.requests) == 1
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_rate_limits_requests(stub_server, concurrency):
+    addresses = [f'Thorvald Meyers gate {number}, 0555 Oslo' for number in range(8)]
+    for address in addresses:
+        stub_server.responses[address] = [(200, [{'lat': '59.92', 'lon': '10.76'}])]
+    engine = stub_engine(stub_server, rate=20.0, concurrency=concurrency)
+
+    results = engine.geocode_many(addresses)
+
+    assert results == {address: (59.92, 10.76) for address in addresses}
+    times = sorted(request_time for request_time, _, _ in stub_server.requests)
+    # The bucket holds one token, so the 8 requests take at least 7 intervals of 1/20 s
+    assert times[-1] - times[0] >= 7 / 20 * 0.9
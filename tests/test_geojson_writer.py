@@ -0,0 +1,78 @@
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import make_listings
+from geojson_writer import write_feature_collection
+
+
+@pytest.fixture
+def listings():
+    return pd.DataFrame(
+        {
+            'annonse-href': ['https://www.finn.no/realestate/homes/ad.html?finnkode=1', 'b', None],
+            'pris': pd.array([5_900_000, None, 3], dtype='Int64'),
+            'pris/m2': [89394.0, np.nan, 1.5],
+            'heis': pd.array([True, None, False], dtype='boolean'),
+            'adresse': ['Hovinveien 52B, 0576 Oslo', 'Æøå "sitat" \\ \n', np.nan],
+            'first-seen': ['2024-05-09 14:06:47', None, '2024-05-10 09:00:00'],
+            'latitude': [59.922321, 59.9, 59.8],
+            'longitude': [10.791916, 10.7, 10.6],
+        }
+    )
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_output_is_byte_for_byte_reproducible(tmp_path):
+    df = make_listings(2_000, seed=5)
+    write_feature_collection(df, tmp_path / 'first.geojson')
+    write_feature_collection(df.copy(), tmp_path / 'second.geojson', chunk_size=333)
+
+    assert read(tmp_path / 'first.geojson') == read(tmp_path / 'second.geojson')
+    assert len(json.loads(read(tmp_path / 'first.geojson'))['features']) == 2_000
+
+
+def test_matches_geopandas(listings, tmp_path):
+    geopandas = pytest.importorskip('geopandas')
+    gdf = geopandas.GeoDataFrame(listings, geometry=geopandas.points_from_xy(listings.longitude, listings.latitude))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        gdf.to_file(tmp_path / 'geopandas.geojson', driver='GeoJSON')
+    write_feature_collection(listings, tmp_path / 'writer.geojson')
+
+    expected = json.loads(read(tmp_path / 'geopandas.geojson'))['features']
+    features = json.loads(read(tmp_path / 'writer.geojson'))['features']
+    assert features == expected
+    # Missing values of every type are null, and Int64 columns are numbers
+    assert [feature['properties']['pris'] for feature in features] == [5_900_000, None, 3]
+    assert [feature['properties']['heis'] for feature in features] == [True, None, False]
+    assert features[2]['properties']['adresse'] is None
+
+
+def test_formatted_like_gdal(listings, tmp_path):
+    write_feature_collection(listings.iloc[:1], tmp_path / 'writer.geojson')
+
+    assert read(tmp_path / 'writer.geojson').decode('utf-8') == (
+        '{\n"type": "FeatureCollection",\n"features": [\n'
+        '{ "type": "Feature", "properties": { '
+        '"annonse-href": "https://www.finn.no/realestate/homes/ad.html?finnkode=1", "pris": 5900000, '
+        '"pris/m2": 89394, "heis": true, "adresse": "Hovinveien 52B, 0576 Oslo", '
+        '"first-seen": "2024-05-09 14:06:47", "latitude": 59.922321, "longitude": 10.791916 }, '
+        '"geometry": { "type": "Point", "coordinates": [ 10.791916, 59.922321 ] } }'
+        '\n]\n}\n'
+    )
+
+
+def test_object_booleans_are_json_booleans(listings, tmp_path):
+    # geopandas wrote these as the strings "True" and "False"
+    write_feature_collection(listings.assign(solgt=[True, False, None]), tmp_path / 'writer.geojson')
+
+    features = json.loads(read(tmp_path / 'writer.geojson'))['features']
+    assert [feature['properties']['solgt'] for feature in features] == [True, False, None]
@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from geojson_writer import write_change_set
+from merge import build_change_set, upsert_listings
+
+URL = 'https://www.finn.no/realestate/homes/ad.html?finnkode={}'
+
+
+def listings(rows):
+    """A dataset from (finnkode, pris, etasje) tuples, with the columns the merge looks at."""
+    df = pd.DataFrame(rows, columns=['finnkode', 'pris', 'etasje'])
+    df['annonse-href'] = [URL.format(finnkode) for finnkode in df.pop('finnkode')]
+    df['latitude'] = 59.92
+    df['longitude'] = 10.76
+    return df
+
+
+@pytest.fixture
+def existing_df():
+    df = listings([(1, 5_900_000, 2), (2, 4_500_000, 1), (3, 3_900_000, 4)])
+    df['first-seen'] = ['2024-05-01 10:00:00', '2024-05-02 10:00:00', '2024-05-03 10:00:00']
+    df['pin'] = [True, False, False]
+    df['gjem'] = [False, True, False]
+    df['solgt'] = False
+    return df
+
+
+def merge(existing_df, new_df):
+    merged_df, status = upsert_listings(existing_df, new_df)
+    return merged_df.set_index('annonse-href'), status.set_axis(merged_df['annonse-href'])
+
+
+def test_new_listing_is_added(existing_df):
+    new_df = listings([(1, 5_900_000, 2), (2, 4_500_000, 1), (3, 3_900_000, 4), (4, 6_100_000, 3)])
+    merged_df, status = merge(existing_df, new_df)
+
+    assert status[URL.format(4)] == 'new'
+    assert merged_df.loc[URL.format(4), 'pris'] == 6_100_000
+    assert not merged_df.loc[URL.format(4), 'solgt']
+    # A new listing is first seen now
+    assert pd.notna(merged_df.loc[URL.format(4), 'first-seen'])
+    assert list(merged_df.index) == [URL.format(finnkode) for finnkode in (1, 2, 3, 4)]
+
+
+def test_changed_listing_takes_the_new_values(existing_df):
+    new_df = listings([(1, 5_500_000, 2), (2, 4_500_000, 1), (3, 3_900_000, 4)])
+    merged_df, status = merge(existing_df, new_df)
+
+    assert status[URL.format(1)] == 'updated'
+    assert merged_df.loc[URL.format(1), 'pris'] == 5_500_000
+    assert (status.drop(URL.format(1)) == 'unchanged').all()
+
+
+def test_missing_new_value_does_not_overwrite(existing_df):
+    new_df = listings([(1, 5_500_000, None), (2, 4_500_000, 1), (3, 3_900_000, 4)])
+    merged_df, _ = merge(existing_df, new_df)
+
+    assert merged_df.loc[URL.format(1), 'etasje'] == 2
+
+
+def test_unchanged_listing_is_kept_as_it_is(existing_df):
+    new_df = listings([(1, 5_900_000, 2), (2, 4_500_000, 1), (3, 3_900_000, 4)])
+    merged_df, status = merge(existing_df, new_df)
+
+    assert (status == 'unchanged').all()
+    pd.testing.assert_frame_equal(
+        merged_df.reset_index()[existing_df.columns], existing_df, check_dtype=False
+    )
+
+
+def test_disappeared_listing_is_marked_as_sold(existing_df):
+    new_df = listings([(1, 5_900_000, 2), (2, 4_500_000, 1)])
+    merged_df, status = merge(existing_df, new_df)
+
+    assert status[URL.format(3)] == 'disappeared'
+    assert merged_df['solgt'].tolist() == [False, False, True]
+    # The listing is kept with its last values
+    assert merged_df.loc[URL.format(3), 'pris'] == 3_900_000
+
+    # Once sold, it stays unchanged while it is missing
+    merged_again, status_again = merge(merged_df.reset_index(), new_df)
+    assert status_again[URL.format(3)] == 'unchanged'
+    assert merged_again.loc[URL.format(3), 'solgt']
+
+
+def test_sold_listing_that_comes_back_is_for_sale_again(existing_df):
+    existing_df['solgt'] = [False, False, True]
+    new_df = listings([(1, 5_900_000, 2), (2, 4_500_000, 1), (3, 3_900_000, 4)])
+    merged_df, status = merge(existing_df, new_df)
+
+    assert status[URL.format(3)] == 'updated'
+    assert not merged_df['solgt'].any()
+
+
+def test_user_columns_keep_their_existing_values(existing_df):
+    new_df = listings([(1, 5_500_000, 2), (2, 4_000_000, 1), (3, 3_900_000, 4)])
+    new_df['first-seen'] = '2024-06-01 10:00:00'
+    new_df['pin'] = False
+    new_df['gjem'] = False
+    merged_df, status = merge(existing_df, new_df)
+
+    assert (status[[URL.format(1), URL.format(2)]] == 'updated').all()
+    assert merged_df['first-seen'].tolist() == existing_df['first-seen'].tolist()
+    assert merged_df['pin'].tolist() == [True, False, False]
+    assert merged_df['gjem'].tolist() == [False, True, False]
+
+
+def test_empty_scrape_does_not_mark_everything_as_sold(existing_df):
+    merged_df, status = merge(existing_df, listings([]))
+
+    assert (status == 'unchanged').all()
+    assert not merged_df['solgt'].any()
+    assert np.array_equal(merged_df['pris'].to_numpy(dtype=int), existing_df['pris'].to_numpy())
+
+
+def test_listings_with_content_hashes_are_compared_by_hash(existing_df):
+    existing_df['innhold-hash'] = ['a', 'b', 'c']
+    # The price of 2 differs, but its hash says the scraped content is the same
+    new_df = listings([(1, 5_900_000, 2), (2, 4_000_000, 1), (3, 3_900_000, 4)])
+    new_df['innhold-hash'] = ['x', 'b', 'c']
+    _, status = merge(existing_df, new_df)
+
+    assert status.tolist() == ['updated', 'unchanged', 'unchanged']
+
+
+@pytest.mark.parametrize('published_columns', ['all', 'without first-seen'])
+def test_change_set_has_only_the_changed_price(existing_df, tmp_path, published_columns):
+    # A live dataset from before first-seen was added has it backfilled by the merge
+    published_df = existing_df if published_columns == 'all' else existing_df.drop(columns='first-seen')
+    new_df = listings([(1, 5_900_000, 2), (2, 4_250_000, 1), (3, 3_900_000, 4)])
+    merged_df, _ = upsert_listings(published_df, new_df)
+
+    write_change_set(build_change_set(published_df, merged_df), tmp_path / 'changes.json')
+
+    with open(tmp_path / 'changes.json') as f:
+        changes = json.load(f)
+    assert changes['added'] == [] and changes['removed'] == []
+    [feature] = changes['updated']
+    assert feature['properties'] == {'annonse-href': URL.format(2), 'pris': 4_250_000}
@@ -0,0 +1,101 @@
+import os
+
+import pandas as pd
+import pytest
+
+from benchmark import make_listings
+from geojson_writer import write_feature_collection
+from snapshots import SnapshotStore
+
+DAY = pd.Timedelta(days=1)
+START = pd.Timestamp('2024-08-01 12:00')
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def datasets(tmp_path):
+    """Five downloads of a dataset, each with the price of a few more listings changed."""
+    df = make_listings(500, seed=7)
+    paths = []
+    for number in range(5):
+        df.loc[number * 10 : number * 10 + 9, 'pris'] += 100_000
+        paths.append(tmp_path / f'download_{number}.geojson')
+        write_feature_collection(df, paths[-1])
+    return paths
+
+
+@pytest.fixture(params=['full', 'deltas'])
+def store(request, tmp_path):
+    return SnapshotStore(str(tmp_path / 'old_datasets'), codec='gzip', deltas=request.param == 'deltas')
+
+
+def add_daily(store, datasets):
+    return [store.add(path, START + number * DAY) for number, path in enumerate(datasets)]
+
+
+def test_restore_as_of_is_byte_for_byte(store, datasets, tmp_path):
+    add_daily(store, datasets)
+
+    for number, path in enumerate(datasets):
+        store.restore(tmp_path / 'restored.geojson', as_of=START + number * DAY + pd.Timedelta(hours=1))
+        assert read(tmp_path / 'restored.geojson') == read(path)
+
+    store.restore(tmp_path / 'restored.geojson')
+    assert read(tmp_path / 'restored.geojson') == read(datasets[-1])
+    with pytest.raises(FileNotFoundError):
+        store.restore(tmp_path / 'restored.geojson', as_of=START - DAY)
+
+
+def test_deltas_only_store_the_changed_features(datasets, tmp_path):
+    full = SnapshotStore(str(tmp_path / 'full'), codec='gzip', deltas=False)
+    deltas = SnapshotStore(str(tmp_path / 'deltas'), codec='gzip', deltas=True)
+    add_daily(full, datasets)
+    entries = add_daily(deltas, datasets)
+
+    assert [entry['base'] for entry in entries] == [None] + [entry['id'] for entry in entries[:-1]]
+    last_object = lambda store: os.path.getsize(store._object_path(store.snapshots[-1]))
+    assert last_object(deltas) < last_object(full) / 5
+
+
+def test_identical_downloads_are_stored_once(store, datasets):
+    store.add(datasets[0], START)
+    store.add(datasets[0], START + DAY)
+
+    assert len(store.snapshots) == 2
+    assert len(os.listdir(store.objects_path)) == 1
+
+
+def test_prune_keeps_the_newest_snapshot_of_each_day(store, datasets, tmp_path):
+    entries = add_daily(store, datasets)
+    # A second download on the last day replaces the first one
+    entries.append(store.add(datasets[0], START + 4 * DAY + pd.Timedelta(hours=6)))
+
+    removed = store.prune(keep_daily=2, keep_weekly=0, now=START + 4 * DAY + pd.Timedelta(hours=7))
+
+    assert removed == 4
+    assert [snapshot['id'] for snapshot in store.snapshots] == [entries[3]['id'], entries[5]['id']]
+    assert sorted(os.listdir(store.objects_path)) == sorted(snapshot['object'] for snapshot in store.snapshots)
+    # The kept snapshots are restored exactly, also if their base was pruned
+    reopened = SnapshotStore(store.path)
+    reopened.restore(tmp_path / 'restored.geojson', as_of=START + 3 * DAY)
+    assert read(tmp_path / 'restored.geojson') == read(datasets[3])
+    reopened.restore(tmp_path / 'restored.geojson')
+    assert read(tmp_path / 'restored.geojson') == read(datasets[0])
+
+
+def test_import_files(store, datasets):
+    # Earlier versions named the backups after the time they were downloaded
+    os.replace(datasets[0], f'{store.path}/existing_finn_eiendom_2024-07-01 10:30:00.123456.geojson')
+    os.replace(datasets[1], f'{store.path}/existing_finn_eiendom_2024-07-02 09:00:00.654321.geojson')
+
+    store.import_files(f'{store.path}/existing_finn_eiendom_*.geojson', delete=True)
+
+    assert [snapshot['created'] for snapshot in store.snapshots] == [
+        '2024-07-01T10:30:00.123456',
+        '2024-07-02T09:00:00.654321',
+    ]
+    assert not [name for name in os.listdir(store.path) if name.endswith('.geojson')]
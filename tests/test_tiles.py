@@ -0,0 +1,59 @@
+import glob
+import json
+
+import pandas as pd
+import pytest
+
+from tiles import MAX_POINT_ZOOM, export_tiles
+
+
+def listings(longitudes, latitude=59.92):
+    n = len(longitudes)
+    return pd.DataFrame(
+        {
+            'latitude': [latitude] * n,
+            'longitude': longitudes,
+            'annonse-href': [f'https://www.finn.no/realestate/homes/ad.html?finnkode={i}' for i in range(n)],
+            'pris': [5_900_000] * n,
+            'pris/m2': [89_394.0] * n,
+            'solgt': [False] * n,
+            'pin': [False] * n,
+        }
+    )
+
+
+def read_tiles(path, zoom):
+    tiles = {}
+    for tile_path in glob.glob(f'{path}/{zoom}/*/*.geojson'):
+        with open(tile_path) as f:
+            tiles[tile_path.removeprefix(f'{path}/')] = json.load(f)
+    return tiles
+
+
+def test_listings_next_to_a_tile_edge_stay_in_their_tile(tmp_path):
+    # 3e-7 degrees, about 2 cm, either side of the west edge of the tiles with x=4339 at zoom 13
+    edge = 4339 / 2**13 * 360 - 180
+    written, _ = export_tiles(listings([edge - 3e-7, edge + 3e-7]), str(tmp_path), min_zoom=12, point_zoom=13)
+
+    tiles = read_tiles(tmp_path, 13)
+    assert sorted(tiles) == ['13/4338/2382.geojson', '13/4339/2382.geojson']
+    assert all(tile['antall'] == len(tile['features']) == 1 for tile in tiles.values())
+    assert written == 3
+
+
+def test_every_listing_is_in_one_tile_per_zoom(tmp_path):
+    longitudes = [10.70 + i * 0.0037 for i in range(60)]
+    export_tiles(listings(longitudes), str(tmp_path), min_zoom=8, point_zoom=13)
+
+    points = read_tiles(tmp_path, 13)
+    assert sum(len(tile['features']) for tile in points.values()) == 60
+    for zoom in range(8, 13):
+        clusters = read_tiles(tmp_path, zoom)
+        assert sum(feature['properties']['antall'] for tile in clusters.values() for feature in tile['features']) == 60
+
+
+@pytest.mark.parametrize('min_zoom, point_zoom', [(8, MAX_POINT_ZOOM + 1), (14, 13), (-1, 13)])
+def test_zooms_out_of_range_are_rejected(tmp_path, min_zoom, point_zoom):
+    with pytest.raises(ValueError):
+        export_tiles(listings([10.75]), str(tmp_path), min_zoom=min_zoom, point_zoom=point_zoom)
+    assert not glob.glob(f'{tmp_path}/*')
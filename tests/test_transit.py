@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from projection import wgs84_to_utm
+from transit import MODE_COLUMNS, ZONE, TransitIndex, add_transit_distances
+
+
+def stop_index(stops):
+    """A TransitIndex with one stop at (latitude, longitude) for each mode in stops."""
+    projected = {}
+    for mode in MODE_COLUMNS:
+        latitudes, longitudes = ([stops[mode][0]], [stops[mode][1]]) if mode in stops else ([], [])
+        projected[mode] = wgs84_to_utm(np.array(latitudes), np.array(longitudes), ZONE)
+    return TransitIndex(projected, source='test')
+
+
+def test_replaces_every_scraped_distance(tmp_path):
+    index = stop_index({'tbane': (59.9226, 10.7927), 'buss': (59.9220, 10.7900)})
+    df = pd.DataFrame(
+        {
+            'latitude': [59.922321, np.nan],
+            'longitude': [10.791916, np.nan],
+            'avstand-tbane': [7.0, 5.0],
+            'avstand-trikk': [426.0, 300.0],
+            'avstand-buss': [2202.0, 4.0],
+        }
+    )
+
+    df = add_transit_distances(df, index, cache_path=str(tmp_path / 'distances.pkl'))
+
+    assert 40 < df.loc[0, 'avstand-tbane'] < 60
+    assert 100 < df.loc[0, 'avstand-buss'] < 120
+    # No tram stops in the file and no coordinates: no scraped value is kept
+    assert df['avstand-trikk'].isna().all()
+    assert df.loc[1, ['avstand-tbane', 'avstand-buss']].isna().all()
@@ -0,0 +1,221 @@
+import os
+import glob
+import json
+import argparse
+import numpy as np
+
+from geojson_writer import encode_features
+from paths import TILES_PATH
+from store import read_master
+
+# The properties of the listings in the point tiles
+TILE_COLUMNS = ['annonse-href', 'pris', 'pris/m2', 'solgt', 'pin']
+
+# Tiles below POINT_ZOOM hold clusters, tiles at POINT_ZOOM the listings. Map clients
+# show the point tiles at higher zoom levels too, so no tiles are needed above it.
+MIN_ZOOM = 8
+POINT_ZOOM = 13
+
+# Clusters are made on a grid of 2^CLUSTER_BITS by 2^CLUSTER_BITS cells in each tile
+CLUSTER_BITS = 3
+
+# The listings are sorted along a Hilbert curve on a 2^HILBERT_ORDER grid over the world.
+# It is finer than any tile or cluster cell, so the listings in every tile and cell end
+# up next to each other.
+HILBERT_ORDER = 20
+
+# The clusters of the zoom below POINT_ZOOM need cells of 2^CLUSTER_BITS pixels on that grid
+MAX_POINT_ZOOM = HILBERT_ORDER - CLUSTER_BITS
+
+MAX_LATITUDE = 85.0511287798
+
+
+def web_mercator_pixels(latitudes, longitudes, zoom):
+    """Get the x and y of the Web Mercator grid of 2^zoom by 2^zoom cells each point is in."""
+    size = 2**zoom
+    latitudes = np.radians(np.clip(latitudes, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitudes, dtype=float) + 180) / 360 * size
+    y = (1 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2 * size
+    return np.clip(x, 0, size - 1).astype(np.int64), np.clip(y, 0, size - 1).astype(np.int64)
+
+
+def hilbert_index(x, y, order=HILBERT_ORDER):
+    """
+    Get the position of each cell (x, y) of a 2^order grid along the Hilbert curve. The
+    cells of a quadtree tile at zoom z are one run of the curve, starting at the position
+    of the tile on the curve at that zoom, so index >> 2 * (order - z) is the same for all
+    of them.
+    """
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    index = np.zeros(len(x), dtype=np.int64)
+    size = 1 << order
+    s = size >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve continues where it left off
+        flip = rx & ~ry
+        x = np.where(flip, size - 1 - x, x)
+        y = np.where(flip, size - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return index
+
+
+def _runs(keys):
+    """Get the start and end of every run of equal values in sorted keys."""
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return starts, np.r_[starts[1:], len(keys)]
+
+
+def _cluster_features(df, order_index, zoom):
+    """
+    Encode the clusters of the listings in df, which are sorted along the Hilbert curve,
+    at zoom. Returns the row of the first listing in each cluster and the features.
+    """
+    starts, ends = _runs(order_index >> 2 * (HILBERT_ORDER - zoom - CLUSTER_BITS))
+    counts = ends - starts
+    longitudes = np.add.reduceat(df['longitude'].to_numpy(dtype=float), starts) / counts
+    latitudes = np.add.reduceat(df['latitude'].to_numpy(dtype=float), starts) / counts
+    sold = df['solgt'].astype('boolean').fillna(False).to_numpy(dtype=bool)
+    unsold = np.add.reduceat(~sold, starts)
+    features = [
+        f'{{"type":"Feature","properties":{{"antall":{count},"antall-usolgt":{unsold_count}}},'
+        f'"geometry":{{"type":"Point","coordinates":[{longitude:.6f},{latitude:.6f}]}}}}'
+        for count, unsold_count, longitude, latitude in zip(counts, unsold, longitudes, latitudes)
+    ]
+    return starts, features
+
+
+def _tile_texts(df, order_index, pixels, zoom, point_zoom, point_features):
+    """
+    Yield the x, y and text of each tile at zoom. pixels are the x and y of each listing
+    on the HILBERT_ORDER grid the curve was made from.
+    """
+    starts, ends = _runs(order_index >> 2 * (HILBERT_ORDER - zoom))
+    # The tile of the first listing in each run. Taken from the same pixels as the curve,
+    # so a listing right at the edge of a tile is not put in its neighbour.
+    x, y = pixels[0][starts] >> (HILBERT_ORDER - zoom), pixels[1][starts] >> (HILBERT_ORDER - zoom)
+    if zoom >= point_zoom:
+        feature_rows, features = np.arange(len(df)), point_features
+    else:
+        feature_rows, features = _cluster_features(df, order_index, zoom)
+    # Clusters never span tiles, so the features of each tile are one slice as well
+    bounds = np.searchsorted(feature_rows, np.r_[starts, len(df)])
+    for i in range(len(starts)):
+        text = (
+            f'{{"type":"FeatureCollection","antall":{ends[i] - starts[i]},"features":['
+            + ','.join(features[bounds[i] : bounds[i + 1]])
+            + ']}\n'
+        )
+        yield int(x[i]), int(y[i]), text
+
+
+def _write_if_changed(path, text):
+    """Write text to path unless it already has that content. Returns True if it was written."""
+    data = text.encode('utf-8')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def export_tiles(df=None, output_path=None, min_zoom=MIN_ZOOM, point_zoom=POINT_ZOOM, master_path=None):
+    """
+    Write the listings as GeoJSON tiles in output_path/{z}/{x}/{y}.geojson, so a map only
+    has to fetch the tiles in view. Tiles below point_zoom hold clusters with the number
+    of listings (antall) and unsold listings (antall-usolgt) in each cell of an 8 by 8 grid,
+    tiles at point_zoom the listings with only the TILE_COLUMNS. Every tile has the total
+    number of listings in it as antall. The listings are read from the master dataset at
+    master_path unless df is given.
+
+    Only tiles whose content changed are written, and tiles that are now empty are
+    deleted, so syncing the tiles to a web server only copies what changed. Returns the
+    number of tiles written and deleted.
+    """
+    if not 0 <= min_zoom <= point_zoom <= MAX_POINT_ZOOM:
+        raise ValueError(
+            f"Expected 0 <= min_zoom <= point_zoom <= {MAX_POINT_ZOOM}, got {min_zoom} and {point_zoom}."
+        )
+    output_path = output_path or TILES_PATH
+    if df is None:
+        df = read_master(master_path, columns=['latitude', 'longitude', *TILE_COLUMNS])
+        if df is None:
+            print("No master dataset yet. Skipping the map tiles.")
+            return 0, 0
+    df = df.dropna(subset=['latitude', 'longitude'])
+    df = df[[col for col in ['latitude', 'longitude', *TILE_COLUMNS] if col in df.columns]]
+
+    x, y = web_mercator_pixels(
+        df['latitude'].to_numpy(dtype=float), df['longitude'].to_numpy(dtype=float), HILBERT_ORDER
+    )
+    order_index = hilbert_index(x, y)
+    order = np.argsort(order_index, kind='stable')
+    df = df.iloc[order].reset_index(drop=True)
+    order_index = order_index[order]
+    pixels = (x[order], y[order])
+    # The coordinates are rounded to about 10 cm when encoded, which keeps the tiles small
+    point_features = encode_features(
+        df.assign(latitude=df['latitude'].astype(float).round(6), longitude=df['longitude'].astype(float).round(6)),
+        [col for col in TILE_COLUMNS if col in df.columns],
+        compact=True,
+    )
+
+    tile_paths = set()
+    written = 0
+    for zoom in range(min_zoom, point_zoom + 1):
+        for tile_x, tile_y, text in _tile_texts(df, order_index, pixels, zoom, point_zoom, point_features):
+            path = f'{output_path}/{zoom}/{tile_x}/{tile_y}.geojson'
+            tile_paths.add(path)
+            written += _write_if_changed(path, text)
+
+    deleted = 0
+    for path in glob.glob(f'{output_path}/*/*/*.geojson'):
+        if path not in tile_paths:
+            os.remove(path)
+            deleted += 1
+
+    metadata = {
+        'tilejson': '3.0.0',
+        'tiles': ['{z}/{x}/{y}.geojson'],
+        'minzoom': min_zoom,
+        'maxzoom': point_zoom,
+        'bounds': [
+            round(float(df['longitude'].min()), 6),
+            round(float(df['latitude'].min()), 6),
+            round(float(df['longitude'].max()), 6),
+            round(float(df['latitude'].max()), 6),
+        ] if len(df) else None,
+        'antall': len(df),
+        'fields': [col for col in TILE_COLUMNS if col in df.columns],
+        'cluster_fields': ['antall', 'antall-usolgt'],
+    }
+    _write_if_changed(f'{output_path}/tiles.json', json.dumps(metadata, indent=1, ensure_ascii=False))
+    print(f"Wrote {written} map tiles to {output_path}, {len(tile_paths) - written} unchanged, {deleted} deleted.")
+    return written, deleted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the master dataset as map tiles.")
+    parser.add_argument('--output', default=TILES_PATH, help="Directory to write the tiles to")
+    parser.add_argument('--min-zoom', type=int, default=MIN_ZOOM, choices=range(MAX_POINT_ZOOM + 1), metavar='ZOOM')
+    parser.add_argument(
+        '--point-zoom',
+        type=int,
+        default=POINT_ZOOM,
+        choices=range(MAX_POINT_ZOOM + 1),
+        metavar='ZOOM',
+        help=f"Zoom of the tiles with the listings, at most {MAX_POINT_ZOOM}",
+    )
+    args = parser.parse_args()
+    if args.min_zoom > args.point_zoom:
+        parser.error("--min-zoom cannot be above --point-zoom")
+    export_tiles(output_path=args.output, min_zoom=args.min_zoom, point_zoom=args.point_zoom)
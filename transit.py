@@ -0,0 +1,250 @@
+import os
+import glob
+import pickle
+import numpy as np
+import shapely
+from dotenv import load_dotenv
+
+from projection import wgs84_to_utm
+from metrics import get_metrics
+
+load_dotenv()
+
+PATH_ROOT = os.getenv('PATH_ROOT')
+
+# EPSG:25832, the same projection as the postal code areas
+ZONE = 32
+
+# The distance columns and the modes they are computed for
+MODE_COLUMNS = {
+    'tbane': 'avstand-tbane',
+    'trikk': 'avstand-trikk',
+    'buss': 'avstand-buss',
+}
+
+# GTFS route types of each mode, both the basic ones and the extended ones used by Entur
+ROUTE_TYPES = {
+    'tbane': {1, *range(400, 500)},
+    'trikk': {0, *range(900, 1000)},
+    'buss': {3, 11, *range(700, 800)},
+}
+
+# Names of the modes in stop files that have a mode column instead of GTFS route types
+MODE_NAMES = {
+    'tbane': 'tbane',
+    't-bane': 'tbane',
+    'metro': 'tbane',
+    'subway': 'tbane',
+    'trikk': 'trikk',
+    'tram': 'trikk',
+    'buss': 'buss',
+    'bus': 'buss',
+}
+
+STOP_TIMES_CHUNK_SIZE = 1_000_000
+
+
+class TransitIndex:
+    """
+    Stop points of each mode in UTM, with an STRtree per mode, for finding the distance
+    from many points to the nearest stop of each mode in one query per mode.
+    """
+
+    def __init__(self, stops, zone=ZONE, source=None):
+        self.stops = stops
+        self.zone = zone
+        self.source = source
+        self.trees = {
+            mode: shapely.STRtree(shapely.points(eastings, northings))
+            for mode, (eastings, northings) in stops.items()
+            if len(eastings)
+        }
+
+    def __len__(self):
+        return sum(len(eastings) for eastings, _ in self.stops.values())
+
+    def nearest(self, latitudes, longitudes):
+        """
+        Get the distance in metres from each point to the nearest stop of each mode, by
+        mode. Distances are NaN for points without coordinates and modes without stops.
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        valid = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        eastings, northings = wgs84_to_utm(latitudes[valid], longitudes[valid], self.zone)
+        points = shapely.points(eastings, northings)
+
+        distances = {}
+        for mode in MODE_COLUMNS:
+            distances[mode] = np.full(len(latitudes), np.nan)
+            if mode in self.trees and len(valid):
+                (point_rows, _), nearest = self.trees[mode].query_nearest(
+                    points, return_distance=True, all_matches=False
+                )
+                distances[mode][valid[point_rows]] = nearest
+        return distances
+
+
+def _route_type_mode(route_type):
+    for mode, route_types in ROUTE_TYPES.items():
+        if route_type in route_types:
+            return mode
+    return None
+
+
+def _stop_mode(value):
+    """The mode of a value in the mode column of a stop file, a GTFS route type or a name."""
+    try:
+        return _route_type_mode(int(value))
+    except (TypeError, ValueError):
+        return MODE_NAMES.get(str(value).strip().lower())
+
+
+def _gtfs_stop_modes(directory):
+    """Get the modes served at each stop of a GTFS feed, from its routes, trips and stop times."""
+    import pandas as pd
+
+    routes = pd.read_csv(f'{directory}/routes.txt', usecols=['route_id', 'route_type'], dtype={'route_id': str})
+    route_modes = routes.set_index('route_id')['route_type'].map(_route_type_mode)
+    trips = pd.read_csv(f'{directory}/trips.txt', usecols=['trip_id', 'route_id'], dtype=str)
+    trip_modes = trips.set_index('trip_id')['route_id'].map(route_modes).dropna()
+
+    # stop_times.txt of a national feed has tens of millions of rows, so it is read in chunks
+    stop_modes = []
+    for chunk in pd.read_csv(
+        f'{directory}/stop_times.txt', usecols=['trip_id', 'stop_id'], dtype=str, chunksize=STOP_TIMES_CHUNK_SIZE
+    ):
+        modes = pd.DataFrame({'stop_id': chunk['stop_id'], 'mode': chunk['trip_id'].map(trip_modes)})
+        stop_modes.append(modes.dropna().drop_duplicates())
+    return pd.concat(stop_modes).drop_duplicates()
+
+
+def _load_stops(path, zone=ZONE):
+    """
+    Read the stops of each mode from a stop file, projected to UTM. The file is a GTFS
+    stops.txt, with the modes taken from the rest of the feed in the same directory, or a
+    CSV of stop points with a mode column.
+    """
+    import pandas as pd
+
+    stops = pd.read_csv(path, dtype={'stop_id': str})
+    latitude = next(col for col in ('stop_lat', 'latitude', 'lat') if col in stops.columns)
+    longitude = next(col for col in ('stop_lon', 'longitude', 'lon') if col in stops.columns)
+    mode_column = next((col for col in ('mode', 'vehicle_type', 'route_type') if col in stops.columns), None)
+    if mode_column is not None:
+        stops['mode'] = stops[mode_column].map(_stop_mode)
+    else:
+        directory = os.path.dirname(path)
+        if not os.path.exists(f'{directory}/stop_times.txt'):
+            raise ValueError(f"{path} has no mode column and is not part of a GTFS feed.")
+        stops = stops.merge(_gtfs_stop_modes(directory), on='stop_id')
+    stops = stops.dropna(subset=['mode', latitude, longitude])
+
+    projected = {}
+    for mode in MODE_COLUMNS:
+        mode_stops = stops[stops['mode'] == mode]
+        projected[mode] = wgs84_to_utm(mode_stops[latitude].to_numpy(), mode_stops[longitude].to_numpy(), zone)
+    return projected
+
+
+def find_transit_stops_file(root=None):
+    """Find the GTFS stops.txt, or other stop point file, in the project root."""
+    if os.getenv('TRANSIT_STOPS_PATH'):
+        return os.getenv('TRANSIT_STOPS_PATH')
+    root = root or PATH_ROOT
+    candidates = sorted(glob.glob(f'{root}/stops.txt')) + sorted(glob.glob(f'{root}/*gtfs*/stops.txt'))
+    return candidates[0] if candidates else None
+
+
+def load_transit_index(path, cache_path=None):
+    """
+    Load a TransitIndex from a stop file. The projected stops are cached in cache_path,
+    which is rebuilt when the stop file changes.
+    """
+    cache_path = cache_path or f'{PATH_ROOT}/files/transit_index.pkl'
+    stat = os.stat(path)
+    source = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['source'] == source:
+            return TransitIndex(cached['stops'], cached['zone'], source)
+
+    print(f"Building transit stop index from {path}...")
+    stops = _load_stops(path)
+    index = TransitIndex(stops, ZONE, source)
+    print(', '.join(f"{len(eastings)} {mode} stops" for mode, (eastings, _) in stops.items()))
+    if os.path.isdir(os.path.dirname(cache_path)):
+        with open(cache_path, 'wb') as f:
+            pickle.dump({'source': source, 'stops': stops, 'zone': ZONE}, f)
+    return index
+
+
+_index = None
+
+
+def get_transit_index():
+    """Get the shared transit stop index, or None if there is no stop file."""
+    global _index
+    if _index is None:
+        path = find_transit_stops_file()
+        if path is None or not os.path.exists(path):
+            return None
+        _index = load_transit_index(path)
+    return _index
+
+
+def cached_distances(index, latitudes, longitudes, cache_path=None):
+    """
+    Get the distances to the nearest stop of each mode, like TransitIndex.nearest, from
+    a cache keyed on the coordinates. Only coordinates that are not cached yet are looked
+    up. The cache is cleared when the stop file changes.
+    """
+    cache_path = cache_path or f'{PATH_ROOT}/files/transit_distances.pkl'
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['source'] == index.source:
+            cache = cached['distances']
+
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    valid = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+    # Rounded to about 10 cm, so the same address geocoded twice gets the same key
+    keys = list(zip(np.round(latitudes[valid], 6).tolist(), np.round(longitudes[valid], 6).tolist()))
+    missing = [key for key in dict.fromkeys(keys) if key not in cache]
+    get_metrics().count('transit_cache.hits', len(keys) - len(missing))
+    get_metrics().count('transit_cache.misses', len(missing))
+    if missing:
+        distances = index.nearest([key[0] for key in missing], [key[1] for key in missing])
+        for i, key in enumerate(missing):
+            cache[key] = tuple(float(distances[mode][i]) for mode in MODE_COLUMNS)
+        if os.path.isdir(os.path.dirname(cache_path)):
+            with open(cache_path, 'wb') as f:
+                pickle.dump({'source': index.source, 'distances': cache}, f)
+
+    rows = np.full((len(latitudes), len(MODE_COLUMNS)), np.nan)
+    if keys:
+        rows[valid] = [cache[key] for key in keys]
+    return {mode: rows[:, i] for i, mode in enumerate(MODE_COLUMNS)}
+
+
+def add_transit_distances(df, index=None, cache_path=None):
+    """
+    Replace the scraped avstand-tbane, avstand-trikk and avstand-buss with the straight
+    line distance in metres from each listing to the nearest stop of each mode. The
+    scraped distances are in mixed units, so none of them are kept: listings without
+    coordinates, and modes without stops in the stop file, get NaN. Without a stop file
+    the scraped distances are left as they are.
+    """
+    if index is None:
+        index = get_transit_index()
+    if index is None:
+        print("No transit stops found. Keeping the scraped distances.")
+        return df
+
+    distances = cached_distances(index, df['latitude'], df['longitude'], cache_path)
+    for mode, column in MODE_COLUMNS.items():
+        df[column] = np.round(distances[mode])
+    return df